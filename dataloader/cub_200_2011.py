@@ -2,6 +2,7 @@ from dataset.cub_200_2011 import Cub2002011 as Dataset
 from torch.utils.data import DataLoader
 from torchvision import transforms
 from utils.util import get_object_from_path
+from dataloader.sampler import get_train_sampler, get_test_sampler
 
 
 class Cub2002011:
@@ -75,11 +76,16 @@ class Cub2002011:
         batch_size = self.config.cfg["dataloader"]["batch_size"]  # Batch size for the dataloader
         shuffle = self.config.cfg["dataloader"]["shuffle"]  # Either to shuffle dataset or not
         num_workers = self.config.cfg["dataloader"]["num_workers"]  # Number of workers to load the dataset
+        # Shard the datasets across the processes for distributed training
+        train_sampler = get_train_sampler(self.train_dataset, shuffle)
+        test_sampler = get_test_sampler(self.test_dataset)
         # Create the train dataloader
-        train_dataloader = DataLoader(dataset=self.train_dataset, batch_size=batch_size, shuffle=shuffle,
+        train_dataloader = DataLoader(dataset=self.train_dataset, batch_size=batch_size,
+                                      shuffle=shuffle if train_sampler is None else False, sampler=train_sampler,
                                       num_workers=num_workers)
         # Create the test dataloader
-        test_dataloader = DataLoader(dataset=self.test_dataset, batch_size=batch_size, shuffle=shuffle,
+        test_dataloader = DataLoader(dataset=self.test_dataset, batch_size=batch_size,
+                                     shuffle=shuffle if test_sampler is None else False, sampler=test_sampler,
                                      num_workers=num_workers)
         # Return train and test dataloader
         return train_dataloader, test_dataloader
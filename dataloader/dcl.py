@@ -2,6 +2,7 @@ from dataset.dcl import DCL as Dataset
 from torch.utils.data import DataLoader
 from torchvision import transforms
 from utils.util import get_object_from_path
+from dataloader.sampler import get_train_sampler, get_test_sampler
 import torch
 
 
@@ -11,8 +12,11 @@ def collate_train(batch):
 
     :param batch: The list containing outputs of the __get_item__() function.
     Length of the list is equal to the required batch size.
-    :return: The batch containing images and labels for DCL training
+    :return: The batch containing images and labels for DCL training, the original images and labels only (and None
+    jigsaw labels) for the classification only steps of an auxiliary task schedule
     """
+    if batch[0][1] is None:
+        return torch.stack([sample[0] for sample in batch], 0), [sample[2] for sample in batch], None, None
     imgs = []  # List to store the images
     target = []  # List to store the targets
     target_jigsaw = []  # List to store the jigsaw targets
@@ -151,11 +155,15 @@ class DCL:
         batch_size = self.config.cfg["dataloader"]["batch_size"]  # Batch size for the dataloader
         shuffle = self.config.cfg["dataloader"]["shuffle"]  # Either to shuffle dataset or not
         num_workers = self.config.cfg["dataloader"]["num_workers"]  # Number of workers to load the dataset
+        # Shard the datasets across the processes for distributed training
+        train_sampler = get_train_sampler(self.train_dataset, shuffle)
+        test_sampler = get_test_sampler(self.test_dataset)
         # Create the train dataloader
         train_dataloader = DataLoader(dataset=self.train_dataset, batch_size=batch_size, collate_fn=collate_train,
-                                      shuffle=shuffle, num_workers=num_workers, pin_memory=True)
+                                      shuffle=shuffle if train_sampler is None else False, sampler=train_sampler,
+                                      num_workers=num_workers, pin_memory=True)
         # Create the test dataloader
         test_dataloader = DataLoader(dataset=self.test_dataset, batch_size=batch_size, collate_fn=collate_test,
-                                     num_workers=num_workers, pin_memory=True)
+                                     sampler=test_sampler, num_workers=num_workers, pin_memory=True)
         # Return train and test dataloader
         return train_dataloader, test_dataloader
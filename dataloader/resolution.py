@@ -0,0 +1,52 @@
+from torch.utils.data import Subset
+from torchvision import transforms
+
+# The transforms whose output size is scaled by the resolution schedule
+SIZE_TRANSFORMS = (transforms.Resize, transforms.RandomCrop, transforms.CenterCrop, transforms.RandomResizedCrop)
+# The dataset attributes holding the train transforms (Cub2002011/Cub2002011Contrastive and DCL datasets)
+TRANSFORM_ATTRIBUTES = ["transform", "common_transform", "final_transform"]
+
+
+def _scale_size(size, scale):
+    if isinstance(size, int):
+        return max(int(round(size * scale)), 1)
+    return type(size)(max(int(round(s * scale)), 1) for s in size)
+
+
+def get_resolution_scale(resolution_schedule, epoch):
+    """
+    The function returns the train resolution scale of the epoch.
+
+    :param resolution_schedule: List of {'epochs': [first, last], 'scale': ...} entries (train.resolution_schedule)
+    :param epoch: The epoch
+    :return: The scale of the first entry containing the epoch, 1 (the configured resolution) if none
+    """
+    for entry in resolution_schedule or []:
+        first, last = entry["epochs"]
+        if first <= epoch <= last:
+            return entry["scale"]
+    return 1
+
+
+def set_train_resolution(dataloader, scale):
+    """
+    The function scales the resize dimensions and the sizes of the resize and crop transforms of the train dataset
+    of the dataloader with respect to the configured ones. The DCL jigsaw grid and the PIRL jigsaw crops are not
+    changed. The dataloader workers pick up the new sizes at the next epoch (the workers are not persistent).
+
+    :param dataloader: The train dataloader
+    :param scale: The resolution scale, e.g. 0.5 to train a 448px configuration at 224px
+    """
+    dataset = dataloader.dataset
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    for name in TRANSFORM_ATTRIBUTES:
+        for transform in getattr(getattr(dataset, name, None), "transforms", []):
+            if isinstance(transform, SIZE_TRANSFORMS):
+                if not hasattr(transform, "_configured_size"):
+                    transform._configured_size = transform.size
+                transform.size = _scale_size(transform._configured_size, scale)
+    if getattr(dataset, "resize_dims", None) is not None:
+        if not hasattr(dataset, "_configured_resize_dims"):
+            dataset._configured_resize_dims = dataset.resize_dims
+        dataset.resize_dims = _scale_size(dataset._configured_resize_dims, scale)
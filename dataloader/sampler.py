@@ -0,0 +1,171 @@
+import math
+from torch.utils.data import Sampler, Subset, DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from utils.distributed import is_distributed, get_rank, get_world_size
+
+
+class ResumableSampler(DistributedSampler):
+    """
+    The class extends the DistributedSampler so that the training can be resumed from the middle of an epoch. The
+    order of the samples depends only on the seed and the epoch, and the samples already consumed in the interrupted
+    epoch are skipped. It is also used for single process training (one replica).
+    """
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0):
+        """
+        Constructor, the function initializes the sampler parameters.
+
+        :param dataset: The dataset to sample from
+        :param num_replicas: Number of processes participating in the training
+        :param rank: Rank of the current process
+        :param shuffle: Either to shuffle the dataset or not
+        :param seed: Random seed used to shuffle the dataset, must be the same across the processes
+        """
+        super(ResumableSampler, self).__init__(dataset,
+                                               num_replicas=num_replicas if num_replicas is not None
+                                               else get_world_size(),
+                                               rank=rank if rank is not None else get_rank(),
+                                               shuffle=shuffle, seed=seed)
+        self.start_index = 0  # Number of samples of the current epoch to skip
+        self.aux_task_schedule = None  # Schedule of the steps computing the auxiliary task, see set_aux_task_schedule()
+        self.batch_size = None  # Batch size of the dataloader, maps the samples to their steps
+
+    def set_epoch(self, epoch):
+        super(ResumableSampler, self).set_epoch(epoch)
+        self.start_index = 0  # A new epoch starts from the beginning
+
+    def set_start_index(self, start_index):
+        """
+        The function sets the number of samples of the current epoch already consumed, must be called after set_epoch.
+
+        :param start_index: Number of samples to skip
+        """
+        self.start_index = start_index
+
+    def set_aux_task_schedule(self, aux_task_schedule, batch_size):
+        """
+        The function makes the sampler yield (index, aux) pairs, aux being False for the samples of the steps which do
+        not compute the auxiliary task, so that the dataset skips building the auxiliary inputs of these samples.
+
+        :param aux_task_schedule: The AuxTaskSchedule (train/aux_task_schedule.py)
+        :param batch_size: Batch size of the dataloader
+        """
+        self.aux_task_schedule = aux_task_schedule
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        indices = list(super(ResumableSampler, self).__iter__())[self.start_index:]
+        if self.aux_task_schedule is None:
+            return iter(indices)
+        return iter((index, self.aux_task_schedule.is_aux_step(self.epoch, (self.start_index + i) // self.batch_size))
+                    for i, index in enumerate(indices))
+
+    def __len__(self):
+        return max(self.num_samples - self.start_index, 0)
+
+
+class DistributedEvalSampler(Sampler):
+    """
+    The class implements a sequential sampler that shards the dataset across the processes without padding,
+    so that every sample is evaluated exactly once and the metrics reduced across the processes are exact.
+    """
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        """
+        Constructor, the function initializes the sampler parameters.
+
+        :param dataset: The dataset to sample from
+        :param num_replicas: Number of processes participating in the evaluation
+        :param rank: Rank of the current process
+        """
+        self.dataset = dataset
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return int(math.ceil((len(self.dataset) - self.rank) / self.num_replicas))
+
+
+def get_train_sampler(dataset, shuffle):
+    """
+    The function returns the resumable sampler for the train dataloader, which shards the dataset across the
+    processes for distributed training.
+
+    :param dataset: The train dataset
+    :param shuffle: Either to shuffle the dataset or not
+    """
+    return ResumableSampler(dataset, shuffle=shuffle)
+
+
+def set_sampler_start_index(dataloader, start_index):
+    """
+    The function skips the first start_index samples of the current epoch of the dataloader sampler (if supported).
+
+    :param dataloader: The dataloader
+    :param start_index: Number of samples to skip
+    """
+    sampler = getattr(dataloader, "sampler", None)
+    if hasattr(sampler, "set_start_index"):
+        sampler.set_start_index(start_index)
+
+
+def set_sampler_aux_task_schedule(dataloader, aux_task_schedule):
+    """
+    The function sets the auxiliary task schedule of the dataloader sampler (if supported), see
+    ResumableSampler.set_aux_task_schedule().
+
+    :param dataloader: The train dataloader
+    :param aux_task_schedule: The AuxTaskSchedule
+    """
+    sampler = getattr(dataloader, "sampler", None)
+    if hasattr(sampler, "set_aux_task_schedule"):
+        sampler.set_aux_task_schedule(aux_task_schedule, dataloader.batch_size)
+
+
+def get_test_sampler(dataset):
+    """
+    The function returns the sampler for the test dataloader, a DistributedEvalSampler for distributed training
+    and None (i.e. the default DataLoader sampler) otherwise.
+
+    :param dataset: The test dataset
+    """
+    if is_distributed():
+        return DistributedEvalSampler(dataset)
+    return None
+
+
+def get_subset_dataloader(dataloader, fraction):
+    """
+    The function returns a dataloader over a fixed, evenly spaced subset of the dataset of the given dataloader,
+    e.g. for a fast validation pass. The test datasets are ordered by image id (i.e. by class), so every class is
+    represented in the subset.
+
+    :param dataloader: The (test) dataloader
+    :param fraction: Fraction of the dataset to keep (0 < fraction <= 1)
+    """
+    dataset = dataloader.dataset
+    step = max(int(round(1 / fraction)), 1)
+    subset = Subset(dataset, list(range(0, len(dataset), step)))
+    return DataLoader(dataset=subset, batch_size=dataloader.batch_size, collate_fn=dataloader.collate_fn,
+                      sampler=get_test_sampler(subset), num_workers=dataloader.num_workers,
+                      pin_memory=dataloader.pin_memory)
+
+
+def get_shard_dataloader(dataloader, shard, shards, batch_size=None, num_workers=None):
+    """
+    The function returns a dataloader over the shard-th of shards interleaved shards of the dataset of the given
+    dataloader, e.g. for the evaluation of the test dataset by several processes.
+
+    :param dataloader: The (test) dataloader
+    :param shard: The index of the shard (0 <= shard < shards)
+    :param shards: Number of the shards
+    :param batch_size: The batch size, the batch size of the dataloader if None
+    :param num_workers: Number of the dataloader workers, the workers of the dataloader if None
+    """
+    dataset = dataloader.dataset
+    subset = Subset(dataset, list(range(shard, len(dataset), shards))) if shards > 1 else dataset
+    return DataLoader(dataset=subset, batch_size=batch_size or dataloader.batch_size,
+                      collate_fn=dataloader.collate_fn,
+                      num_workers=dataloader.num_workers if num_workers is None else num_workers,
+                      pin_memory=dataloader.pin_memory)
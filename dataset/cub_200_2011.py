@@ -83,6 +83,9 @@ class Cub2002011(Dataset):
         else:
             self.data = self.data[self.data.is_training_img == 0]
             self.data = self.data.groupby('target').apply(self.__sample_data_test)
+        # Keep a deterministic order of the samples, the dataset indices must refer to the same images in all the
+        # processes of a distributed training
+        self.data = self.data.sort_values('img_id')
 
     def _check_integrity(self):
         """
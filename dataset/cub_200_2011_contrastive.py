@@ -1,5 +1,6 @@
 import os
 import pandas as pd
+import torch
 from torchvision.datasets.folder import default_loader
 from utils.util import download_file_from_google_drive
 from torch.utils.data import Dataset
@@ -75,6 +76,9 @@ class Cub2002011Contrastive(Dataset):
         else:
             self.data = self.data[self.data.is_training_img == 0]
             self.data = self.data.groupby('target').apply(self.__sample_data_test)
+        # Keep a deterministic order of the samples, the dataset indices must refer to the same images in all the
+        # processes of a distributed training
+        self.data = self.data.sort_values('img_id')
 
     def _check_integrity(self):
         """
@@ -139,9 +143,11 @@ class Cub2002011Contrastive(Dataset):
         """
         The function overrides the __getitem__ method of the Dataset class.
 
-        :param idx: The index to fetch the data entry/sample
+        :param idx: The index to fetch the data entry/sample, or the (index, aux) pair yielded by the train sampler
+        with an auxiliary task schedule, the contrastive transforms are skipped if aux is False
         :return: The image tensor and corresponding label
         """
+        idx, aux = idx if isinstance(idx, tuple) else (idx, True)
         sample = self.data.iloc[idx]  # Get the idx data sample
         path = os.path.join(self.root, self.base_folder, sample.filepath)  # Path of the image
         target = sample.target - 1  # Targets start at 1 by default, so shift to 0
@@ -154,7 +160,10 @@ class Cub2002011Contrastive(Dataset):
         if self.transform is not None:
             o = self.transform(img)
         if self.train:
-            if self.contrastive_transform is not None:
+            if not aux:
+                # Classification only step, empty jigsaw crops
+                t_1, t_2 = [], torch.empty(0)
+            elif self.contrastive_transform is not None:
                 t_1, t_2 = self.contrastive_transform(img)
                 # Return the original image tensor, transformed image tensors, and target/label corresponding to
                 # original image
@@ -27,15 +27,22 @@ class DCL(Cub2002011):
     def __getitem__(self, idx):
         """
         The function overrides the __getitem__ method of the Cub2002011 class
-        :param idx: The index to fetch the data entry/sample
+        :param idx: The index to fetch the data entry/sample, or the (index, aux) pair yielded by the train sampler
+        with an auxiliary task schedule, the jigsaw image and labels are skipped if aux is False
         :return: The image tensor and corresponding label
         """
+        idx, aux = idx if isinstance(idx, tuple) else (idx, True)
         sample = self.data.iloc[idx]
         path = os.path.join(self.root, self.base_folder, sample.filepath)
         target = sample.target - 1  # Targets start at 1 by default, so shift to 0
         img = self.loader(path)  # Call the loader function to load the image
         if self.train:
             img_original = self.common_transform(img) if self.common_transform is not None else img
+            if not aux:
+                # Classification only step, no jigsaw image and labels
+                img_original = self.final_transform(img_original) if self.final_transform is not None \
+                    else img_original
+                return img_original, None, target, None, None, None
             img_original_list = get_image_crops(img_original, self.crop_patch_size)
             original_patch_range = self.crop_patch_size[0] * self.crop_patch_size[1]
             original_patch_labels = [(i - (original_patch_range // 2)) / original_patch_range
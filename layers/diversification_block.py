@@ -17,7 +17,7 @@ class DiversificationBlock(nn.Module):
         :param alpha: Suppression factor
         :param p_peak: Probability for peak suppression
         :param p_patch: Probability for patch suppression
-        :param device: Device of execution
+        :param device: Device of execution (unused, the masks are created on the device of the activations)
         """
         # Call the parent constructor
         super(DiversificationBlock, self).__init__()
@@ -27,43 +27,31 @@ class DiversificationBlock(nn.Module):
         self.p_peak = p_peak
         self.p_patch = p_patch
         self.device = device
+        self.enabled = True  # Bypassed if False, e.g. by the selection pass of the selective backpropagation
 
     def forward(self, activation):
         """
-        The function implements the forward pass for the DB.
+        The function implements the forward pass for the DB. The Bernoulli masks are drawn per class (peak
+        suppression) and per patch (patch suppression), and expanded to the CAMs resolution only once.
 
         :param activation: The class activation maps (CAMs) to apply the suppression on.
+        :return: The suppressed CAMs (the input CAMs are not modified)
         """
-        peak = torch.max(torch.max(activation, 3).values, 2).values  # Find the peak location in CAMs
-        # Bernoulli prob for p_peak: 0 or 1 randomly for c classes
-        rc = torch.bernoulli(torch.mul(torch.ones(activation.size(), device=self.device), torch.tensor(self.p_peak)))
+        if not self.enabled:
+            return activation
         b, c, m, n = activation.shape
-        # Peak Suppression
-        pc = torch.zeros_like(activation)  # Mask for peaks for each class
-        pc[activation == torch.unsqueeze(torch.unsqueeze(peak, 2), 3)] = 1
-        bc_dash = torch.mul(rc, pc)  # Peak suppression mask
-
-        # Patch suppression
-        # Patching image to 'kernel_size x kernel_size' patches
-        stride = self.kernel_size  # Kernel size
-        # Extract patches
-        patches = activation.unfold(2, self.kernel_size, stride).unfold(3, self.kernel_size, stride)
-        l, k = patches.shape[2], patches.shape[3]
-        # Bernoulli prob for p_patch
-        p_patch = torch.bernoulli(torch.mul(torch.ones(patches.size()[:-2],
-                                                       device=self.device), torch.tensor(self.p_patch)))
-        bc_dd = torch.zeros_like(patches)  # Mask initialization for peaks for each patch
-        bc_dd[p_patch == 1] = 1  # Sets value 1 to suppress at random peak locations
-        # Combines mask patches to single mask
-        bc_dd = (bc_dd.reshape(b, c, l, k, self.kernel_size * self.kernel_size)).permute(0, 1, 4, 2, 3)
-        bc_dd = bc_dd.reshape(b, c, self.kernel_size * self.kernel_size, -1)
-        bc_dd_batch = torch.zeros_like(activation)
-        for i in range(b):
-            bc_dd_batch[i] = F.fold(bc_dd[i], (m, n), kernel_size=self.kernel_size, stride=stride).squeeze(1)
-        bc_dd_batch[activation == torch.unsqueeze(torch.unsqueeze(peak, 2), 3)] = 0
-        # Mask for total suppression
-        bc = bc_dash + bc_dd_batch
+        # Peak location of each CAM
+        peak = activation.flatten(2).argmax(dim=2, keepdim=True)
+        is_peak = (torch.arange(m * n, device=activation.device) == peak).view(b, c, m, n)
+        # Peak suppression: Bernoulli draw with p_peak for each CAM
+        rc = torch.rand(b, c, 1, 1, device=activation.device) < self.p_peak
+        # Patch suppression: Bernoulli draw with p_patch for each 'kernel_size x kernel_size' patch, the incomplete
+        # patches of the borders are never suppressed
+        l, k = m // self.kernel_size, n // self.kernel_size
+        bc_dd = torch.rand(b, c, l, k, device=activation.device) < self.p_patch
+        bc_dd = bc_dd.repeat_interleave(self.kernel_size, dim=2).repeat_interleave(self.kernel_size, dim=3)
+        bc_dd = F.pad(bc_dd, (0, n - k * self.kernel_size, 0, m - l * self.kernel_size))
+        # The peaks are only suppressed by the peak suppression, the other locations by the patch suppression
+        bc = torch.where(is_peak, rc, bc_dd)
         # Suppress the activations using activation suppression factor called alpha
-        activation[bc >= 1] *= self.alpha
-
-        return activation
+        return torch.where(bc, activation * self.alpha, activation)
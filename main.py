@@ -2,11 +2,6 @@ import sys
 import os
 import logging
 import shutil
-from config.config import Configuration as config
-from dataloader.common import Dataloader
-from model.common import Model
-from train.common import Trainer
-from utils.util import load_vissl_weights
 import argparse
 
 
@@ -17,6 +12,8 @@ def parse_arguments():
     ap = argparse.ArgumentParser()
     ap.add_argument("-config", "--config_path", required=False, default="config.yml",
                     help="The path to the pipeline .yml configuration file.")
+    ap.add_argument("--resume", action="store_true",
+                    help="Resume the training from the last training state saved in the experiment directory.")
 
     args = vars(ap.parse_args())
 
@@ -29,36 +26,61 @@ def main():
     """
     # Parse the arguments
     args = parse_arguments()
+    # The pipeline modules (torch, torchvision, ...) are only imported once the arguments are parsed, --help is instant
+    import numpy as np
+    from config.config import Configuration as config
+    from dataloader.common import Dataloader
+    from model.common import Model
+    from train.common import Trainer
+    from train.state import load_training_state
+    from utils.util import load_vissl_weights
+    from utils.weight_registry import get_weight_registry
+    from utils.distributed import init_distributed, cleanup_distributed, is_main_process, barrier
+    from utils.preemption import install_preemption_handler
     config_path = args["config_path"]  # Config path
+    resume = args["resume"]  # Either to resume the training of an existing experiment or not
     # Load the configuration file
     config.load_config(config_path)
     # Read the general configuration parameters
     output_directory = config.cfg["general"]["output_directory"]
     experiment_id = config.cfg["general"]["experiment_id"]
     model_checkpoints_directory_name = config.cfg["general"]["model_checkpoints_directory_name"]
+    # Initialize the process group if launched with torchrun (e.g. torchrun --nproc_per_node=2 main.py)
+    init_distributed(config.cfg["train"].get("device", "cuda"), config.cfg["train"].get("distributed_backend"))
+    checkpoints_dir_path = f"{output_directory}/{experiment_id}/{model_checkpoints_directory_name}"
     # Create the output and experiment directory
-    if not os.path.exists(f"{output_directory}/{experiment_id}/{model_checkpoints_directory_name}"):
-        os.makedirs(f"{output_directory}/{experiment_id}/{model_checkpoints_directory_name}")
-    else:
-        print(f"The directory {output_directory}/{experiment_id} already exits. Please delete the directory or change "
-              f"the experiment_id in the configuration file.")
+    if resume and not os.path.exists(checkpoints_dir_path):
+        print(f"The directory {checkpoints_dir_path} does not exist. Nothing to resume from.")
+        sys.exit(1)
+    if not resume and os.path.exists(checkpoints_dir_path):
+        print(f"The directory {output_directory}/{experiment_id} already exits. Please delete the directory, change "
+              f"the experiment_id in the configuration file or use --resume to continue the training.")
         sys.exit(1)
-    # Copy the configuration file to experiment directory
-    shutil.copyfile(config_path, f"{output_directory}/{experiment_id}/{config_path.split('/')[-1]}")
-    # Configure the logger
-    logging.basicConfig(level=logging.DEBUG,
-                        format="%(asctime)s: %(name)-s: %(levelname)-s: %(message)s",
-                        datefmt="%m-%d %H:%M",
-                        filename=f"{output_directory}/{experiment_id}/{experiment_id}.log",
-                        filemode="w")
+    barrier()  # All the processes must check the directory before the main process creates it
+    if is_main_process():
+        if not resume:
+            os.makedirs(checkpoints_dir_path)
+            # Copy the configuration file to experiment directory
+            shutil.copyfile(config_path, f"{output_directory}/{experiment_id}/{config_path.split('/')[-1]}")
+        # Configure the logger
+        logging.basicConfig(level=logging.DEBUG,
+                            format="%(asctime)s: %(name)-s: %(levelname)-s: %(message)s",
+                            datefmt="%m-%d %H:%M",
+                            filename=f"{output_directory}/{experiment_id}/{experiment_id}.log",
+                            filemode="a" if resume else "w")
+    else:
+        # Only the main process logs the training progress, the other processes only report the warnings
+        logging.getLogger().setLevel(logging.WARNING)
+    barrier()
     # Define a Handler which writes INFO messages
     console = logging.StreamHandler()
-    console.setLevel(logging.INFO)
+    console.setLevel(logging.INFO if is_main_process() else logging.WARNING)
     # Set a format which is simpler for console use
     formatter = logging.Formatter('%(name)-s: %(levelname)-s: %(message)s')
     console.setFormatter(formatter)  # Tell the handler to use this format
     logging.getLogger().addHandler(console)  # Add the handler to the root logger
     # Create the dataloaders
+    np.random.seed(0)  # All the processes and the resumed runs must sample the same train/test data fractions
     dataloader = Dataloader(config=config)
     train_loader, test_loader = dataloader.get_loader()
     # Create the model
@@ -67,21 +89,28 @@ def main():
     try:
         vissl_checkpoints_path = config.cfg["model"]["vissl_weights_path"]
         if not len(vissl_checkpoints_path) == 0:
-            model = load_vissl_weights(model, vissl_checkpoints_path)
+            model = load_vissl_weights(model, vissl_checkpoints_path, get_weight_registry(config))
     except Exception:
         pass
+    # Stop after the current step and save a restart snapshot when the scheduler sends SIGTERM
+    install_preemption_handler()
+    # Load the training state (model, optimizer, lr scheduler, phase, epoch, etc.) to resume from
+    resume_state = load_training_state(checkpoints_dir_path) if resume else None
     # Create the trainer and run training
     warm_up_epochs = config.cfg["train"]["warm_up_epochs"]
-    if warm_up_epochs > 0:
+    if warm_up_epochs > 0 and (resume_state is None or resume_state["phase"] == "warm_up"):
         logging.info(f"Starting warp-up training loop using "
                      f"{config.cfg['train']['warm_up_loss_function_path'].split('.')[-1]} for {warm_up_epochs} epochs.")
         trainer = Trainer(config=config, model=model, dataloader=train_loader, val_dataloader=test_loader,
                           warm_up=True).get_trainer()
-        trainer.train_and_validate(start_epoch=1, end_epoch=warm_up_epochs)
+        trainer.train_and_validate(start_epoch=1, end_epoch=warm_up_epochs, phase="warm_up",
+                                   resume_state=resume_state)
+        resume_state = None  # The main training loop starts from scratch after the warm-up
     logging.info(f"Staring main training loop using {config.cfg['train']['class_loss_function_path'].split('.')[-1]} "
                  f"for {config.cfg['train']['epochs'] - warm_up_epochs} epochs.")
     trainer = Trainer(config=config, model=model, dataloader=train_loader, val_dataloader=test_loader).get_trainer()
-    trainer.train_and_validate(start_epoch=warm_up_epochs + 1)
+    trainer.train_and_validate(start_epoch=warm_up_epochs + 1, phase="main", resume_state=resume_state)
+    cleanup_distributed()
 
 
 if __name__ == "__main__":
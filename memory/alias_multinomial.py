@@ -10,46 +10,46 @@ class AliasMethod(object):
     From: https://hips.seas.harvard.edu/blog/2013/03/03/the-alias-method-efficient-sampling-with-many-discrete-outcomes/
     """
     def __init__(self, probs):
-
-        if probs.sum() > 1:
-            probs.div_(probs.sum())
+        """
+        Build the alias tables without a python loop: the outcomes larger than 1/K give their excess, in order, to
+        the smaller outcomes in order (a larger outcome whose excess is exhausted becomes smaller and is completed by
+        the next larger outcome), the donor of each outcome is found on the cumulative sums of the deficits and excesses
+        :param probs: probabilities of the K outcomes (normalized if required)
+        """
         K = len(probs)
-        self.prob = torch.zeros(K)
-        self.alias = torch.LongTensor([0]*K)
-
-        # Sort the data into the outcomes with probabilities
-        # that are larger and smaller than 1/K.
-        smaller = []
-        larger = []
-        for kk, prob in enumerate(probs):
-            self.prob[kk] = K*prob
-            if self.prob[kk] < 1.0:
-                smaller.append(kk)
-            else:
-                larger.append(kk)
-
-        # Loop though and create little binary mixtures that
-        # appropriately allocate the larger outcomes over the
-        # overall uniform mixture.
-        while len(smaller) > 0 and len(larger) > 0:
-            small = smaller.pop()
-            large = larger.pop()
-
-            self.alias[small] = large
-            self.prob[large] = (self.prob[large] - 1.0) + self.prob[small]
-
-            if self.prob[large] < 1.0:
-                smaller.append(large)
-            else:
-                larger.append(large)
-
-        for last_one in smaller+larger:
-            self.prob[last_one] = 1
+        prob = probs.double().cpu() * K / probs.sum().double()
+        alias = torch.arange(K)
+
+        is_larger = prob >= 1.0
+        is_larger[prob.argmax()] = True  # At least one larger outcome, even with rounding errors
+        smaller = torch.nonzero(~is_larger, as_tuple=True)[0]
+        larger = torch.nonzero(is_larger, as_tuple=True)[0]
+        # Cumulative deficits of the smaller outcomes and cumulative excesses of the larger outcomes
+        deficits = torch.cumsum(1.0 - prob[smaller], 0)
+        excesses = torch.cumsum(prob[larger] - 1.0, 0)
+        # The smaller outcome i is completed by the larger outcome j such that excesses[j - 1] < deficits[i - 1] <=
+        # excesses[j]
+        donor = torch.searchsorted(excesses, deficits - (1.0 - prob[smaller])).clamp(max=len(larger) - 1)
+        alias[smaller] = larger[donor]
+        # The larger outcome j is exhausted by the first smaller outcome with deficits[i] > excesses[j], its deficit
+        # is completed by the next larger outcome (the last one is never exhausted, up to rounding errors)
+        last = torch.searchsorted(deficits, excesses, right=True)
+        exhausted = torch.nonzero(last[:-1] < len(smaller), as_tuple=True)[0]
+        prob[larger] = 1.0
+        prob[larger[exhausted]] = (1.0 - (deficits[last[exhausted]] - excesses[exhausted])).clamp(0.0, 1.0)
+        alias[larger[exhausted]] = larger[exhausted + 1]
+
+        self.prob = prob.float()
+        self.alias = alias
 
     def cuda(self):
         self.prob = self.prob.cuda()
         self.alias = self.alias.cuda()
 
+    def to(self, device):
+        self.prob = self.prob.to(device)
+        self.alias = self.alias.to(device)
+
     def draw(self, N):
         """
         Draw N samples from multinomial
@@ -67,3 +67,40 @@ class AliasMethod(object):
         oj = alias.mul((1-b).long())
 
         return oq + oj
+
+
+class UniformSampler(object):
+    """
+    Uniform multinomial, the samples are drawn directly without alias tables
+    """
+    def __init__(self, K):
+        """
+        :param K: number of outcomes
+        """
+        self.K = K
+        self.device = torch.device("cpu")
+
+    def cuda(self):
+        self.device = torch.device("cuda")
+
+    def to(self, device):
+        self.device = torch.device(device)
+
+    def draw(self, N):
+        """
+        Draw N samples from the uniform multinomial
+        :param N: number of samples
+        :return: samples
+        """
+        return torch.randint(0, self.K, (N,), device=self.device)
+
+
+def build_sampler(probs):
+    """
+    Build the sampler of a multinomial, the uniform multinomials skip the alias tables
+    :param probs: probabilities of the outcomes
+    :return: UniformSampler or AliasMethod, drawing samples with draw(N)
+    """
+    if bool((probs == probs[0]).all()):
+        return UniformSampler(len(probs))
+    return AliasMethod(probs)
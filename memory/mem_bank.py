@@ -5,7 +5,8 @@ Credits: The code has been taken from https://github.com/HobbitLong/PyContrast/t
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .alias_multinomial import AliasMethod
+from .alias_multinomial import build_sampler
+from utils.distributed import get_rank, get_world_size, broadcast_tensor, all_to_all_tensor
 
 
 class BaseMem(nn.Module):
@@ -28,8 +29,11 @@ class BaseMem(nn.Module):
             w_pos = torch.index_select(memory, 0, y.view(-1))
             w_pos.mul_(self.m)
             w_pos.add_(torch.mul(x, 1 - self.m))
-            updated_weight = F.normalize(w_pos)
-            memory.index_copy_(0, y, updated_weight)
+            # scatter reduce (sum) of the updates, duplicate indices (e.g. padded distributed batches) are averaged
+            # by the normalization where index_copy_ would keep an arbitrary one of them
+            memory.index_fill_(0, y.view(-1), 0).index_add_(0, y.view(-1), w_pos)
+            updated_weight = F.normalize(torch.index_select(memory, 0, y.view(-1)))
+            memory.index_copy_(0, y.view(-1), updated_weight)
 
     def _compute_logit(self, x, w):
         """
@@ -43,19 +47,59 @@ class BaseMem(nn.Module):
         out = out.squeeze().contiguous()
         return out
 
+    def _compute_shared_logit(self, x, w_pos, w_neg, mask=None):
+        """
+        Args:
+          x: feat, shape [bsz, n_dim]
+          w_pos: positive weight, shape [bsz, n_dim]
+          w_neg: negative weight shared by the batch, shape [K, n_dim]
+          mask: negatives equal to the positive of the sample, shape [bsz, K]
+        """
+        neg = torch.mm(x, w_neg.t())
+        if mask is not None:
+            neg = neg.masked_fill(mask, float("-inf"))
+        pos = torch.sum(x * w_pos, dim=1, keepdim=True).to(neg.dtype)
+        out = torch.cat([pos, neg], dim=1)
+        out = torch.div(out, self.T)
+        return out
+
 
 class RGBMem(BaseMem):
-    """Memory bank for single modality"""
-    def __init__(self, n_dim, n_data, K=65536, T=0.07, m=0.5):
+    """
+    Memory bank for single modality. With shared_negatives, the batch shares one draw of K negatives (the complete
+    memory bank if n_data <= K) instead of K independent negatives per sample, so the logits are a single matmul of
+    the features with the [K, n_dim] negatives instead of gathering [bsz, K + 1, n_dim] weights.
+    """
+    def __init__(self, n_dim, n_data, K=65536, T=0.07, m=0.5, shared_negatives=False):
         super(RGBMem, self).__init__(K, T, m)
-        # create sampler
-        self.multinomial = AliasMethod(torch.ones(n_data))
-        self.multinomial.cuda()
+        self.n_data = n_data
+        self.shared_negatives = shared_negatives
+        # create sampler, uniform without alias tables
+        self.multinomial = build_sampler(torch.ones(n_data))
 
         # create memory bank
         self.register_buffer('memory', torch.randn(n_data, n_dim))
         self.memory = F.normalize(self.memory)
 
+    def _apply(self, fn, *args, **kwargs):
+        # keep the sampler tables on the same device as the memory bank
+        super(RGBMem, self)._apply(fn, *args, **kwargs)
+        self.multinomial.to(self.memory.device)
+        return self
+
+    def broadcast(self):
+        """
+        Synchronize the memory bank of all processes with the one of rank 0 (replicated memory bank)
+        """
+        broadcast_tensor(self.memory, src=0)
+
+    def _get_weights(self, idx):
+        """
+        Args:
+          idx: flat index of the memory entries to fetch
+        """
+        return torch.index_select(self.memory, 0, idx)
+
     def forward(self, x, y, x_jig=None, all_x=None, all_y=None):
         """
         Args:
@@ -68,19 +112,37 @@ class RGBMem(BaseMem):
         bsz = x.size(0)
         n_dim = x.size(1)
 
-        # sample negative features
-        idx = self.multinomial.draw(bsz * (self.K + 1)).view(bsz, -1)
-        idx.select(1, 0).copy_(y.data)
-        w = torch.index_select(self.memory, 0, idx.view(-1))
-        w = w.view(bsz, self.K + 1, n_dim)
+        if self.shared_negatives:
+            # sample the negative features shared by the batch, the positives are fetched in the same call
+            if self.n_data <= self.K:
+                neg_idx = torch.arange(self.n_data, device=y.device)
+            else:
+                neg_idx = self.multinomial.draw(self.K)
+            w = self._get_weights(torch.cat([y.data, neg_idx]))
+            w_pos, w_neg = w[:bsz], w[bsz:]
+            # a sample is not its own negative
+            mask = y.data.unsqueeze(1) == neg_idx.unsqueeze(0)
 
-        # compute logits
-        logits = self._compute_logit(x, w)
-        if x_jig is not None:
-            logits_jig = self._compute_logit(x_jig, w)
+            # compute logits, the features and the jigsaw features share one matmul
+            if x_jig is not None:
+                logits, logits_jig = self._compute_shared_logit(
+                    torch.cat([x, x_jig]), torch.cat([w_pos, w_pos]), w_neg, torch.cat([mask, mask])).split(bsz)
+            else:
+                logits = self._compute_shared_logit(x, w_pos, w_neg, mask)
+        else:
+            # sample negative features
+            idx = self.multinomial.draw(bsz * (self.K + 1)).view(bsz, -1)
+            idx.select(1, 0).copy_(y.data)
+            w = self._get_weights(idx.view(-1))
+            w = w.view(bsz, self.K + 1, n_dim)
+
+            # compute logits
+            logits = self._compute_logit(x, w)
+            if x_jig is not None:
+                logits_jig = self._compute_logit(x_jig, w)
 
         # set label
-        labels = torch.zeros(bsz, dtype=torch.long).cuda()
+        labels = torch.zeros(bsz, dtype=torch.long, device=x.device)
 
         # update memory
         if (all_x is not None) and (all_y is not None):
@@ -92,3 +154,53 @@ class RGBMem(BaseMem):
             return logits, logits_jig, labels
         else:
             return logits, labels
+
+
+class ShardedRGBMem(RGBMem):
+    """
+    Memory bank for single modality sharded by index range across the processes. Rank r stores the entries
+    [r * shard_size, (r + 1) * shard_size), so the memory per process scales as 1 / world_size. The negatives are
+    fetched collectively and every process updates its own shard from the features gathered across the processes.
+    """
+    def __init__(self, n_dim, n_data, K=65536, T=0.07, m=0.5, shared_negatives=False):
+        super(RGBMem, self).__init__(K, T, m)
+        self.n_data = n_data
+        self.shared_negatives = shared_negatives
+        self.shard_size = (n_data + get_world_size() - 1) // get_world_size()
+        self.start = min(get_rank() * self.shard_size, n_data)
+        self.end = min(self.start + self.shard_size, n_data)
+        # create sampler over the complete memory bank
+        self.multinomial = build_sampler(torch.ones(n_data))
+
+        # create the local shard of the memory bank
+        self.register_buffer('memory', torch.randn(self.end - self.start, n_dim))
+        self.memory = F.normalize(self.memory)
+
+    def broadcast(self):
+        # each process owns a different shard, nothing to synchronize
+        pass
+
+    def _get_weights(self, idx):
+        """
+        Args:
+          idx: flat index of the memory entries to fetch, must be called by all processes at the same time
+        """
+        # every process requests its unique entries from their owners, the rows of an owner are consecutive
+        # (requested is sorted and the shards are index ranges)
+        requested, inverse = torch.unique(idx, return_inverse=True)
+        send_counts = torch.bincount(requested // self.shard_size, minlength=get_world_size()).tolist()
+        served, recv_counts = all_to_all_tensor(requested, send_counts)
+        # every owner sends the requested rows of its shard back, each row crosses the wire once
+        w, _ = all_to_all_tensor(torch.index_select(self.memory, 0, served - self.start), recv_counts, send_counts)
+        return torch.index_select(w, 0, inverse)
+
+    def _update_memory(self, memory, x, y):
+        """
+        Args:
+          memory: local shard of the memory buffer
+          x: features gathered across processes
+          y: index of updating position gathered across processes
+        """
+        local = (y >= self.start) & (y < self.end)
+        if local.any():
+            super(ShardedRGBMem, self)._update_memory(memory, x[local], y[local] - self.start)
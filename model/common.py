@@ -1,4 +1,6 @@
 import sys
+import torch
+from utils.checkpoint import load_checkpoint_state_dict
 
 
 class Model:
@@ -37,3 +39,25 @@ class Model:
         This function returns the selected model
         """
         return self.model
+
+
+def load_model_from_checkpoint(config, checkpoints_path, device="cpu"):
+    """
+    The function creates the model of the configuration with the weights of a checkpoint. The model skeleton is
+    built on the meta device, i.e. without allocating, initializing or downloading any weights, and the memory-mapped
+    checkpoint tensors are assigned to the parameters instead of being copied (see load_checkpoint_state_dict()).
+
+    :param config: Configuration class object
+    :param checkpoints_path: The path to the model checkpoints (.pth or flat .safetensors checkpoint)
+    :param device: The computation device
+    """
+    state_dict = load_checkpoint_state_dict(checkpoints_path)
+    pretrained = config.cfg["model"]["pretrained"]
+    config.cfg["model"]["pretrained"] = False  # The weights come from the checkpoint
+    try:
+        with torch.device("meta"):
+            model = Model(config=config).get_model()
+    finally:
+        config.cfg["model"]["pretrained"] = pretrained
+    model.load_state_dict(state_dict, strict=True, assign=True)
+    return model.to(device)
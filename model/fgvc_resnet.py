@@ -1,6 +1,8 @@
 import torch.nn as nn
+import torch.nn.functional as F
 from layers.diversification_block import DiversificationBlock
 from utils.util import get_object_from_path
+from utils.weight_registry import build_pretrained_model, get_weight_registry
 
 
 class FGVCResnet(nn.Module):
@@ -24,25 +26,31 @@ class FGVCResnet(nn.Module):
         self.alpha = config.cfg["diversification_block"]["alpha"]  # Suppression factor
         self.p_peak = config.cfg["diversification_block"]["p_peak"]  # Probability for peak selection
         self.p_patch = config.cfg["diversification_block"]["p_patch"]  # Probability for patch selection
-        self.cam = CAM(self.model_function, self.num_classes, self.pretrained)  # Initialize the CAM module
+        # Initialize the CAM module
+        self.cam = CAM(self.model_function, self.num_classes, self.pretrained, get_weight_registry(config))
         # Initialize the diversification block (DB) module
         self.diversification_block = DiversificationBlock(self.kernel_size, self.alpha, self.p_peak, self.p_patch)
 
-    def forward(self, x, train=False):
+    def forward(self, x, train=False, return_cams=False):
         """
         The function implements the forward pass of the model.
 
         :param x: Input image tensor
         :param train: Flag to specify either train or test mode
+        :param return_cams: Flag to return the CAMs along with the class scores in test mode, the features are pooled
+        before the classifier (no CAMs are computed) otherwise
         """
-        out = self.cam(x)  # Calculate the CAMs
+        if not train and not return_cams:
+            return self.cam.pooled_forward(x)  # Inference fast path
+        cams = self.cam(x)  # Calculate the CAMs
+        out = cams
         if train:
             # Diversification block is only used during training
             out = self.diversification_block(out)
         # Apply global average pooling to calculate the class probabilities
         out = out.mean([2, 3])
 
-        return out
+        return (out, cams) if return_cams and not train else out
 
 
 class CAM(nn.Module):
@@ -51,18 +59,20 @@ class CAM(nn.Module):
     "Fine-grained Recognition: Accounting for Subtle Differences between Similar Classes".
     (http://arxiv.org/abs/1912.06842).
     """
-    def __init__(self, model_function, num_classes, pretrained=True):
+    def __init__(self, model_function, num_classes, pretrained=True, registry=None):
         """
         Constructor, the function initializes the model as per the provided parameters.
 
         :param model_function: The backbone path to use for the model (e.g. torchvision.models.resnet50)
         :param num_classes: Number of classes for the classification head
         :param pretrained: Either to load weights from torchvision ImageNet pretrained model or not
+        :param registry: The weight registry of the pretrained weights (see utils/weight_registry.py), the torchvision
+        weights are downloaded if None
         """
         # Call the parent constructor
         super(CAM, self).__init__()
         # Load the specified model
-        net = model_function(pretrained=pretrained)
+        net = build_pretrained_model(model_function, pretrained, registry)
         net_list = list(net.children())
         # Separate out the feature extractor
         self.feature_extractor = nn.Sequential(*net_list[:-2])
@@ -80,3 +90,14 @@ class CAM(nn.Module):
         cams = self.conv(feature_map)  # Get CAMs
 
         return cams
+
+    def pooled_forward(self, x):
+        """
+        The function computes the class scores of the CAMs averaged over the spatial dimensions without computing the
+        CAMs, i.e. the features are averaged first and the 1 x 1 convolution is applied as a linear layer
+        (mean(conv(f)) == linear(mean(f))).
+
+        :param x: Input image tensor
+        """
+        features = self.feature_extractor(x).mean([2, 3])  # Extract and pool the features
+        return F.linear(features, self.conv.weight.flatten(1), self.conv.bias)
@@ -1,5 +1,6 @@
 import torch.nn as nn
 from utils.util import get_object_from_path
+from utils.weight_registry import get_weight_registry
 from model.fgvc_resnet import CAM
 from layers.diversification_block import DiversificationBlock
 
@@ -27,21 +28,27 @@ class FGVCSSLRotation(nn.Module):
         self.p_peak = config.cfg["diversification_block"]["p_peak"]  # Probability for peak selection
         self.p_patch = config.cfg["diversification_block"]["p_patch"]  # Probability for peak selection
         # Load the model
-        self.cam = CAM(self.model_function, self.num_classes_classification, self.pretrained)
+        self.cam = CAM(self.model_function, self.num_classes_classification, self.pretrained,
+                       get_weight_registry(config))
         self.adaptive_pooling = nn.AdaptiveAvgPool2d(3)  # Adaptive average pooling for classification prediction
         self.flatten = nn.Flatten()  # Flatten the features
         # Adds a classification head for rotation prediction
         self.rotation_head = nn.Linear(self.num_classes_classification * 3 * 3, self.num_classes_rot)
         self.diversification_block = DiversificationBlock(self.kernel_size, self.alpha, self.p_peak, self.p_patch)
 
-    def forward(self, x, train=False):
+    def forward(self, x, train=False, return_cams=False):
         """
         The function implements the forward pass of the model.
 
         :param x: Input image tensor
         :param train: Flag to specify either train or test mode
+        :param return_cams: Flag to return the CAMs along with the class scores in test mode, the features are pooled
+        before the classifier (no CAMs are computed) otherwise
         """
-        out = self.cam(x)  # Calculate the CAMs
+        if not train and not return_cams:
+            return self.cam.pooled_forward(x)  # Inference fast path
+        cams = self.cam(x)  # Calculate the CAMs
+        out = cams
         if train:
             # Diversification block is only used during training
             out = self.diversification_block(out)
@@ -53,4 +60,4 @@ class FGVCSSLRotation(nn.Module):
             y_rotation = self.rotation_head(out)  # Classification head predicts rotation augmentation applied
             return y_classification, y_rotation
         else:
-            return y_classification
+            return (y_classification, cams) if return_cams else y_classification
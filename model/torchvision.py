@@ -1,5 +1,6 @@
 import torch.nn as nn
 from utils.util import get_object_from_path
+from utils.weight_registry import build_pretrained_model, get_weight_registry
 
 
 class TorchVision(nn.Module):
@@ -19,7 +20,7 @@ class TorchVision(nn.Module):
         self.pretrained = config.cfg["model"]["pretrained"]  # Either to load weights from pretrained model or not
         self.num_classes = config.cfg["model"]["classes_count"]  # Number of classes
         # Load the model
-        self.model = self.model_function(pretrained=self.pretrained)
+        self.model = build_pretrained_model(self.model_function, self.pretrained, get_weight_registry(config))
         # Alter the classification layer as per the specified number of classes
         self.model.fc = nn.Linear(in_features=self.model.fc.in_features, out_features=self.num_classes,
                                   bias=(self.model.fc.bias is not None))
@@ -4,6 +4,7 @@ Credits: This implementation is inspired from https://github.com/JDAI-CV/DCL
 
 import torch.nn as nn
 from utils.util import get_object_from_path
+from utils.weight_registry import build_pretrained_model, get_weight_registry
 
 
 class TorchVisionSSLDCL(nn.Module):
@@ -25,7 +26,7 @@ class TorchVisionSSLDCL(nn.Module):
         jigsaw_size = config.cfg["dataloader"]["transforms"]["jigsaw"]["t_1"]["param"]["size"]  # Jigsaw patch size
         self.jigsaw_class = jigsaw_size[0] * jigsaw_size[1]
         # Load the model
-        net = self.model_function(pretrained=self.pretrained)
+        net = build_pretrained_model(self.model_function, self.pretrained, get_weight_registry(config))
         net_list = list(net.children())
         self.feature_extractor = nn.Sequential(*net_list[:-2])  # Feature extractor
         self.avg_pool = nn.AdaptiveAvgPool2d(output_size=1)  # Adaptive average pooling
@@ -40,9 +41,11 @@ class TorchVisionSSLDCL(nn.Module):
                                    padding=0, bias=True)
         self.conv_mask_cls = nn.Conv2d(in_channels=net.fc.in_features, out_channels=self.jigsaw_class, kernel_size=1,
                                        stride=1, padding=0, bias=True)
-        self.avg_pool_1 = nn.AvgPool2d(2, stride=2)
-        # Jigsaw permutation prediction head for 7*7 patches
-        self.jigsaw_cls_classifier = nn.Linear(in_features=49, out_features=self.jigsaw_class, bias=True)
+        # Pool the mask to the jigsaw grid (e.g. 7*7 for 448px images), independently of the image resolution
+        self.avg_pool_1 = nn.AdaptiveAvgPool2d(output_size=tuple(jigsaw_size))
+        # Jigsaw permutation prediction head for the jigsaw grid patches
+        self.jigsaw_cls_classifier = nn.Linear(in_features=self.jigsaw_class, out_features=self.jigsaw_class,
+                                               bias=True)
         self.flatten = nn.Flatten()  # Flatten layer
         self.tan_h = nn.Tanh()  # Tanh activation
         self.relu = nn.ReLU()  # ReLU activation
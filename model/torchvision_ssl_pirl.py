@@ -6,6 +6,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from utils.util import get_object_from_path
+from utils.weight_registry import build_pretrained_model, get_weight_registry
 
 
 class Normalize(nn.Module):
@@ -42,7 +43,7 @@ class JigsawHead(nn.Module):
         x = self.fc1(x)
         # ==== shuffle ====
         # This step can be moved to data processing step
-        shuffle_ids = self.get_shuffle_ids(bsz)
+        shuffle_ids = self.get_shuffle_ids(bsz, x.device)
         x = x[shuffle_ids]
         # ==== shuffle ====
         n_img = int(bsz / self.k)
@@ -51,14 +52,12 @@ class JigsawHead(nn.Module):
         x = self.l2norm(x)
         return x
 
-    def get_shuffle_ids(self, bsz):
+    def get_shuffle_ids(self, bsz, device=None):
         n_img = int(bsz / self.k)
-        rnd_ids = [torch.randperm(self.k) for i in range(n_img)]
-        rnd_ids = torch.cat(rnd_ids, dim=0)
-        base_ids = torch.arange(bsz)
-        base_ids = torch.div(base_ids, self.k).long()
-        base_ids = base_ids * self.k
-        shuffle_ids = rnd_ids + base_ids
+        # A random permutation of the k crops of each image, drawn at once
+        rnd_ids = torch.rand(n_img, self.k, device=device).argsort(dim=1)
+        base_ids = torch.arange(n_img, device=device).unsqueeze(1) * self.k
+        shuffle_ids = (rnd_ids + base_ids).view(-1)
         return shuffle_ids
 
 
@@ -78,8 +77,10 @@ class TorchVisionSSLPIRL(nn.Module):
         self.model_function = get_object_from_path(config.cfg["model"]["model_function_path"])  # Model type
         self.pretrained = config.cfg["model"]["pretrained"]  # Either to load weights from pretrained model or not
         self.num_classes = config.cfg["model"]["classes_count"]  # Number of classes
+        # Either to run the backbone once on the original and jigsaw images (if they have the same size) or not
+        self.fused_backbone = config.cfg["model"].get("fused_backbone", False)
         # Load the model
-        net = self.model_function(pretrained=self.pretrained)
+        net = build_pretrained_model(self.model_function, self.pretrained, get_weight_registry(config))
         net_list = list(net.children())
         self.feature_extractor = nn.Sequential(*net_list[:-1])  # Feature extractor
         # Flatten layer
@@ -102,13 +103,18 @@ class TorchVisionSSLPIRL(nn.Module):
         The function implements the forward pass of the model.
 
         :param x: Input image tensor
+        :param x_jig: Jigsaw crops tensor (4 crops per image), only used in train mode
         :param train: Flag to specify either train or test mode
         """
-        feat = self.flatten(self.feature_extractor(x))  # Feature extraction
+        if train and self.fused_backbone and x.shape[1:] == x_jig.shape[1:]:
+            # Single backbone pass over the concatenated original and jigsaw images, the features are split afterwards
+            feat, feat_jig = self.flatten(self.feature_extractor(torch.cat([x, x_jig]))).split([len(x), len(x_jig)])
+        else:
+            feat = self.flatten(self.feature_extractor(x))  # Feature extraction
+            feat_jig = self.flatten(self.feature_extractor(x_jig)) if train else None
         classification_scores = self.cls_classifier(feat)  # Classification head
         if train:
             # Get the PIRL twin configurations if train
-            feat_jig = self.flatten(self.feature_extractor(x_jig))
             representation = self.head(feat)
             representation_jig = self.hed_jig(feat_jig)
             return classification_scores, representation, representation_jig
@@ -1,5 +1,6 @@
 import torch.nn as nn
 from utils.util import get_object_from_path
+from utils.weight_registry import build_pretrained_model, get_weight_registry
 
 
 class TorchvisionSSLRotation(nn.Module):
@@ -20,7 +21,7 @@ class TorchvisionSSLRotation(nn.Module):
         self.num_classes_classification = config.cfg["model"]["classes_count"]  # No. of classes for classification
         self.num_classes_rot = config.cfg["model"]["rotation_classes_count"]  # No. of classes for rotation head
         # Load the model
-        self.model = self.model_function(pretrained=self.pretrained)
+        self.model = build_pretrained_model(self.model_function, self.pretrained, get_weight_registry(config))
         net_list = list(self.model.children())
         self.feature_extractor = nn.Sequential(*net_list[:-1])  # Feature extractor
         self.flatten = nn.Flatten()  # Flatten layer
@@ -0,0 +1,126 @@
+import sys
+import os
+import time
+import argparse
+import torch
+
+# Add the root folder (ssl_for_fgvc) as the path
+sys.path.append(f"{'/'.join(os.getcwd().split('/')[:-1])}")
+from memory.alias_multinomial import AliasMethod, UniformSampler
+
+
+def parse_arguments():
+    """
+    Parse the command line arguments
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-d", "--device", required=False, default='cuda',
+                    help="The computation device to perform operations ('cpu', 'cuda')")
+    ap.add_argument("-sizes", "--sizes", required=False, type=int, nargs="+",
+                    default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7],
+                    help="The numbers of entries of the sampled memory banks.")
+    ap.add_argument("-reference_max", "--reference_max_size", required=False, type=int, default=10 ** 5,
+                    help="The largest size whose tables are also built with the python loop reference (slow).")
+    ap.add_argument("-b", "--batch_size", required=False, type=int, default=32,
+                    help="The batch size, bsz * (K + 1) negatives are drawn per step.")
+    ap.add_argument("-k", "--negatives", required=False, type=int, default=2048,
+                    help="Number of the negatives per sample (K).")
+    ap.add_argument("-steps", "--steps", required=False, type=int, default=50,
+                    help="Number of the timed draws per sampler and size.")
+
+    args = vars(ap.parse_args())
+
+    return args
+
+
+def reference_alias_tables(probs):
+    """
+    The python loop implementation of AliasMethod.__init__(), used as reference.
+    """
+    K = len(probs)
+    prob = probs * K / probs.sum()
+    alias = torch.LongTensor([0] * K)
+    smaller, larger = [], []
+    for kk in range(K):
+        if prob[kk] < 1.0:
+            smaller.append(kk)
+        else:
+            larger.append(kk)
+    while len(smaller) > 0 and len(larger) > 0:
+        small = smaller.pop()
+        large = larger.pop()
+        alias[small] = large
+        prob[large] = (prob[large] - 1.0) + prob[small]
+        if prob[large] < 1.0:
+            smaller.append(large)
+        else:
+            larger.append(large)
+    for last_one in smaller + larger:
+        prob[last_one] = 1
+    return prob, alias
+
+
+def get_table_error(prob, alias, probs):
+    """
+    The function returns the largest difference between the probabilities sampled by alias tables and the target
+    probabilities.
+    """
+    sampled = prob.double().clone().index_add_(0, alias, 1 - prob.double()) / len(prob)
+    return float((sampled - probs.double() / probs.sum()).abs().max())
+
+
+def time_function(function, device, steps):
+    """
+    The function returns the mean time in milliseconds of a call of the function.
+
+    :param function: The function to time
+    :param device: The computation device
+    :param steps: Number of the timed calls (one more untimed call is run first)
+    """
+    for step in range(steps + 1):
+        if step == 1:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        function()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def main():
+    """
+    Implements the main flow, i.e. report the alias tables construction time (python loop reference and vectorized)
+    with the error of the tables, and the time of the negatives draws with and without the alias tables, at the
+    memory bank sizes.
+    """
+    args = parse_arguments()  # Parse arguments
+    device = args["device"]
+    count = args["batch_size"] * (args["negatives"] + 1)
+    print(f"Draws of {count} negatives ({args['batch_size']} x {args['negatives'] + 1}), device: {device}")
+    for size in args["sizes"]:
+        probs = torch.rand(size) ** 2  # Non uniform probabilities for the construction
+        start = time.perf_counter()
+        sampler = AliasMethod(probs)
+        vectorized_time = time.perf_counter() - start
+        message = f"{size} entries, tables: vectorized {vectorized_time * 1000:.1f} ms (error " \
+                  f"{get_table_error(sampler.prob, sampler.alias, probs):.1e})"
+        if size <= args["reference_max_size"]:
+            start = time.perf_counter()
+            prob, alias = reference_alias_tables(probs.clone())
+            reference_time = time.perf_counter() - start
+            message += f", python loop {reference_time * 1000:.1f} ms (error {get_table_error(prob, alias, probs):.1e}" \
+                       f", {reference_time / vectorized_time:.0f}x)"
+        print(message)
+        # The memory bank samples uniformly
+        alias_sampler, uniform_sampler = AliasMethod(torch.ones(size)), UniformSampler(size)
+        alias_sampler.to(device)
+        uniform_sampler.to(device)
+        alias_time = time_function(lambda: alias_sampler.draw(count), device, args["steps"])
+        uniform_time = time_function(lambda: uniform_sampler.draw(count), device, args["steps"])
+        print(f"{size} entries, uniform draws: alias tables {alias_time:.3f} ms, uniform sampler {uniform_time:.3f} ms "
+              f"({alias_time / uniform_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
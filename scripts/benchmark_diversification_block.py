@@ -0,0 +1,113 @@
+import sys
+import os
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+
+# Add the root folder (ssl_for_fgvc) as the path
+sys.path.append(f"{'/'.join(os.getcwd().split('/')[:-1])}")
+from layers.diversification_block import DiversificationBlock
+
+
+def parse_arguments():
+    """
+    Parse the command line arguments
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-d", "--device", required=False, default='cuda',
+                    help="The computation device to perform operations ('cpu', 'cuda')")
+    ap.add_argument("-b", "--batch_size", required=False, type=int, default=8,
+                    help="The batch size.")
+    ap.add_argument("-c", "--classes_count", required=False, type=int, default=200,
+                    help="Number of classes, i.e. of CAMs per image.")
+    ap.add_argument("-sizes", "--sizes", required=False, type=int, nargs="+", default=[14, 28, 56],
+                    help="The CAMs sizes (14 for 448px inputs of a ResNet-50).")
+    ap.add_argument("-k", "--kernel_size", required=False, type=int, default=3,
+                    help="The patch size of the patch suppression.")
+    ap.add_argument("-steps", "--steps", required=False, type=int, default=20,
+                    help="Number of the timed forward and backward passes per implementation and size.")
+
+    args = vars(ap.parse_args())
+
+    return args
+
+
+def reference_forward(block, activation):
+    """
+    The per sample fold implementation of DiversificationBlock.forward(), used as reference.
+    """
+    peak = torch.max(torch.max(activation, 3).values, 2).values
+    rc = torch.bernoulli(torch.mul(torch.ones(activation.size(), device=activation.device),
+                                   torch.tensor(block.p_peak)))
+    b, c, m, n = activation.shape
+    pc = torch.zeros_like(activation)
+    pc[activation == torch.unsqueeze(torch.unsqueeze(peak, 2), 3)] = 1
+    bc_dash = torch.mul(rc, pc)
+    stride = block.kernel_size
+    patches = activation.unfold(2, block.kernel_size, stride).unfold(3, block.kernel_size, stride)
+    l, k = patches.shape[2], patches.shape[3]
+    p_patch = torch.bernoulli(torch.mul(torch.ones(patches.size()[:-2], device=activation.device),
+                                        torch.tensor(block.p_patch)))
+    bc_dd = torch.zeros_like(patches)
+    bc_dd[p_patch == 1] = 1
+    bc_dd = (bc_dd.reshape(b, c, l, k, block.kernel_size * block.kernel_size)).permute(0, 1, 4, 2, 3)
+    bc_dd = bc_dd.reshape(b, c, block.kernel_size * block.kernel_size, -1)
+    bc_dd_batch = torch.zeros_like(activation)
+    for i in range(b):
+        bc_dd_batch[i] = F.fold(bc_dd[i], (m, n), kernel_size=block.kernel_size, stride=stride).squeeze(1)
+    bc_dd_batch[activation == torch.unsqueeze(torch.unsqueeze(peak, 2), 3)] = 0
+    bc = bc_dash + bc_dd_batch
+    activation[bc >= 1] *= block.alpha
+    return activation
+
+
+def get_suppression_rates(forward, block, activation):
+    """
+    The function returns the fraction of the suppressed peaks and of the suppressed other locations.
+    """
+    with torch.no_grad():
+        suppressed = forward(block, activation.clone()) != activation
+    is_peak = activation == activation.amax(dim=(2, 3), keepdim=True)
+    return suppressed[is_peak].float().mean().item(), suppressed[~is_peak].float().mean().item()
+
+
+def time_forward_backward(forward, block, activation, device, steps):
+    """
+    The function returns the mean time in milliseconds of a forward and backward pass through the block.
+    """
+    for step in range(steps + 1):
+        if step == 1:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        x = activation * 1  # Non leaf input, as the CAMs of the model
+        forward(block, x).sum().backward()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def main():
+    """
+    Implements the main flow, i.e. report the time and the suppression rates of the reference and of the vectorized
+    diversification block at the CAMs sizes.
+    """
+    args = parse_arguments()  # Parse arguments
+    device = args["device"]
+    block = DiversificationBlock(args["kernel_size"], alpha=0.1, p_peak=0.5, p_patch=0.5)
+    implementations = {"reference": reference_forward, "vectorized": lambda b, x: b(x)}
+    for size in args["sizes"]:
+        activation = torch.randn(args["batch_size"], args["classes_count"], size, size, device=device,
+                                 requires_grad=True)
+        times = {}
+        for name, forward in implementations.items():
+            times[name] = time_forward_backward(forward, block, activation, device, args["steps"])
+            peak_rate, patch_rate = get_suppression_rates(forward, block, activation.detach())
+            print(f"CAMs {tuple(activation.shape)}, {name}: {times[name]:.2f} ms, suppressed peaks: "
+                  f"{peak_rate:.3f}, suppressed other locations: {patch_rate:.3f}")
+        print(f"CAMs {tuple(activation.shape)}, speedup: {times['reference'] / times['vectorized']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import sys
+import os
+import time
+import argparse
+import torch
+
+# Add the root folder (ssl_for_fgvc) as the path
+sys.path.append(f"{'/'.join(os.getcwd().split('/')[:-1])}")
+from config.config import Configuration as config
+from model.common import Model
+from train.freeze import BACKBONE_STAGES, set_frozen_stages
+from train.optimizer import build_optimizer
+
+
+def parse_arguments():
+    """
+    Parse the command line arguments
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-config", "--config_path", required=True,
+                    help="The path to the pipeline .yml configuration file.")
+    ap.add_argument("-d", "--device", required=False, default='cuda',
+                    help="The computation device to perform operations ('cpu', 'cuda')")
+    ap.add_argument("-b", "--batch_size", required=False, type=int, default=None,
+                    help="The batch size (the batch size of the configuration by default).")
+    ap.add_argument("-steps", "--steps", required=False, type=int, default=10,
+                    help="Number of the timed training steps per frozen stages configuration.")
+
+    args = vars(ap.parse_args())
+
+    return args
+
+
+def time_training_step(model, optimizer, inputs, labels, device, steps):
+    """
+    The function returns the mean time in milliseconds of a training step (forward, backward and optimizer step) of
+    the classification output of the model.
+
+    :param model: The model
+    :param optimizer: The optimizer
+    :param inputs: The input batch
+    :param labels: The labels of the input batch
+    :param device: The computation device
+    :param steps: Number of the timed steps (one more untimed step is run first)
+    """
+    loss_function = torch.nn.CrossEntropyLoss()
+    for step in range(steps + 1):
+        if step == 1:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        outputs = model(inputs, train=False)  # The classification scores of all the models
+        loss = loss_function(outputs, labels)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def main():
+    """
+    Implements the main flow, i.e. create the model of the configuration and report the training step time with
+    the backbone frozen up to each stage (see train.freeze_schedule).
+    """
+    args = parse_arguments()  # Parse arguments
+    config.load_config(args["config_path"])  # Load the configuration
+    config.cfg["model"]["pretrained"] = False  # The weights do not matter
+    model = Model(config=config).get_model().to(args["device"]).train()
+    optimizer = build_optimizer(model, config.cfg["train"]["optimizer_path"], config.cfg["train"]["optimizer_param"])
+    batch_size = args["batch_size"] or config.cfg["dataloader"]["batch_size"]
+    size = config.cfg["dataloader"]["transforms"]["train"]["t_1"]["param"]["size"]
+    size = (size, size) if isinstance(size, int) else tuple(size)
+    inputs = torch.randn(batch_size, 3, *size, device=args["device"])
+    labels = torch.randint(config.cfg["model"]["classes_count"], (batch_size,), device=args["device"])
+    print(f"Model: {config.cfg['model']['name']} ({config.cfg['model']['model_function_path']}), "
+          f"input: {tuple(inputs.shape)}, device: {args['device']}")
+    baseline = None
+    for i in range(len(BACKBONE_STAGES) + 1):
+        stages = BACKBONE_STAGES[:i]
+        set_frozen_stages(model, stages, optimizer)
+        step_time = time_training_step(model, optimizer, inputs, labels, args["device"], args["steps"])
+        baseline = baseline or step_time
+        print(f"Frozen stages: {', '.join(stages) if stages else 'none'}: {step_time:.1f} ms/step "
+              f"({(1 - step_time / baseline) * 100:.1f}% saving)")
+
+
+if __name__ == "__main__":
+    main()
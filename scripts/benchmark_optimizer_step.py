@@ -0,0 +1,98 @@
+import sys
+import os
+import time
+import argparse
+import torch
+
+# Add the root folder (ssl_for_fgvc) as the path
+sys.path.append(f"{'/'.join(os.getcwd().split('/')[:-1])}")
+from config.config import Configuration as config
+from model.common import Model
+from train.optimizer import build_optimizer, DCL_LR_MULTIPLIERS
+from utils.util import get_object_from_path
+
+
+def parse_arguments():
+    """
+    Parse the command line arguments
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-config", "--config_path", required=True,
+                    help="The path to the pipeline .yml configuration file.")
+    ap.add_argument("-d", "--device", required=False, default='cuda',
+                    help="The computation device to perform operations ('cpu', 'cuda')")
+    ap.add_argument("-steps", "--steps", required=False, type=int, default=50,
+                    help="Number of the timed optimizer steps.")
+    ap.add_argument("-warmup", "--warmup_steps", required=False, type=int, default=5,
+                    help="Number of the optimizer steps run before the timing.")
+
+    args = vars(ap.parse_args())
+
+    return args
+
+
+def get_per_parameter_optimizer(model, optimizer_path, optimizer_param):
+    """
+    The function creates the optimizer as before the semantic parameter groups, i.e. one parameter group per tensor.
+
+    :param model: The model to train
+    :param optimizer_path: Complete optimizer class path (e.g. torch.optim.SGD)
+    :param optimizer_param: Optimizer parameters from the configuration
+    """
+    params = [{'params': [value]} for value in model.parameters() if value.requires_grad]
+    return get_object_from_path(optimizer_path)(params=params, lr=optimizer_param["lr"],
+                                                momentum=optimizer_param["momentum"],
+                                                weight_decay=optimizer_param["weight_decay"])
+
+
+def time_optimizer_step(optimizer, model, device, steps, warmup_steps):
+    """
+    The function returns the mean optimizer step time in milliseconds. The gradients are random and kept constant,
+    only optimizer.step() is timed.
+
+    :param optimizer: The optimizer
+    :param model: The model whose parameters are optimized
+    :param device: The computation device
+    :param steps: Number of the timed steps
+    :param warmup_steps: Number of the steps run before the timing (e.g. to create the momentum buffers)
+    """
+    for param in model.parameters():
+        param.grad = torch.randn_like(param) if param.requires_grad else None
+    for _ in range(warmup_steps):
+        optimizer.step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        optimizer.step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def main():
+    """
+    Implements the main flow, i.e. create the model of the configuration and time the optimizer step with the
+    per-tensor parameter groups and with the semantic parameter groups of each optimizer implementation.
+    """
+    args = parse_arguments()  # Parse arguments
+    config.load_config(args["config_path"])  # Load the configuration
+    config.cfg["model"]["pretrained"] = False  # The weights do not matter
+    model = Model(config=config).get_model().to(args["device"])
+    optimizer_path = config.cfg["train"]["optimizer_path"]
+    optimizer_param = config.cfg["train"]["optimizer_param"]
+    lr_multipliers = DCL_LR_MULTIPLIERS if config.cfg["model"]["name"] == "dcl" else None
+    optimizers = {"per-tensor groups": get_per_parameter_optimizer(model, optimizer_path, optimizer_param)}
+    for implementation in ["for_loop", "foreach", "fused"]:
+        optimizer_param = dict(optimizer_param, implementation=implementation)
+        optimizers[f"semantic groups, {implementation}"] = build_optimizer(model, optimizer_path, optimizer_param,
+                                                                           lr_multipliers)
+    print(f"Model: {config.cfg['model']['name']} ({config.cfg['model']['model_function_path']}), "
+          f"{sum(1 for p in model.parameters() if p.requires_grad)} trainable tensors, device: {args['device']}")
+    for name, optimizer in optimizers.items():
+        step_time = time_optimizer_step(optimizer, model, args["device"], args["steps"], args["warmup_steps"])
+        print(f"{name}: {len(optimizer.param_groups)} parameter groups, {step_time:.2f} ms/step")
+
+
+if __name__ == "__main__":
+    main()
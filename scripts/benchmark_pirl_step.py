@@ -0,0 +1,146 @@
+import sys
+import os
+import time
+import argparse
+import torch
+
+# Add the root folder (ssl_for_fgvc) as the path
+sys.path.append(f"{'/'.join(os.getcwd().split('/')[:-1])}")
+from config.config import Configuration as config
+from model.common import Model
+from memory.mem_bank import RGBMem
+from train.optimizer import build_optimizer
+
+
+def parse_arguments():
+    """
+    Parse the command line arguments
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-config", "--config_path", required=True,
+                    help="The path to the PIRL pipeline .yml configuration file.")
+    ap.add_argument("-d", "--device", required=False, default='cuda',
+                    help="The computation device to perform operations ('cpu', 'cuda')")
+    ap.add_argument("-b", "--batch_size", required=False, type=int, default=None,
+                    help="The batch size (the batch size of the configuration by default).")
+    ap.add_argument("-size", "--size", required=False, type=int, default=None,
+                    help="The size of the original images (the train crop size of the configuration by default), the "
+                         "fused backbone pass requires the size of the jigsaw crops.")
+    ap.add_argument("-jigsaw_size", "--jigsaw_size", required=False, type=int, default=256,
+                    help="The size of the jigsaw crops (256 with transforms.pirl.JigsawTransform).")
+    ap.add_argument("-n_data", "--n_data", required=False, type=int, default=5994,
+                    help="The number of entries of the memory bank timed alone (5994 CUB train images by default).")
+    ap.add_argument("-steps", "--steps", required=False, type=int, default=10,
+                    help="Number of the timed training steps per configuration.")
+
+    args = vars(ap.parse_args())
+
+    return args
+
+
+def get_shuffle_ids_loop(bsz, k=4):
+    """
+    The per image randperm implementation of JigsawHead.get_shuffle_ids(), used as reference.
+    """
+    n_img = int(bsz / k)
+    rnd_ids = torch.cat([torch.randperm(k) for i in range(n_img)], dim=0)
+    base_ids = torch.div(torch.arange(bsz), k).long() * k
+    return rnd_ids + base_ids
+
+
+def time_function(function, device, steps):
+    """
+    The function returns the mean time in milliseconds of a call of the function.
+
+    :param function: The function to time
+    :param device: The computation device
+    :param steps: Number of the timed calls (one more untimed call is run first)
+    """
+    for step in range(steps + 1):
+        if step == 1:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        function()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def time_memory_bank(shared_negatives, batch_size, n_data, device, steps):
+    """
+    The function returns the mean time in milliseconds of the memory bank logits, loss and backward pass of a PIRL
+    training step.
+
+    :param shared_negatives: Either the batch shares the negatives or every sample draws its own negatives
+    :param batch_size: The batch size
+    :param n_data: Number of the entries of the memory bank
+    :param device: The computation device
+    :param steps: Number of the timed steps
+    """
+    memory = RGBMem(n_dim=128, n_data=n_data, K=2048, shared_negatives=shared_negatives).to(device)
+    representation = torch.randn(batch_size, 128, device=device, requires_grad=True)
+    representation_jig = torch.randn(batch_size, 128, device=device, requires_grad=True)
+    index = torch.randperm(n_data, device=device)[:batch_size]
+
+    def memory_step():
+        logits, logits_jig, target = memory(representation, index, representation_jig)
+        loss = torch.nn.functional.cross_entropy(logits, target) + torch.nn.functional.cross_entropy(logits_jig, target)
+        loss.backward()
+
+    return time_function(memory_step, device, steps)
+
+
+def main():
+    """
+    Implements the main flow, i.e. create the PIRL model of the configuration and report the time of the shuffle ids
+    generation, of the memory bank with independent and shared negatives, and of a PIRL training step with the two
+    backbone passes and with the fused backbone pass.
+    """
+    args = parse_arguments()  # Parse arguments
+    config.load_config(args["config_path"])  # Load the configuration
+    config.cfg["model"]["pretrained"] = False  # The weights do not matter
+    device = args["device"]
+    model = Model(config=config).get_model().to(device).train()
+    optimizer = build_optimizer(model, config.cfg["train"]["optimizer_path"], config.cfg["train"]["optimizer_param"])
+    loss_function = torch.nn.CrossEntropyLoss()
+    batch_size = args["batch_size"] or config.cfg["dataloader"]["batch_size"]
+    size = args["size"] or config.cfg["dataloader"]["transforms"]["train"]["t_1"]["param"]["size"]
+    memory = RGBMem(n_dim=128, n_data=batch_size, K=2048).to(device)
+    inputs = torch.randn(batch_size, 3, size, size, device=device)
+    inputs_jig = torch.randn(batch_size * 4, 3, args["jigsaw_size"], args["jigsaw_size"], device=device)
+    labels = torch.randint(config.cfg["model"]["classes_count"], (batch_size,), device=device)
+    index = torch.arange(batch_size, device=device)
+
+    def train_step():
+        classification_scores, representation, representation_jig = model(inputs, inputs_jig, train=True)
+        pirl_output = memory(representation, index, representation_jig)
+        pirl_losses = [loss_function(logit, pirl_output[-1]) for logit in pirl_output[:-1]]
+        loss = loss_function(classification_scores, labels) + 0.5 * pirl_losses[0] + 0.5 * pirl_losses[1]
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    print(f"Model: {config.cfg['model']['model_function_path']}, input: {tuple(inputs.shape)}, jigsaw input: "
+          f"{tuple(inputs_jig.shape)}, device: {device}")
+    loop_time = time_function(lambda: get_shuffle_ids_loop(batch_size * 4).to(device), device, 100)
+    vectorized_time = time_function(lambda: model.hed_jig.get_shuffle_ids(batch_size * 4, device), device, 100)
+    print(f"Shuffle ids: per image randperm {loop_time:.3f} ms, vectorized {vectorized_time:.3f} ms")
+    independent_time = time_memory_bank(False, batch_size, args["n_data"], device, 100)
+    shared_time = time_memory_bank(True, batch_size, args["n_data"], device, 100)
+    print(f"Memory bank ({args['n_data']} entries): independent negatives {independent_time:.3f} ms, shared "
+          f"negatives {shared_time:.3f} ms ({independent_time / shared_time:.1f}x)")
+    model.fused_backbone = False
+    separate_time = time_function(train_step, device, args["steps"])
+    print(f"Two backbone passes: {separate_time:.1f} ms/step")
+    if size != args["jigsaw_size"]:
+        print(f"The fused backbone pass requires original images of the jigsaw crops size, "
+              f"use --size {args['jigsaw_size']}")
+        return
+    model.fused_backbone = True
+    fused_time = time_function(train_step, device, args["steps"])
+    print(f"Fused backbone pass: {fused_time:.1f} ms/step ({(1 - fused_time / separate_time) * 100:.1f}% saving)")
+
+
+if __name__ == "__main__":
+    main()
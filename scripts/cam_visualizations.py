@@ -1,20 +1,48 @@
 import sys
 import os
+import time
 import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import torch
+import torch.nn.functional as F
 import numpy as np
 from PIL import Image
+from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
-from pytorch_grad_cam import GradCAM, ScoreCAM, GradCAMPlusPlus, AblationCAM, XGradCAM
-from pytorch_grad_cam.utils.image import show_cam_on_image
 
 # Add the root folder (ssl_for_fgvc) as the path
 sys.path.append(f"{'/'.join(os.getcwd().split('/')[:-1])}")
 from config.config import Configuration as config
 from dataloader.common import Dataloader
-from model.common import Model
+from model.common import load_model_from_checkpoint
 from utils.util import get_object_from_path
 
+# The models computing the class activation maps natively (model.fgvc_resnet.CAM), no gradients are required
+NATIVE_CAM_MODELS = ["fgvc_resnet", "fgvc_ssl_rotation"]
+
+
+class CAMOutputRecorder:
+    """
+    The class wraps the activations and gradients hooks of a grad-cam method and records the model output of the
+    forward pass computing the CAM, from which the predicted class is read instead of forwarding the model again.
+    """
+    def __init__(self, activations_and_grads):
+        """
+        Constructor, the function initializes the class variables.
+
+        :param activations_and_grads: The ActivationsAndGradients object of the grad-cam method
+        """
+        self.activations_and_grads = activations_and_grads
+        self.output = None  # The model output of the last forward pass
+
+    def __call__(self, x):
+        self.output = self.activations_and_grads(x)
+        return self.output
+
+    def __getattr__(self, name):
+        return getattr(self.activations_and_grads, name)
+
 
 class CAMVisualization:
     """
@@ -27,13 +55,15 @@ class CAMVisualization:
         :param model: Model to be used for the CAM visualization
         :param model_name: Model name (as per config.yml)
         :param cam_method: The method to be used for CAM calculation. Available options are
-        "GradCAM, ScoreCAM, GradCAMPlusPlus, AblationCAM, XGradCAM"
+        "GradCAM, ScoreCAM, GradCAMPlusPlus, AblationCAM, XGradCAM", ignored for the models computing the CAMs
+        natively (NATIVE_CAM_MODELS)
         """
         self.model = model.eval()  # Put the model in the evaluation mode
         self.model_name = model_name  # The model name (as per the config.yml)
         self.cam_method = cam_method  # The cam method
         self.target_layer = None  # The target layer used to calculate the CAM
         self.cam = None  # The calculated CAM
+        self.use_cuda = next(self.model.parameters()).is_cuda  # Either the GradCAM methods run on GPU or not
         self._set_target_layer()  # Set the target layer as per the specified model name
         self._set_cam()  # Set cam as per the specified cam method
 
@@ -41,6 +71,8 @@ class CAMVisualization:
         """
         The function selects the target layer as per the specified model name.
         """
+        if self.model_name in NATIVE_CAM_MODELS:
+            return  # The CAMs are the output of the CAM module
         if self.model_name == "torchvision" or self.model_name == "torchvision_ssl_rotation":
             self.target_layer = self.model.model.layer4[-1]
         elif self.model_name == "torchvision_ssl_pirl":
@@ -55,33 +87,120 @@ class CAMVisualization:
         """
         The function selects the cam visualization method specified by cam_method
         """
+        if self.model_name in NATIVE_CAM_MODELS:
+            return
+        # Only imported for the models without native CAMs (pytorch_grad_cam imports OpenCV)
+        from pytorch_grad_cam import GradCAM, ScoreCAM, GradCAMPlusPlus, AblationCAM, XGradCAM
         if self.cam_method == "GradCAM":
-            self.cam = GradCAM(model=self.model, target_layer=self.target_layer, use_cuda=True)
+            self.cam = GradCAM(model=self.model, target_layer=self.target_layer, use_cuda=self.use_cuda)
         elif self.cam_method == "GradCAMPlusPlus":
-            self.cam = GradCAMPlusPlus(model=self.model, target_layer=self.target_layer, use_cuda=True)
+            self.cam = GradCAMPlusPlus(model=self.model, target_layer=self.target_layer, use_cuda=self.use_cuda)
         elif self.cam_method == "ScoreCAM":
-            self.cam = ScoreCAM(model=self.model, target_layer=self.target_layer, use_cuda=True)
+            self.cam = ScoreCAM(model=self.model, target_layer=self.target_layer, use_cuda=self.use_cuda)
         elif self.cam_method == "AblationCAM":
-            self.cam = AblationCAM(model=self.model, target_layer=self.target_layer, use_cuda=True)
+            self.cam = AblationCAM(model=self.model, target_layer=self.target_layer, use_cuda=self.use_cuda)
         elif self.cam_method == "XGradCAM":
-            self.cam = XGradCAM(model=self.model, target_layer=self.target_layer, use_cuda=True)
+            self.cam = XGradCAM(model=self.model, target_layer=self.target_layer, use_cuda=self.use_cuda)
         else:
-            self.cam = GradCAM(model=self.model, target_layer=self.target_layer, use_cuda=True)
+            self.cam = GradCAM(model=self.model, target_layer=self.target_layer, use_cuda=self.use_cuda)
+        # The methods forward the model through their activations and gradients hooks first, the output is recorded
+        self.cam.activations_and_grads = CAMOutputRecorder(self.cam.activations_and_grads)
 
-    def get_cam_image(self, x, x_orig):
+    def get_cams(self, x, size=None):
         """
-        The function interpolates the class activation maps and return an image of required size
+        The function computes the class activation maps of the predicted classes.
 
         :param x: Batch of images (b, c, h, w)
+        :param size: The (h, w) size of the returned CAMs, the images size if None
+        :return: The CAMs normalized to [0, 1] and interpolated to the required size (b, h, w) as a numpy array, and
+        the predicted labels
+        """
+        size = tuple(size or x.shape[-2:])
+        if self.model_name in NATIVE_CAM_MODELS:
+            with torch.no_grad():
+                cls_scores, cams = self.model(x, return_cams=True)
+                labels = torch.argmax(cls_scores, 1)
+                cams = cams[torch.arange(len(labels), device=cams.device), labels].unsqueeze(1)
+                cams = F.interpolate(cams, size=size, mode="bilinear", align_corners=False).squeeze(1)
+                cams = cams - cams.amin(dim=(1, 2), keepdim=True)
+                cams = cams / cams.amax(dim=(1, 2), keepdim=True).clamp(min=1e-7)
+            return cams.cpu().numpy(), labels.cpu()
+        # The grad-cam version of the requirements (1.2.6) computes the CAM of a single image per call, the images of
+        # the batch are processed one by one. Without target category the methods target the predicted class, read
+        # from the recorded output of their forward pass
+        cams, labels = [], []
+        for i in range(len(x)):
+            cams.append(self.cam(input_tensor=x[i:i + 1], target_category=None))
+            labels.append(int(torch.argmax(self.cam.activations_and_grads.output, 1)[0]))
+        cams = np.stack(cams)
+        if cams.shape[-2:] != size:
+            cams = F.interpolate(torch.from_numpy(cams).unsqueeze(1), size=size, mode="bilinear",
+                                 align_corners=False).squeeze(1).numpy()
+        return cams, torch.tensor(labels)
+
+
+class CAMImageDataset(Dataset):
+    """
+    The dataset loads the test images for the CAM visualizations, i.e. the model input and the image to overlay the
+    CAM on, in the dataloader workers.
+    """
+    def __init__(self, root, image_ids, image_paths, image_labels, resize_dim, output_dim, transform):
         """
-        grayscale_cam = self.cam(input_tensor=x, target_category=1)
-        visualization = show_cam_on_image(np.array(x_orig, dtype=np.float32) / 255.0, grayscale_cam, use_rgb=True)
-        pil_image = Image.fromarray(visualization)
-        # Get the classification label
-        cls_scores = self.model(x)
-        _, label = torch.max(cls_scores, 1)
+        Constructor, the function initializes the dataset parameters.
 
-        return pil_image, int(label.detach())
+        :param root: The dataset root directory path
+        :param image_ids: The image ids
+        :param image_paths: The image paths relative to the images directory
+        :param image_labels: The image labels (starting at 1)
+        :param resize_dim: The (width, height) resize dimensions of the model input
+        :param output_dim: The dimension of the output visualizations
+        :param transform: The test transform
+        """
+        self.root = root
+        self.image_ids = image_ids
+        self.image_paths = image_paths
+        self.image_labels = image_labels
+        self.resize_dim = resize_dim
+        self.output_dim = output_dim
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, idx):
+        """
+        The function returns the model input, the image to overlay the CAM on (output_dim x output_dim x 3, uint8),
+        the image id and the image label.
+        """
+        image = Image.open(os.path.join(self.root, "CUB_200_2011/images", self.image_paths[idx])).convert('RGB')
+        model_input = self.transform(image.resize(self.resize_dim, Image.LANCZOS))
+        # The overlay image is resized from the original image once
+        overlay = np.asarray(image.resize((self.output_dim, self.output_dim), Image.LANCZOS), dtype=np.uint8)
+        return model_input, torch.from_numpy(overlay.copy()), int(self.image_ids[idx]), int(self.image_labels[idx])
+
+
+def save_visualization(overlay, grayscale_cam, path):
+    """
+    The function blends the CAM with the image and saves the visualization as JPEG.
+
+    :param overlay: The image (h x w x 3, uint8)
+    :param grayscale_cam: The CAM normalized to [0, 1] (h x w)
+    :param path: The output path
+    """
+    from pytorch_grad_cam.utils.image import show_cam_on_image  # Imports OpenCV, only once the CAMs are computed
+    visualization = show_cam_on_image(overlay.astype(np.float32) / 255.0, grayscale_cam, use_rgb=True)
+    Image.fromarray(visualization).save(path)
+
+
+def wait_for_tasks(tasks):
+    """
+    The function waits for the completion of the tasks (raising their exceptions) and returns their number.
+
+    :param tasks: List of futures
+    """
+    for task in tasks:
+        task.result()
+    return len(tasks)
 
 
 def parse_arguments():
@@ -105,6 +224,17 @@ def parse_arguments():
                     help="The output dimensions of the images overlayed with CAMs.")
     ap.add_argument("-d", "--device", required=False, default='cuda',
                     help="The computation device to perform operations ('cpu', 'cuda')")
+    ap.add_argument("-b", "--batch_size", type=int, required=False, default=32,
+                    help="The batch size of the CAM computation.")
+    ap.add_argument("-workers", "--num_workers", type=int, required=False, default=8,
+                    help="Number of the dataloader workers decoding and resizing the images.")
+    ap.add_argument("-threads", "--num_threads", type=int, required=False, default=8,
+                    help="Number of the threads blending the CAMs and encoding the JPEG images.")
+    ap.add_argument("-predictions", "--predictions", required=False, default="all",
+                    choices=["all", "correct", "wrong"],
+                    help="Only save the visualizations of the correct or of the wrong predictions.")
+    ap.add_argument("-classes", "--classes", type=int, nargs="+", required=False, default=None,
+                    help="Only visualize the images of these classes (labels starting at 1, all if not provided).")
 
     args = vars(ap.parse_args())
 
@@ -129,16 +259,13 @@ def main():
     # Get the required attributes from the dataset
     data = test_loader.dataset.data.values
     data = data[np.argsort(data[:, 0])]
+    if args["classes"]:
+        data = data[np.isin(data[:, 2], args["classes"])]  # Subset of the classes
     image_ids = data[:, 0]
     test_image_paths = data[:, 1]
     test_image_labels = data[:, 2]
-    # Create the model
-    model = Model(config=config).get_model()
-    model = model.to(args["device"])
-    # Load pretrained weights
-    checkpoints_path = args["model_checkpoints"]
-    checkpoints = torch.load(checkpoints_path)
-    model.load_state_dict(checkpoints["state_dict"], strict=True)
+    # Create the model with the memory-mapped checkpoint weights
+    model = load_model_from_checkpoint(config, args["model_checkpoints"], args["device"])
     # Create CAM visualizer object
     visualizer = CAMVisualization(model, config.cfg["model"]["name"], cam_method=args["cam_method"])
     # Create transforms for performing inference
@@ -152,29 +279,37 @@ def main():
             else get_object_from_path(test_transforms[i]['path'])() for i in test_transforms.keys()
         ]
     )
-    # Iterate over the dataset
-    for image_info in zip(image_ids, test_image_paths, test_image_labels):
-        image_id, image_path, image_label = image_info
-        full_path = os.path.join(config.cfg["dataloader"]["root_directory_path"],
-                                 "CUB_200_2011/images", image_path)
-        input = Image.open(full_path).convert('RGB')
-        input = input.resize(resize_dim, Image.ANTIALIAS)
-        input_trans = test_transform(input)  # Transform the image
-        input_trans = torch.unsqueeze(input_trans, 0)
-        input_trans = input_trans.to(args["device"])
-        # Get the cam image
-        output_image, predicted_label = visualizer.get_cam_image(input_trans,
-                                                                 input.resize((infer_dim, infer_dim), Image.ANTIALIAS))
-        # Write the cam images to the disc
-        predicted_label += 1
-        if predicted_label == image_label:
-            # Save the PIL image
-            output_image.save(f"{args['output_directory']}/correct_predictions/"
-                              f"{image_id}_{image_label}_{predicted_label}.jpg")
-        else:
-            # Save the PIL image
-            output_image.save(f"{args['output_directory']}/wrong_predictions/"
-                              f"{image_id}_{image_label}_{predicted_label}.jpg")
+    # The workers decode and resize the images, the CAMs are computed by batches and the threads blend and encode
+    dataset = CAMImageDataset(config.cfg["dataloader"]["root_directory_path"], image_ids, test_image_paths,
+                              test_image_labels, resize_dim, infer_dim, test_transform)
+    loader = DataLoader(dataset, batch_size=args["batch_size"], num_workers=args["num_workers"],
+                        pin_memory=args["device"] == "cuda")
+    start = time.perf_counter()
+    saved = 0
+    pending = collections.deque()  # The save tasks of the last batches, bounds the decoded images kept in memory
+    with ThreadPoolExecutor(max_workers=args["num_threads"]) as executor:
+        for inputs, overlays, batch_image_ids, batch_image_labels in loader:
+            grayscale_cams, predicted_labels = visualizer.get_cams(inputs.to(args["device"]),
+                                                                   size=(infer_dim, infer_dim))
+            predicted_labels += 1
+            tasks = []
+            for i in range(len(inputs)):
+                image_id, image_label, predicted_label = (int(batch_image_ids[i]), int(batch_image_labels[i]),
+                                                          int(predicted_labels[i]))
+                correct = predicted_label == image_label
+                if (args["predictions"] == "correct" and not correct) or (args["predictions"] == "wrong" and correct):
+                    continue
+                # Write the cam images to the disc
+                directory = "correct_predictions" if correct else "wrong_predictions"
+                tasks.append(executor.submit(save_visualization, overlays[i].numpy(), grayscale_cams[i],
+                                             f"{args['output_directory']}/{directory}/"
+                                             f"{image_id}_{image_label}_{predicted_label}.jpg"))
+            pending.append(tasks)
+            if len(pending) > 2:
+                saved += wait_for_tasks(pending.popleft())
+        while pending:
+            saved += wait_for_tasks(pending.popleft())
+    print(f"Saved {saved} visualizations of {len(dataset)} images in {time.perf_counter() - start:.1f} s")
 
 
 if __name__ == "__main__":
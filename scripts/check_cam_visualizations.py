@@ -0,0 +1,92 @@
+import sys
+import os
+import argparse
+import numpy as np
+import torch
+
+# Add the root folder (ssl_for_fgvc) as the path
+sys.path.append(f"{'/'.join(os.getcwd().split('/')[:-1])}")
+from config.config import Configuration as config
+from model.common import Model
+from cam_visualizations import CAMVisualization, NATIVE_CAM_MODELS
+
+
+def parse_arguments():
+    """
+    Parse the command line arguments
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-config", "--config_path", required=True,
+                    help="The path to the pipeline .yml configuration file of the model.")
+    ap.add_argument("-cam", "--cam_methods", nargs="+", required=False,
+                    default=["GradCAM", "GradCAMPlusPlus", "XGradCAM", "ScoreCAM", "AblationCAM"],
+                    help="The CAM methods to check (ignored for the models computing the CAMs natively).")
+    ap.add_argument("-b", "--batch_size", type=int, required=False, default=3,
+                    help="The number of the images of the checked batch (more than one).")
+    ap.add_argument("-size", "--size", type=int, required=False, default=64,
+                    help="The size of the random input images.")
+    ap.add_argument("-output_size", "--output_size", type=int, required=False, default=96,
+                    help="The size of the returned CAMs (interpolated from the input size).")
+
+    args = vars(ap.parse_args())
+
+    return args
+
+
+def check_cam_method(model, model_name, cam_method, inputs, output_size):
+    """
+    The function returns the failures of the CAMs of a batch computed by the CAM visualization: their shape and
+    range, the predicted labels, and the CAM of each image compared to the CAM of the image computed alone.
+
+    :param model: The model (on cpu)
+    :param model_name: The model name (as per config.yml)
+    :param cam_method: The CAM method
+    :param inputs: The batch of images
+    :param output_size: The size of the returned CAMs
+    """
+    failures = []
+    visualizer = CAMVisualization(model, model_name, cam_method=cam_method)
+    cams, labels = visualizer.get_cams(inputs, size=(output_size, output_size))
+    with torch.no_grad():
+        expected_labels = torch.argmax(model(inputs), 1)
+    if cams.shape != (len(inputs), output_size, output_size):
+        failures.append(f"CAMs of shape {cams.shape} instead of {(len(inputs), output_size, output_size)}")
+        return failures
+    if not torch.equal(labels, expected_labels):
+        failures.append(f"predicted labels {labels.tolist()} instead of {expected_labels.tolist()}")
+    finite = cams[np.isfinite(cams)]
+    if finite.size and (finite.min() < -1e-5 or finite.max() > 1 + 1e-5):
+        failures.append(f"CAMs in [{finite.min()}, {finite.max()}] instead of [0, 1]")
+    for i in range(len(inputs)):
+        cam, label = visualizer.get_cams(inputs[i:i + 1], size=(output_size, output_size))
+        if int(label[0]) != int(labels[i]) or not np.allclose(cam[0], cams[i], atol=1e-4, equal_nan=True):
+            failures.append(f"the CAM of the image {i} differs from the CAM of the image computed alone")
+    return failures
+
+
+def main():
+    """
+    Implements the main flow, i.e. compute the CAMs of a batch of random images with the model of the configuration
+    (random weights, on cpu) for each CAM method and check them
+    """
+    args = parse_arguments()  # Parse arguments
+    config.load_config(args["config_path"])  # Load the configuration
+    config.cfg["model"]["pretrained"] = False  # The weights do not matter
+    model_name = config.cfg["model"]["name"]
+    cam_methods = ["native"] if model_name in NATIVE_CAM_MODELS else args["cam_methods"]
+    inputs = torch.randn(args["batch_size"], 3, args["size"], args["size"])
+    failed = False
+    for cam_method in cam_methods:
+        torch.manual_seed(0)
+        model = Model(config=config).get_model()  # A new model per method, the methods register hooks on the model
+        failures = check_cam_method(model, model_name, cam_method, inputs, args["output_size"])
+        failed = failed or bool(failures)
+        print(f"{model_name} {cam_method} ({args['batch_size']} images): {'FAILED' if failures else 'OK'}")
+        for failure in failures:
+            print(f"    {failure}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import sys
+import os
+import socket
+import argparse
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import TensorDataset, DataLoader
+
+# Add the root folder (ssl_for_fgvc) as the first path, the python standard library also has a test package
+sys.path.insert(0, f"{'/'.join(os.getcwd().split('/')[:-1])}")
+from utils.distributed import all_gather_tensor, cleanup_distributed
+from dataloader.sampler import ResumableSampler, DistributedEvalSampler, get_test_sampler, set_sampler_start_index
+from test.base_tester import BaseTester
+
+
+def parse_arguments():
+    """
+    Parse the command line arguments
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-processes", "--processes", type=int, required=False, default=2,
+                    help="Number of the gloo processes on cpu.")
+    ap.add_argument("-size", "--dataset_size", type=int, required=False, default=23,
+                    help="Number of the samples of the synthetic dataset (an odd size checks the padding).")
+    ap.add_argument("-start", "--start_index", type=int, required=False, default=5,
+                    help="Number of the samples of the epoch consumed before the resume.")
+
+    args = vars(ap.parse_args())
+
+    return args
+
+
+class LinearModel(torch.nn.Module):
+    """
+    Linear classifier with the forward signature of the pipeline models.
+    """
+    def __init__(self, features=8, classes=4):
+        super(LinearModel, self).__init__()
+        self.fc = torch.nn.Linear(features, classes)
+
+    def forward(self, x, train=False):
+        return self.fc(x)
+
+
+def get_test_objects(dataset_size, features=8, classes=4):
+    """
+    The function returns the synthetic dataset and the model, identical in all the processes.
+    """
+    generator = torch.Generator().manual_seed(0)
+    dataset = TensorDataset(torch.randn(dataset_size, features, generator=generator),
+                            torch.randint(classes, (dataset_size,), generator=generator))
+    torch.manual_seed(0)
+    return dataset, LinearModel(features, classes)
+
+
+def evaluate(dataset, model):
+    """
+    The function returns the metrics of the BaseTester on the dataset, sharded across the processes if distributed.
+    """
+    # The loss is averaged over the batches, batches of one sample make it independent of the sharding
+    dataloader = DataLoader(dataset, batch_size=1, sampler=get_test_sampler(dataset))
+    return BaseTester(dataloader, torch.nn.CrossEntropyLoss, device="cpu").test(model)
+
+
+def check_sampler_coverage(dataset_size, world_size):
+    """
+    The function returns the failures of the shard coverage of the train and test samplers.
+    """
+    failures = []
+    dataset = list(range(dataset_size))
+    for epoch in range(2):
+        sampler = ResumableSampler(dataset, shuffle=True, seed=0)
+        sampler.set_epoch(epoch)
+        indices = torch.tensor(list(sampler))
+        gathered = all_gather_tensor(indices).tolist()
+        padded_size = -(-dataset_size // world_size) * world_size
+        if len(indices) != padded_size // world_size or len(gathered) != padded_size:
+            failures.append(f"train sampler epoch {epoch}: {len(indices)} samples per process, {len(gathered)} total")
+        if set(gathered) != set(dataset):
+            failures.append(f"train sampler epoch {epoch}: the shards do not cover the dataset")
+    gathered = all_gather_tensor(torch.tensor(list(DistributedEvalSampler(dataset)))).tolist()
+    if sorted(gathered) != dataset:
+        failures.append("test sampler: the shards do not cover every sample exactly once")
+    return failures
+
+
+def check_resume(dataset_size, start_index):
+    """
+    The function returns the failures of the resume from the middle of an epoch.
+    """
+    failures = []
+    dataset = list(range(dataset_size))
+    sampler = ResumableSampler(dataset, shuffle=True, seed=0)
+    sampler.set_epoch(3)
+    full = list(sampler)
+    resumed = ResumableSampler(dataset, shuffle=True, seed=0)
+    dataloader = DataLoader(dataset, batch_size=1, sampler=resumed)
+    resumed.set_epoch(3)
+    set_sampler_start_index(dataloader, start_index)
+    if list(resumed) != full[start_index:] or len(resumed) != len(full[start_index:]):
+        failures.append("resume: the resumed epoch is not the remainder of the interrupted epoch")
+    if [int(x) for x in dataloader] != full[start_index:]:
+        failures.append("resume: the dataloader does not skip the consumed samples")
+    resumed.set_epoch(4)
+    sampler.set_epoch(4)
+    if resumed.start_index != 0 or list(resumed) != list(sampler):
+        failures.append("resume: the next epoch does not start from the beginning")
+    return failures
+
+
+def run_process(rank, world_size, port, args, expected_metrics, results):
+    """
+    The function runs the checks in one process of the process group.
+    """
+    os.environ.update({"MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port), "RANK": str(rank),
+                       "WORLD_SIZE": str(world_size)})
+    dist.init_process_group(backend="gloo", init_method="env://")
+    failures = check_sampler_coverage(args["dataset_size"], world_size)
+    dataset, model = get_test_objects(args["dataset_size"])
+    metrics = evaluate(dataset, model)
+    for name, value in expected_metrics.items():
+        if abs(metrics[name] - value) > 1e-6:
+            failures.append(f"tester: {name} {metrics[name]} instead of {value} (single process)")
+    failures += check_resume(args["dataset_size"], args["start_index"])
+    results[rank] = failures
+    cleanup_distributed()
+
+
+def get_free_port():
+    """
+    The function returns a free TCP port of the local machine.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    """
+    Implements the main flow, i.e. run the checks of the distributed samplers, of the reduction of the tester metrics
+    and of the resume from the middle of an epoch in a process group of gloo processes on cpu
+    """
+    args = parse_arguments()  # Parse arguments
+    dataset, model = get_test_objects(args["dataset_size"])
+    expected_metrics = evaluate(dataset, model)  # Single process evaluation
+    results = mp.Manager().dict()
+    mp.spawn(run_process, args=(args["processes"], get_free_port(), args, expected_metrics, results),
+             nprocs=args["processes"])
+    failed = False
+    for rank in range(args["processes"]):
+        for failure in results.get(rank, ["no result"]):
+            print(f"Rank {rank}: {failure}")
+            failed = True
+    print(f"{args['processes']} processes: {'FAILED' if failed else 'OK'}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import sys
+import os
+import argparse
+import subprocess
+
+# The commands checked by default (script path relative to the scripts directory and arguments)
+COMMANDS = [["../main.py", "--help"], ["evaluate.py", "--help"], ["metrics.py", "--help"]]
+# The modules which must not be imported by the commands, e.g. the heavy or optional backends only required once
+# the arguments are parsed
+FORBIDDEN_MODULES = ["torch", "torchvision", "numpy", "pandas", "requests", "cv2", "pytorch_grad_cam"]
+
+
+def parse_arguments():
+    """
+    Parse the command line arguments
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-budget", "--budget_ms", type=float, required=False, default=250,
+                    help="The maximum import time in milliseconds of each command.")
+    ap.add_argument("-repeats", "--repeats", type=int, required=False, default=3,
+                    help="Number of the runs of each command, the fastest run is checked.")
+    ap.add_argument("-top", "--top", type=int, required=False, default=5,
+                    help="Number of the slowest top level imports reported per command.")
+
+    args = vars(ap.parse_args())
+
+    return args
+
+
+def parse_import_time(output):
+    """
+    The function parses the '-X importtime' report of a python process.
+
+    :param output: The standard error of the process
+    :return: Dictionary of the cumulative import time in microseconds of the top level imports, and the set of all
+    the imported modules
+    """
+    top_level, modules = {}, set()
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.add(name.strip())
+        if not name[1:].startswith(" "):  # The nested imports are indented
+            top_level[name.strip()] = int(cumulative)
+    return top_level, modules
+
+
+def measure_import_time(command, repeats=3):
+    """
+    The function runs a python command with '-X importtime' and returns the report of its fastest run.
+
+    :param command: The script path and its arguments
+    :param repeats: Number of the runs
+    :return: The total import time in milliseconds, the top level imports (see parse_import_time()) and the set of
+    the imported modules
+    """
+    best = None
+    for _ in range(repeats):
+        process = subprocess.run([sys.executable, "-X", "importtime"] + command, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if process.returncode != 0:
+            print(f"{' '.join(command)} failed:\n{process.stderr[-2000:]}")
+            sys.exit(1)
+        top_level, modules = parse_import_time(process.stderr)
+        total = sum(top_level.values()) / 1000
+        if best is None or total < best[0]:
+            best = (total, top_level, modules)
+    return best
+
+
+def main():
+    """
+    Implements the main flow, i.e. measure the import time of the commands and fail if a command exceeds the budget
+    or imports a forbidden module
+    """
+    args = parse_arguments()  # Parse arguments
+    failed = False
+    for command in COMMANDS:
+        total, top_level, modules = measure_import_time(command, args["repeats"])
+        forbidden = sorted(modules.intersection(FORBIDDEN_MODULES))
+        status = "OK" if total <= args["budget_ms"] and not forbidden else "FAILED"
+        failed = failed or status == "FAILED"
+        print(f"{' '.join(command)}: {total:.1f} ms (budget {args['budget_ms']:.0f} ms) {status}")
+        for name, cumulative in sorted(top_level.items(), key=lambda item: -item[1])[:args["top"]]:
+            print(f"    {cumulative / 1000:8.1f} ms {name}")
+        if forbidden:
+            print(f"    Forbidden imports: {', '.join(forbidden)}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,16 @@
 import sys
 import os
+import copy
+import json
+import re
+import glob
+import time
 import argparse
-import torch
-from torch.autograd import Variable
-import numpy as np
+import traceback
 
 # Add the root folder (ssl_for_fgvc) as the path
 sys.path.append(f"{'/'.join(os.getcwd().split('/')[:-1])}")
-from config.config import Configuration as config
-from dataloader.common import Dataloader
-from model.common import Model
-from utils.util import get_object_from_path
+# The pipeline modules (torch, torchvision, ...) are imported by the functions using them, so that --help is instant
 
 
 def parse_arguments():
@@ -21,77 +21,363 @@ def parse_arguments():
     ap.add_argument("-config", "--config_path", required=True,
                     help="The path to the pipeline .yml configuration file.")
     ap.add_argument("-checkpoints", "--model_checkpoints", required=True,
-                    help="The path to model checkpoints.")
+                    help="The path to model checkpoints. A checkpoints directory (all its epoch_*.pth checkpoints) or "
+                         "a glob pattern (e.g. 'results/*/checkpoints/best_checkpoints.pth') evaluates several "
+                         "checkpoints in a sweep, every test batch is prepared once and fed to a group of loaded "
+                         "models.")
     ap.add_argument("-dataset", "--root_dataset_path", required=False, default="./data/CUB_200_2011",
                     help="The path to the dataset root directory. "
                          "The program will download the dataset if not present locally.")
     ap.add_argument("-d", "--device", required=False, default='cuda',
                     help="The computation device to perform operations ('cpu', 'cuda')")
+    ap.add_argument("-b", "--batch_size", type=int, required=False, default=None,
+                    help="The evaluation batch size (the batch size of the configuration by default).")
+    ap.add_argument("-workers", "--num_workers", type=int, required=False, default=None,
+                    help="Number of the dataloader workers per shard (the workers of the configuration by default).")
+    ap.add_argument("-shards", "--shards", type=int, required=False, default=1,
+                    help="Number of the processes evaluating an interleaved shard of the test dataset each.")
+    ap.add_argument("-threads", "--num_threads", type=int, required=False, default=None,
+                    help="Number of the threads per shard (the cpu count divided by the shards on cpu by default).")
+    ap.add_argument("-top_k", "--top_k", type=int, nargs="+", required=False, default=[1, 2, 5],
+                    help="The k values of the reported top-k accuracies.")
+    ap.add_argument("-group", "--group_size", type=int, required=False, default=None,
+                    help="Number of the models loaded together in a sweep (estimated from the free memory of the "
+                         "device by default).")
+    ap.add_argument("-store", "--logit_store", required=False, default=None,
+                    help="The directory of the stored logits (see metrics.py). The logits, labels and image ids of the "
+                         "evaluated checkpoints are stored, and the checkpoints already stored for the same test data "
+                         "and transforms are scored from their stored logits without running the model.")
+    ap.add_argument("-report", "--report_path", required=False, default=None,
+                    help="The path of the JSON evaluation report (metrics, per class accuracies and confusion "
+                         "matrix), not written if not provided.")
 
     args = vars(ap.parse_args())
 
     return args
 
 
+def load_model(checkpoints_path, device):
+    """
+    The function creates the model of the loaded configuration with the memory-mapped checkpoint weights.
+
+    :param checkpoints_path: The path to the model checkpoints (.pth or flat .safetensors checkpoint)
+    :param device: The computation device
+    """
+    from config.config import Configuration as config
+    from model.common import load_model_from_checkpoint
+    model = load_model_from_checkpoint(config, checkpoints_path, device)
+    return model.eval()  # Put the model in the evaluation mode
+
+
+def get_test_dataloader(shard, shards, batch_size=None, num_workers=None):
+    """
+    The function returns the dataloader of a shard of the test dataset of the loaded configuration.
+
+    :param shard: The index of the shard
+    :param shards: Number of the shards
+    :param batch_size: The batch size, the batch size of the configuration if None
+    :param num_workers: Number of the dataloader workers, the workers of the configuration if None
+    """
+    import numpy as np
+    from config.config import Configuration as config
+    from dataloader.common import Dataloader
+    from dataloader.sampler import get_shard_dataloader
+    np.random.seed(0)  # Every shard samples the same test data fraction
+    _, test_loader = Dataloader(config=config).get_loader()  # Create dataloader
+    return get_shard_dataloader(test_loader, shard, shards, batch_size, num_workers)
+
+
+def get_dataset_positions(dataset):
+    """
+    The function returns the positions in the full dataset and the image ids of the samples of a (sharded) dataset.
+
+    :param dataset: The dataset or the Subset of a dataset (see get_shard_dataloader())
+    """
+    import numpy as np
+    from torch.utils.data import Subset
+    if isinstance(dataset, Subset):
+        positions, image_ids = get_dataset_positions(dataset.dataset)
+        return positions[dataset.indices], image_ids[dataset.indices]
+    positions = np.arange(len(dataset))
+    data = getattr(dataset, "data", None)  # The CUB datasets list the images in a DataFrame
+    image_ids = data["img_id"].values if data is not None and "img_id" in data else positions
+    return positions, np.asarray(image_ids, dtype=np.int64)
+
+
+def get_data_config(cfg):
+    """
+    The function returns the configuration defining the test images and their transforms, i.e. the logits of a
+    checkpoint, used in the key of the stored logits.
+
+    :param cfg: The pipeline configuration (Configuration.cfg)
+    """
+    dataloader_cfg = cfg["dataloader"]
+    return {"model": cfg["model"]["model_function_path"], "dataloader": dataloader_cfg["name"],
+            "test_data_fraction": dataloader_cfg["test_data_fraction"],
+            "resize": [dataloader_cfg.get("resize_width"), dataloader_cfg.get("resize_height")],
+            "transforms": dataloader_cfg["transforms"].get("test")}
+
+
+def get_checkpoint_paths(path):
+    """
+    The function returns the checkpoint paths of a checkpoint path, a checkpoints directory (its epoch_*.pth
+    checkpoints) or a glob pattern, sorted by name with the numbers compared by value (epoch_2 before epoch_10).
+
+    :param path: The checkpoint path, checkpoints directory path or glob pattern
+    """
+    paths = glob.glob(os.path.join(path, "epoch_*.pth")) if os.path.isdir(path) else glob.glob(path)
+    return sorted(paths, key=lambda p: [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", p)])
+
+
+def get_group_size(checkpoints_paths, device, memory_fraction=0.5):
+    """
+    The function estimates the number of the models fitting in memory together, from the free memory of the device
+    and the size of the largest checkpoint file (the parameters and buffers of the model).
+
+    :param checkpoints_paths: The checkpoint paths
+    :param device: The computation device
+    :param memory_fraction: Fraction of the free memory used by the models, the rest is left for the activations
+    """
+    import torch
+    if device.startswith("cuda"):
+        free_memory, _ = torch.cuda.mem_get_info(torch.device(device))
+    else:
+        free_memory = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    model_size = max(os.path.getsize(path) for path in checkpoints_paths)
+    return max(int(free_memory * memory_fraction // model_size), 1)
+
+
+def evaluate_shard(cfg, checkpoints_paths, device, shard=0, shards=1, batch_size=None, num_workers=None,
+                   num_threads=None, top_k=(1, 2), group_size=1, keep_logits=False):
+    """
+    The function evaluates the model checkpoints on a shard of the test dataset. The checkpoints are loaded in
+    groups of group_size models, each test batch is prepared once per group and fed to all the models of the group.
+
+    :param cfg: The pipeline configuration (Configuration.cfg)
+    :param checkpoints_paths: The paths to the model checkpoints
+    :param device: The computation device
+    :param shard: The index of the shard
+    :param shards: Number of the shards
+    :param batch_size: The batch size, the batch size of the configuration if None
+    :param num_workers: Number of the dataloader workers, the workers of the configuration if None
+    :param num_threads: Number of the threads, torch default if None
+    :param top_k: The k values of the top-k accuracies
+    :param group_size: Number of the models loaded together
+    :param keep_logits: If True, the states also contain the logits, labels, positions and image ids of the shard
+    :return: List of the metric states of the shard (see StreamingMetrics.state_dict()), one per checkpoint
+    """
+    import torch
+    from config.config import Configuration as config
+    from utils.metrics import StreamingMetrics
+    from utils.util import get_object_from_path
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    config.cfg = copy.deepcopy(cfg)
+    test_loader = get_test_dataloader(shard, shards, batch_size, num_workers)
+    test_loss = get_object_from_path(cfg["train"]["class_loss_function_path"])()
+    positions, image_ids = get_dataset_positions(test_loader.dataset)
+    states = []
+    for start in range(0, len(checkpoints_paths), group_size):
+        # The models of the group are only loaded now, and released before loading the next group
+        models = [load_model(path, device) for path in checkpoints_paths[start:start + group_size]]
+        metrics = [StreamingMetrics(cfg["model"]["classes_count"], top_k, device) for _ in models]
+        logits, all_labels = [[] for _ in models], []
+        with torch.no_grad():  # Require to continuously free the GPU memory after inference
+            for inputs, labels in test_loader:
+                # Move the data on the specified device, the DCL labels are lists
+                inputs = inputs.to(device)
+                labels = torch.as_tensor(labels).long().to(device)
+                for model, model_metrics, model_logits in zip(models, metrics, logits):
+                    outputs = model(inputs, train=False)  # Perform batch inference
+                    model_metrics.update(outputs, labels, test_loss(outputs, labels))
+                    if keep_logits:
+                        model_logits.append(outputs.float().cpu())
+                if keep_logits:
+                    all_labels.append(labels.cpu())
+        for model_metrics, model_logits in zip(metrics, logits):
+            state = model_metrics.state_dict()
+            if keep_logits:
+                state.update(logits=torch.cat(model_logits), labels=torch.cat(all_labels),
+                             positions=torch.from_numpy(positions), image_ids=torch.from_numpy(image_ids))
+            states.append(state)
+        del models
+    return states
+
+
+def _shard_worker(results, cfg, checkpoints_paths, device, shard, shards, batch_size, num_workers, num_threads,
+                  top_k, group_size, keep_logits):
+    """
+    The function implements the shard evaluation process, the metric states (or the traceback of the failure) are
+    put in the results queue with the shard index. See evaluate_shard() for the other parameters.
+    """
+    try:
+        states = evaluate_shard(cfg, checkpoints_paths, device, shard, shards, batch_size, num_workers, num_threads,
+                                top_k, group_size, keep_logits)
+        # Numpy arrays, the tensors would be shared with the exiting process
+        results.put((shard, [{name: value.numpy() for name, value in state.items()} for state in states]))
+    except Exception:
+        results.put((shard, traceback.format_exc()))
+
+
+def get_stored_metrics(cfg, store, key, top_k=(1, 2)):
+    """
+    The function computes the metrics of a checkpoint from its stored logits, without running the model.
+
+    :param cfg: The pipeline configuration (Configuration.cfg)
+    :param store: The logit store (LogitStore)
+    :param key: The key of the stored logits
+    :param top_k: The k values of the top-k accuracies
+    """
+    import torch
+    import numpy as np
+    from utils.metrics import StreamingMetrics
+    from utils.util import get_object_from_path
+    logits, labels, _ = store.load(key)
+    logits, labels = torch.from_numpy(np.array(logits)), torch.from_numpy(np.array(labels))
+    test_loss = get_object_from_path(cfg["train"]["class_loss_function_path"])()
+    metrics = StreamingMetrics(cfg["model"]["classes_count"], top_k)
+    metrics.update(logits, labels, test_loss(logits, labels))
+    return metrics.compute()
+
+
+def store_logits(store, key, checkpoints_path, shard_states):
+    """
+    The function writes the logits of a checkpoint gathered by the shards to the logit store, in the dataset order.
+
+    :param store: The logit store (LogitStore)
+    :param key: The key of the stored logits
+    :param checkpoints_path: The path to the model checkpoints
+    :param shard_states: The states of the checkpoint of all the shards (see evaluate_shard())
+    """
+    import numpy as np
+    from utils.checkpoint import get_file_hash
+    count = sum(len(state["positions"]) for state in shard_states)
+    num_classes = shard_states[0]["logits"].shape[1]
+    store.create(key, count, num_classes, {"checkpoints_path": os.path.abspath(checkpoints_path),
+                                           "checkpoint_hash": get_file_hash(checkpoints_path), "split": "test"})
+    for state in shard_states:
+        store.write(key, np.asarray(state["positions"]), np.asarray(state["logits"]), np.asarray(state["labels"]),
+                    np.asarray(state["image_ids"]))
+    store.set_complete(key)
+
+
+def evaluate(cfg, checkpoints_paths, device, shards=1, batch_size=None, num_workers=None, num_threads=None,
+             top_k=(1, 2), group_size=None, store_directory=None):
+    """
+    The function evaluates the model checkpoints on the test dataset, split in shards evaluated by separate
+    processes (the current process if there is a single shard), and merges the metrics of the shards. With a logit
+    store, the checkpoints already stored are scored from their stored logits and the others are stored.
+
+    :param cfg: The pipeline configuration (Configuration.cfg)
+    :param checkpoints_paths: The paths to the model checkpoints
+    :param device: The computation device
+    :param shards: Number of the shards
+    :param batch_size: The batch size, the batch size of the configuration if None
+    :param num_workers: Number of the dataloader workers per shard, the workers of the configuration if None
+    :param num_threads: Number of the threads per shard, the cpu count divided by the shards on cpu if None
+    :param top_k: The k values of the top-k accuracies
+    :param group_size: Number of the models loaded together by a shard, estimated from the free memory if None
+    :param store_directory: The directory of the logit store (see LogitStore), the logits are not stored if None
+    :return: List of the metrics (see StreamingMetrics.compute()), one per checkpoint
+    """
+    import torch.multiprocessing as mp
+    from utils.checkpoint import get_file_hash
+    from utils.logit_store import LogitStore, get_store_key
+    from utils.metrics import StreamingMetrics
+    all_metrics = {}
+    if store_directory:
+        store = LogitStore(store_directory)
+        data_config = get_data_config(cfg)
+        keys = {path: get_store_key(get_file_hash(path), "test", data_config) for path in checkpoints_paths}
+        for path in checkpoints_paths:
+            if store.is_complete(keys[path]):
+                print(f"Scoring {path} from the stored logits {store.get_path(keys[path])}")
+                all_metrics[path] = get_stored_metrics(cfg, store, keys[path], top_k)
+    evaluated_paths = [path for path in checkpoints_paths if path not in all_metrics]
+    if evaluated_paths:
+        if num_threads is None and device == "cpu":
+            num_threads = max((os.cpu_count() or 1) // shards, 1)
+        if group_size is None:
+            # The shards share the memory of the device
+            group_size = max(get_group_size(evaluated_paths, device) // shards, 1)
+        keep_logits = bool(store_directory)
+        if shards == 1:
+            states = [evaluate_shard(cfg, evaluated_paths, device, 0, 1, batch_size, num_workers, num_threads, top_k,
+                                     group_size, keep_logits)]
+        else:
+            context = mp.get_context("spawn")
+            results = context.Queue()
+            # Not daemons, the shards use dataloader worker processes
+            processes = [context.Process(target=_shard_worker, name=f"evaluate-shard-{shard}",
+                                         args=(results, cfg, evaluated_paths, device, shard, shards, batch_size,
+                                               num_workers, num_threads, top_k, group_size, keep_logits))
+                         for shard in range(shards)]
+            for process in processes:
+                process.start()
+            states = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+            for shard, state in states:
+                if isinstance(state, str):
+                    raise RuntimeError(f"The evaluation of the shard {shard} failed:\n{state}")
+            states = [state for _, state in states]
+        for i, path in enumerate(evaluated_paths):
+            metrics = StreamingMetrics(cfg["model"]["classes_count"], top_k)
+            for shard_states in states:
+                metrics.merge(shard_states[i])
+            all_metrics[path] = metrics.compute()
+            if keep_logits:
+                store_logits(store, keys[path], path, [shard_states[i] for shard_states in states])
+    return [all_metrics[path] for path in checkpoints_paths]
+
+
 def main():
     """
-    Implements the main flow, i.e. load the dataset & model, generate cam visualizations and save the visualizations
+    Implements the main flow, i.e. load the dataset & model, evaluate the model (or the models of a sweep) on the
+    test dataset and report the metrics
     """
     args = parse_arguments()  # Parse arguments
+    from config.config import Configuration as config
     config.load_config(args["config_path"])  # Load configuration
     config.cfg["dataloader"]["root_directory_path"] = args["root_dataset_path"]  # Set the dataset path
-    _, test_loader = Dataloader(config=config).get_loader()  # Create dataloader
-    # Create the model
-    model = Model(config=config).get_model()
-    model = model.to(args["device"])
-    # Load pretrained weights
-    checkpoints_path = args["model_checkpoints"]
-    checkpoints = torch.load(checkpoints_path)
-    model.load_state_dict(checkpoints["state_dict"], strict=True)
-    # Initialize the loss
-    loss_func = get_object_from_path(config.cfg["train"]["class_loss_function_path"])
-    test_loss = loss_func()
-    # Iterate over the test dataset and calculate the metrics
-    total_loss = 0  # Variable to store the running loss
-    total_correct_predictions_top_1 = 0  # Variable to store the total top-1 correction predictions
-    total_correct_predictions_top_2 = 0  # Variable to store the total top-1 correction predictions
-    total_predictions = 0  # Variable to store the total predictions
-    metrics = {}  # Dictionary to store the evaluation metrics
-    model.eval()  # Put the model in the evaluation mode
-    with torch.no_grad():  # Require to continuously free the GPU memory after inference
-        print(f"Evaluating. It may take some time. Thank you for your patience.")
-        for batch_idx, d in enumerate(test_loader):
-            inputs, labels = d  # Extract inputs and labels
-            # Move the data on the specified device
-            inputs = inputs.to(args["device"])
-            try:
-                labels = labels.to(args["device"])
-            except Exception:
-                labels = Variable(torch.from_numpy(np.array(labels))).long().to(args["device"])
-            total_predictions += len(labels)  # Increment total predictions
-            outputs = model(inputs, train=False)  # Perform batch inference
-            loss = test_loss(outputs, labels)  # Calculate the loss
-            total_loss += loss  # Total loss till now
-            top_2_val, top_2_pos = torch.topk(outputs, 2)  # Top 2 values and corresponding positions
-            # Calculate the top-1 and top-2 accuracies
-            batch_corrects_1 = torch.sum((top_2_pos[:, 0] == labels)).data.item()
-            total_correct_predictions_top_1 += batch_corrects_1
-            batch_corrects_2 = torch.sum((top_2_pos[:, 1] == labels)).data.item()
-            total_correct_predictions_top_2 += (batch_corrects_2 + batch_corrects_1)
-            if batch_idx % 50 == 0:
-                metrics['loss'] = round(float(total_loss) / len(test_loader), 4)
-                metrics['accuracy_top_1'] = round(float(total_correct_predictions_top_1) / total_predictions, 4)
-                metrics['accuracy_top_2'] = round(float(total_correct_predictions_top_2) / total_predictions, 4)
-                print(f"Step {batch_idx}/{len(test_loader)}, Test loss: {metrics['loss']}, "
-                      f"Top-1 Test accuracy: {metrics['accuracy_top_1']}"
-                      f", Top-2 Test accuracy: {metrics['accuracy_top_2']}")
-        # Final Scores
-        print(f"Final Scores.")
-        metrics['loss'] = float(total_loss) / len(test_loader)
-        metrics['accuracy_top_1'] = float(total_correct_predictions_top_1) / total_predictions
-        metrics['accuracy_top_2'] = float(total_correct_predictions_top_2) / total_predictions
-        print(f"Test loss: {metrics['loss']}, Top-1 Test accuracy: {metrics['accuracy_top_1']}"
-              f", Top-2 Test accuracy: {metrics['accuracy_top_2']}")
+    checkpoints_paths = get_checkpoint_paths(args["model_checkpoints"])
+    if not checkpoints_paths:
+        print(f"No model checkpoints found at {args['model_checkpoints']}. Exiting!")
+        sys.exit(1)
+    top_k = sorted(set(args["top_k"]))
+    print(f"Evaluating {len(checkpoints_paths)} checkpoint(s). It may take some time. Thank you for your patience.")
+    start = time.perf_counter()
+    all_metrics = evaluate(config.cfg, checkpoints_paths, args["device"], shards=args["shards"],
+                           batch_size=args["batch_size"], num_workers=args["num_workers"],
+                           num_threads=args["num_threads"], top_k=top_k, group_size=args["group_size"],
+                           store_directory=args["logit_store"])
+    elapsed = time.perf_counter() - start
+    # Final Scores
+    print(f"Final Scores.")
+    if len(checkpoints_paths) == 1:
+        metrics = all_metrics[0]
+        print(f"Test loss: {metrics['loss']}, " +
+              ", ".join(f"Top-{k} Test accuracy: {metrics[f'accuracy_top_{k}']}" for k in top_k) +
+              f", Mean class accuracy: {metrics['mean_class_accuracy']}")
+    else:
+        # A table with one row per checkpoint
+        width = max(len(path) for path in checkpoints_paths)
+        print(f"{'Checkpoint':<{width}} {'Loss':>8} " + " ".join(f"{f'Top-{k}':>8}" for k in top_k) +
+              f" {'Mean cls':>8}")
+        for path, metrics in zip(checkpoints_paths, all_metrics):
+            print(f"{path:<{width}} {metrics['loss']:>8.4f} " +
+                  " ".join(f"{metrics[f'accuracy_top_{k}']:>8.4f}" for k in top_k) +
+                  f" {metrics['mean_class_accuracy']:>8.4f}")
+    print(f"Evaluated {all_metrics[0]['count']} images with {len(checkpoints_paths)} checkpoint(s) in "
+          f"{elapsed:.1f} s")
+    if args["report_path"]:
+        report = {"config_path": args["config_path"], "device": args["device"], "shards": args["shards"],
+                  "elapsed_seconds": elapsed,
+                  "results": [{"checkpoints_path": path, "metrics": metrics}
+                              for path, metrics in zip(checkpoints_paths, all_metrics)]}
+        with open(args["report_path"], "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"The evaluation report is saved to {args['report_path']}")
 
 
 if __name__ == "__main__":
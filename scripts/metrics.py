@@ -0,0 +1,135 @@
+import sys
+import os
+import json
+import argparse
+
+# Add the root folder (ssl_for_fgvc) as the path
+sys.path.append(f"{'/'.join(os.getcwd().split('/')[:-1])}")
+# The pipeline modules (torch, ...) are imported by the functions using them, so that --help is instant
+
+
+def parse_arguments():
+    """
+    Parse the command line arguments
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-store", "--logit_store", required=True,
+                    help="The directory of the logits stored by evaluate.py --logit_store.")
+    ap.add_argument("-entries", "--entries", nargs="+", required=False, default=None,
+                    help="The keys or the checkpoint paths of the scored entries (all the entries by default).")
+    ap.add_argument("-ensemble", "--ensemble", action="store_true",
+                    help="Also score the ensemble of the entries, i.e. the mean of their class probabilities.")
+    ap.add_argument("-top_k", "--top_k", type=int, nargs="+", required=False, default=[1, 2, 5],
+                    help="The k values of the reported top-k accuracies.")
+    ap.add_argument("-bins", "--calibration_bins", type=int, required=False, default=15,
+                    help="Number of the confidence bins of the expected calibration error.")
+    ap.add_argument("-list", "--list", action="store_true",
+                    help="Only list the stored entries.")
+    ap.add_argument("-report", "--report_path", required=False, default=None,
+                    help="The path of the JSON metrics report (including the per class accuracies and the confusion "
+                         "matrices), not written if not provided.")
+
+    args = vars(ap.parse_args())
+
+    return args
+
+
+def get_metrics(log_probabilities, labels, top_k=(1, 2), bins=15):
+    """
+    The function computes the metrics of class log probabilities.
+
+    :param log_probabilities: The class log probabilities (n, num_classes)
+    :param labels: The labels (n)
+    :param top_k: The k values of the top-k accuracies
+    :param bins: Number of the confidence bins of the expected calibration error
+    :return: Dictionary of the metrics (see StreamingMetrics.compute()) and of the expected calibration error
+    """
+    import torch.nn.functional as F
+    from utils.metrics import StreamingMetrics, expected_calibration_error
+    metrics = StreamingMetrics(log_probabilities.shape[1], top_k)
+    # Negative log likelihood, i.e. the cross entropy loss of the logits
+    metrics.update(log_probabilities, labels, F.nll_loss(log_probabilities, labels))
+    metrics = metrics.compute()
+    metrics["expected_calibration_error"] = expected_calibration_error(log_probabilities.exp(), labels, bins)
+    return metrics
+
+
+def select_entries(store, entries=None):
+    """
+    The function returns the keys and the metadata of the selected complete entries of the store.
+
+    :param store: The logit store (LogitStore)
+    :param entries: The keys or the checkpoint paths of the entries (matched by content if the checkpoints exist),
+    all the entries if None
+    """
+    from utils.checkpoint import get_file_hash
+    stored = store.list()
+    if entries is None:
+        return stored
+    selected = []
+    for entry in entries:
+        checkpoint_hash = get_file_hash(entry) if os.path.isfile(entry) else None
+        matches = [(key, meta) for key, meta in stored if entry == key or os.path.abspath(entry) == meta.get(
+            "checkpoints_path") or (checkpoint_hash and checkpoint_hash == meta.get("checkpoint_hash"))]
+        if not matches:
+            print(f"No stored logits found for {entry}. Exiting!")
+            sys.exit(1)
+        selected += matches
+    return selected
+
+
+def main():
+    """
+    Implements the main flow, i.e. load the stored logits and report the metrics of the entries (and of their
+    ensemble) without running any model
+    """
+    args = parse_arguments()  # Parse arguments
+    import torch
+    import numpy as np
+    from utils.logit_store import LogitStore
+    store = LogitStore(args["logit_store"])
+    entries = select_entries(store, args["entries"])
+    if not entries:
+        print(f"No stored logits found at {args['logit_store']}. Exiting!")
+        sys.exit(1)
+    if args["list"]:
+        for key, meta in entries:
+            print(f"{key} {meta['count']} images, {meta['num_classes']} classes, {meta['checkpoints_path']}")
+        return
+    top_k = sorted(set(args["top_k"]))
+    results, image_ids, labels, ensemble = [], None, None, []
+    for key, meta in entries:
+        logits, entry_labels, entry_image_ids = store.load(key)
+        log_probabilities = torch.log_softmax(torch.from_numpy(np.array(logits)), dim=1)
+        entry_labels = torch.from_numpy(np.array(entry_labels))
+        results.append((meta["checkpoints_path"], get_metrics(log_probabilities, entry_labels, top_k,
+                                                              args["calibration_bins"])))
+        if args["ensemble"]:
+            if image_ids is None:
+                image_ids, labels = np.array(entry_image_ids), entry_labels
+            elif not np.array_equal(image_ids, entry_image_ids):
+                print(f"The entry {key} has not been evaluated on the same images, it can not be ensembled. Exiting!")
+                sys.exit(1)
+            ensemble.append(log_probabilities)
+    if args["ensemble"]:
+        # Log of the mean of the probabilities
+        ensemble = torch.logsumexp(torch.stack(ensemble), dim=0) - np.log(len(ensemble))
+        results.append((f"Ensemble of {len(entries)}", get_metrics(ensemble, labels, top_k, args["calibration_bins"])))
+    # A table with one row per entry
+    width = max(len(name) for name, _ in results)
+    print(f"{'Checkpoint':<{width}} {'Loss':>8} " + " ".join(f"{f'Top-{k}':>8}" for k in top_k) +
+          f" {'Mean cls':>8} {'ECE':>8}")
+    for name, metrics in results:
+        print(f"{name:<{width}} {metrics['loss']:>8.4f} " +
+              " ".join(f"{metrics[f'accuracy_top_{k}']:>8.4f}" for k in top_k) +
+              f" {metrics['mean_class_accuracy']:>8.4f} {metrics['expected_calibration_error']:>8.4f}")
+    if args["report_path"]:
+        report = {"logit_store": args["logit_store"],
+                  "results": [{"checkpoints_path": name, "metrics": metrics} for name, metrics in results]}
+        with open(args["report_path"], "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"The metrics report is saved to {args['report_path']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import sys
+import os
+import tempfile
+import argparse
+import torch
+
+# Add the root folder (ssl_for_fgvc) as the path
+sys.path.append(f"{'/'.join(os.getcwd().split('/')[:-1])}")
+from utils.util import get_object_from_path
+from utils.weight_registry import WeightRegistry
+
+
+def parse_arguments():
+    """
+    Parse the command line arguments
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-cache", "--cache_directory", required=True,
+                    help="The cache directory of the weight registry (model: weight_registry: cache_directory).")
+    ap.add_argument("-name", "--name", required=False, default=None,
+                    help="The name of the registered weights, the torchvision model name (e.g. 'resnet50') for the "
+                         "backbone weights or the name used as model: vissl_weights_path for the VISSL weights.")
+    ap.add_argument("-path", "--path", required=False, default=None,
+                    help="The path of the registered weight file (a state dict saved by torch.save). If not "
+                         "provided, the torchvision ImageNet weights of the model --name are downloaded, e.g. on a "
+                         "machine with network access whose cache directory is then copied to the training nodes.")
+
+    args = vars(ap.parse_args())
+
+    return args
+
+
+def main():
+    """
+    Implements the main flow, i.e. add weights to the registry, or list the registered weights
+    """
+    args = parse_arguments()  # Parse arguments
+    registry = WeightRegistry(args["cache_directory"])
+    if args["name"] is None:
+        for name, sha in sorted(registry.index.items()):
+            print(f"{name}: {sha}{'' if registry.get_path(name) else ' (missing)'}")
+        return
+    if args["path"]:
+        sha = registry.register(args["name"], args["path"])
+    else:
+        model = get_object_from_path(f"torchvision.models.{args['name']}")(pretrained=True)  # Download the weights
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, f"{args['name']}.pth")
+            torch.save(model.state_dict(), path)
+            sha = registry.register(args["name"], path)
+    print(f"Registered the weights '{args['name']}' as {sha} in {args['cache_directory']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import atexit
+import copy
+import queue
+import traceback
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from utils.checkpoint import snapshot_state_dict
+import logging
+
+logger = logging.getLogger(f"test/async_validator.py")
+
+
+def _evaluator_loop(cfg, tester_class, loss_function, device, num_threads, subsample_fraction, requests, results):
+    """
+    The function implements the evaluator process. It builds the model and the test dataloader from the
+    configuration once, then evaluates the weight snapshots received from the trainer until it receives None.
+
+    :param cfg: The pipeline configuration (Configuration.cfg)
+    :param tester_class: The tester class used by the trainer (e.g. BaseTester, DCLTester)
+    :param loss_function: The loss function class of the tester
+    :param device: The execution device of the evaluator
+    :param num_threads: Number of threads used by the evaluator, torch default if None
+    :param subsample_fraction: Fraction of the test dataset evaluated by the fast passes
+    :param requests: Queue of the (epoch, full, state_dict) evaluation requests
+    :param results: Queue of the (epoch, full, metrics) evaluation results
+    """
+    try:
+        from config.config import Configuration as config
+        from dataloader.common import Dataloader
+        from dataloader.sampler import get_subset_dataloader
+        from model.common import Model
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        config.cfg = copy.deepcopy(cfg)
+        config.cfg["model"]["pretrained"] = False  # The weights come from the snapshots
+        np.random.seed(0)  # Sample the same test data fraction as the trainer
+        _, test_dataloader = Dataloader(config=config).get_loader()
+        subset_dataloader = get_subset_dataloader(test_dataloader, subsample_fraction) if subsample_fraction else None
+        model = Model(config=config).get_model().to(device)
+        tester = tester_class(test_dataloader, loss_function, device)
+        while True:
+            try:
+                request = requests.get(timeout=5)
+            except queue.Empty:
+                if not mp.parent_process().is_alive():
+                    return
+                continue
+            if request is None:
+                return
+            epoch, full, state_dict = request
+            model.load_state_dict(state_dict)
+            results.put((epoch, full, tester.test(model, None if full else subset_dataloader)))
+    except Exception:
+        results.put((None, None, traceback.format_exc()))
+
+
+class AsyncValidator:
+    """
+    The class validates the model weight snapshots in a separate process, on its own cores, so that the training
+    continues during the validation. The results are collected with poll().
+    """
+    def __init__(self, cfg, tester_class, loss_function, device="cpu", num_threads=None, subsample_fraction=0,
+                 max_pending=2):
+        """
+        Constructor, the function starts the evaluator process.
+
+        :param cfg: The pipeline configuration (Configuration.cfg)
+        :param tester_class: The tester class used by the trainer (e.g. BaseTester, DCLTester)
+        :param loss_function: The loss function class of the tester
+        :param device: The execution device of the evaluator
+        :param num_threads: Number of threads used by the evaluator, torch default if None
+        :param subsample_fraction: Fraction of the test dataset evaluated by the fast passes
+        :param max_pending: Maximum number of snapshots waiting for the evaluator, submit() blocks beyond
+        """
+        context = mp.get_context("spawn")
+        self.requests = context.Queue(maxsize=max_pending)
+        self.results = context.Queue()
+        self.pending = 0  # Number of the submitted snapshots not yet reported back
+        # Not a daemon, the evaluator uses dataloader worker processes
+        self.process = context.Process(target=_evaluator_loop, name="async-validator",
+                                       args=(cfg, tester_class, loss_function, device, num_threads,
+                                             subsample_fraction, self.requests, self.results))
+        self.process.start()
+        atexit.register(self.terminate)  # Do not wait for the evaluator if the training exits early
+
+    def submit(self, epoch, state_dict, full=True):
+        """
+        The function sends a snapshot of the model weights to the evaluator.
+
+        :param epoch: The epoch of the weights
+        :param state_dict: Model's state dict of parameters
+        :param full: Either to evaluate the complete test dataset or the subset of the fast pass
+        """
+        self.requests.put((epoch, full, snapshot_state_dict(state_dict)))
+        self.pending += 1
+
+    def poll(self, block=False):
+        """
+        The function returns the results reported by the evaluator since the last call.
+
+        :param block: Either to wait for all the pending results or not
+        :return: List of (epoch, full, metrics)
+        """
+        results = []
+        while self.pending:
+            try:
+                epoch, full, metrics = self.results.get(timeout=1) if block else self.results.get_nowait()
+            except queue.Empty:
+                if not block:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError("The asynchronous validation process exited unexpectedly.")
+                continue
+            if epoch is None:
+                raise RuntimeError(f"The asynchronous validation failed:\n{metrics}")
+            self.pending -= 1
+            results.append((epoch, full, metrics))
+        return results
+
+    def close(self):
+        """
+        The function waits for all the pending results and stops the evaluator process.
+
+        :return: List of (epoch, full, metrics) not yet polled
+        """
+        results = self.poll(block=True)
+        self.requests.put(None)
+        self.process.join()
+        return results
+
+    def terminate(self):
+        """
+        The function stops the evaluator process immediately, the pending results are discarded.
+        """
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
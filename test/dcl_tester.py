@@ -1,5 +1,6 @@
 import torch
 import logging
+from utils.distributed import unwrap_model, all_reduce_sum
 from torch.autograd import Variable
 import numpy as np
 
@@ -22,13 +23,17 @@ class DCLTester:
         self.loss = loss_function()
         self.device = device
 
-    def test(self, model):
+    def test(self, model, dataloader=None):
         """
         The function implements the testing pipeline.
 
         :param model: The model to be used for the testing
+        :param dataloader: The dataloader to evaluate on (e.g. a subset for a fast pass), the test dataloader if None
         """
+        dataloader = dataloader if dataloader is not None else self.dataloader
         metrics = {}  # Dictionary to store the evaluation metrics
+        # Evaluate the local replica, the dataset shards of the processes may have different number of batches
+        model = unwrap_model(model)
         model.eval()  # Put the model in the evaluation mode
         with torch.no_grad():  # Require to continuously free the GPU memory after inference
             total_loss = 0  # Variable to store the running loss
@@ -36,7 +41,7 @@ class DCLTester:
             total_correct_predictions_top_2 = 0  # Variable to store the total top-1 correction predictions
             total_predictions = 0  # Variable to store the total predictions
             # Iterate over the dataset
-            for batch_idx, d in enumerate(self.dataloader):
+            for batch_idx, d in enumerate(dataloader):
                 inputs, labels = d  # Extract inputs and labels
                 # Move the data on the specified device
                 inputs = inputs.to(self.device)
@@ -51,7 +56,11 @@ class DCLTester:
                 total_correct_predictions_top_1 += batch_corrects_1
                 batch_corrects_2 = torch.sum((top_2_pos[:, 1] == labels)).data.item()
                 total_correct_predictions_top_2 += (batch_corrects_2 + batch_corrects_1)
-            metrics['loss'] = float(total_loss) / len(self.dataloader)
+            # Sum up the statistics of all the processes, if distributed
+            total_loss, total_batches, total_correct_predictions_top_1, total_correct_predictions_top_2, \
+                total_predictions = all_reduce_sum([total_loss, len(dataloader), total_correct_predictions_top_1,
+                                                    total_correct_predictions_top_2, total_predictions], self.device)
+            metrics['loss'] = float(total_loss) / total_batches
             metrics['accuracy_top_1'] = float(total_correct_predictions_top_1) / total_predictions
             metrics['accuracy_top_2'] = float(total_correct_predictions_top_2) / total_predictions
             logger.info(f"Validation loss: {metrics['loss']}, Top-1 Validation accuracy: {metrics['accuracy_top_1']}"
@@ -0,0 +1,53 @@
+import random
+
+AUX_TASK_MODES = ["every_n_steps", "decay"]  # The supported auxiliary task schedule modes
+
+
+class AuxTaskSchedule:
+    """
+    The class decides which optimization steps compute the auxiliary self-supervised task (rotation, PIRL or DCL
+    jigsaw), the other steps are classification only. The decision only depends on the epoch and the step, so that
+    the train sampler (which tells the dataset to skip the auxiliary inputs) and all the processes of a distributed
+    training agree on it, including after resuming.
+    """
+    def __init__(self, mode="every_n_steps", every_n_steps=1, initial_probability=1.0, decay=1.0,
+                 min_probability=0.0, seed=0):
+        """
+        Constructor, the function initializes the schedule parameters.
+
+        :param mode: 'every_n_steps' computes the auxiliary task every every_n_steps steps, 'decay' computes it with a
+        probability decaying every epoch
+        :param every_n_steps: The auxiliary task period in steps ('every_n_steps' mode)
+        :param initial_probability: The auxiliary task probability of the first epoch ('decay' mode)
+        :param decay: The probability decay factor per epoch ('decay' mode)
+        :param min_probability: The minimum auxiliary task probability ('decay' mode)
+        :param seed: Random seed of the 'decay' mode draws
+        """
+        self.mode = mode
+        self.every_n_steps = every_n_steps
+        self.initial_probability = initial_probability
+        self.decay = decay
+        self.min_probability = min_probability
+        self.seed = seed
+
+    def get_probability(self, epoch):
+        """
+        The function returns the probability of computing the auxiliary task during the epoch.
+
+        :param epoch: The epoch
+        """
+        if self.mode == "every_n_steps":
+            return 1 / self.every_n_steps
+        return max(self.initial_probability * self.decay ** (epoch - 1), self.min_probability)
+
+    def is_aux_step(self, epoch, step):
+        """
+        The function returns True if the step computes the auxiliary task.
+
+        :param epoch: The epoch
+        :param step: The step of the epoch (0 for the first batch)
+        """
+        if self.mode == "every_n_steps":
+            return step % self.every_n_steps == 0
+        # A string seed is hashed deterministically, i.e. the same draw in every process
+        return random.Random(f"{self.seed}-{epoch}-{step}").random() < self.get_probability(epoch)
@@ -1,6 +1,18 @@
+import sys
+import contextlib
+import time
 import torch
 from test.base_tester import BaseTester
+from test.async_validator import AsyncValidator
 from utils.util import save_model_checkpoints
+from utils.checkpoint import CheckpointManager
+from utils.distributed import wrap_model, unwrap_model, set_sampler_epoch, cleanup_distributed, is_main_process
+from utils.preemption import preemption_requested, save_preemption_snapshot, PREEMPTION_EXIT_CODE
+from dataloader.sampler import set_sampler_start_index, get_subset_dataloader
+from dataloader.resolution import get_resolution_scale, set_train_resolution
+from train.state import get_state_path, get_training_state, restore_training_state
+from train.freeze import get_frozen_stages, set_frozen_stages
+from train.selective_backprop import get_sample_losses, selection_pass
 import logging
 
 logger = logging.getLogger(f"train/base_trainer.py")
@@ -10,8 +22,22 @@ class BaseTrainer:
     """
     The class implements the base trainer pipeline.
     """
+    # Validation schedule, see set_validation_schedule()
+    validation_every_n_epochs = 1
+    validation_subsample_fraction = 0
+    validation_mode = "sync"
+    validation_config = None
+    validation_device = "cpu"
+    validation_threads = None
+    freeze_schedule = None  # Backbone stages frozen per epoch range, see set_freeze_schedule()
+    resolution_schedule = None  # Train resolution scale per epoch range, see set_resolution_schedule()
+    selective_backprop = None  # SelectiveBackprop (train/selective_backprop.py), see set_selective_backprop()
+    aux_task_schedule = None  # AuxTaskSchedule (train/aux_task_schedule.py), see set_aux_task_schedule()
+    flat_checkpoints = False  # Also write the flat checkpoints, see set_flat_checkpoints()
+
     def __init__(self, model, dataloader, loss_function, optimizer, epochs,
-                 lr_scheduler=None, val_dataloader=None, device="cuda", log_step=50, checkpoints_dir_path=None):
+                 lr_scheduler=None, val_dataloader=None, device="cuda", log_step=50, checkpoints_dir_path=None,
+                 keep_last_checkpoints=None, state_checkpoint_steps=None):
         """
         Constructor, the function initializes the training related parameters.
 
@@ -25,6 +51,8 @@ class BaseTrainer:
         :param device:  The execution device
         :param log_step:  # Logging step, after each log_step batches a log will be recorded
         :param checkpoints_dir_path:  # Checkpoints directory to save the model training progress and checkpoints
+        :param keep_last_checkpoints:  # Number of the latest epoch checkpoints to keep (all if None)
+        :param state_checkpoint_steps:  # Save the mid-epoch training state every state_checkpoint_steps steps
         """
         self.model = model
         self.dataloader = dataloader
@@ -35,7 +63,9 @@ class BaseTrainer:
         self.device = device
         self.log_step = log_step
         self.checkpoints_dir_path = checkpoints_dir_path
-        self.validator = BaseTester(val_dataloader, loss_function) if val_dataloader else None
+        self.keep_last_checkpoints = keep_last_checkpoints
+        self.state_checkpoint_steps = state_checkpoint_steps
+        self.validator = BaseTester(val_dataloader, loss_function, device) if val_dataloader else None
         self.metrics = {}
 
     def train_epoch(self, epoch):
@@ -45,48 +75,287 @@ class BaseTrainer:
         total_loss = 0
         total_predictions = 0
         total_correct_predictions = 0
+        selective = self.selective_backprop is not None and self.selective_backprop.is_active(epoch)
         self.model.train()
         for batch_idx, d in enumerate(self.dataloader):
             inputs, labels = d
             inputs = inputs.to(self.device)
             labels = labels.to(self.device)
-            outputs = self.model(inputs, train=True)
-            loss = self.loss(outputs, labels)
+            # The selection pass only computes the sample losses
+            with selection_pass(self.model) if selective else contextlib.nullcontext():
+                outputs = self.model(inputs, train=True)
+                loss = self.loss(outputs, labels)
             total_loss += loss
             _, preds = torch.max(outputs, 1)
             total_predictions += len(preds)
             total_correct_predictions += torch.sum(preds == labels.data)
+            if selective:
+                # Forward and backpropagate the selected samples only, as a smaller dense batch
+                index = self.selective_backprop.select(get_sample_losses(self.loss, outputs, labels))
+                loss = self.loss(self.model(inputs[index], train=True), labels[index])
             self.optimizer.zero_grad()
             loss.backward()
             self.optimizer.step()
+            self._after_step()
             if (batch_idx % self.log_step == 0) and (batch_idx != 0):
                 logger.info(
                     f"Train Epoch: {epoch}, Step, {batch_idx}/{len(self.dataloader)}, Loss: {total_loss / batch_idx}")
         self.metrics[epoch] = {}
         self.metrics[epoch]["train"] = {}
-        self.metrics[epoch]["train"]["loss"] = float(total_loss / batch_idx)
+        self.metrics[epoch]["train"]["loss"] = float(total_loss / (batch_idx + 1))
         self.metrics[epoch]["train"]["accuracy"] = float(total_correct_predictions) / float(total_predictions)
         logger.info(f"Epoch {epoch} loss: {self.metrics[epoch]['train']['loss']}, accuracy:, "
                     f"{self.metrics[epoch]['train']['accuracy']}")
 
-    def train_and_validate(self, start_epoch, end_epoch=None):
+    def train_and_validate(self, start_epoch, end_epoch=None, phase="main", resume_state=None):
         """
         The function implements the overall training pipeline.
 
         :param start_epoch: Start epoch number
         :param end_epoch: End epoch number
+        :param phase: The training phase ('warm_up' or 'main'), recorded in the training state
+        :param resume_state: The training state to resume from (see train/state.py), if any
         """
         self.model = self.model.to(self.device)  # Transfer the model to the execution device
-        best_accuracy = 0  # Variable to keep track of the best test accuracy to save the best model
+        self.phase = phase
+        self.best_accuracy = 0  # Variable to keep track of the best test accuracy to save the best model
+        resume_step = 0  # Number of the optimization steps of the resumed epoch already done
+        if resume_state is not None:
+            start_epoch, resume_step, self.best_accuracy = restore_training_state(self, resume_state)
+        if self.freeze_schedule:
+            # DistributedDataParallel only synchronizes the parameters requiring gradients when wrapping the model
+            set_frozen_stages(self.model, [], self.optimizer)
+        self.model = wrap_model(self.model, self.device)  # Synchronize the gradients across processes, if distributed
+        # Write the checkpoints in the background so that the training does not wait for the disk
+        self.checkpoint_manager = CheckpointManager(self.checkpoints_dir_path, keep_last=self.keep_last_checkpoints,
+                                                    flat=self.flat_checkpoints) if self.checkpoints_dir_path else None
+        # Validate in a separate process (main process only) or on a subset of the test dataset, if configured
+        self.async_validator = AsyncValidator(self.validation_config, type(self.validator), type(self.validator.loss),
+                                              self.validation_device, self.validation_threads,
+                                              self.validation_subsample_fraction) \
+            if self.validator and self.validation_mode == "async" and is_main_process() else None
+        self.subsample_dataloader = \
+            get_subset_dataloader(self.validator.dataloader, self.validation_subsample_fraction) \
+            if self.validator and self.validation_mode == "sync" and self.validation_subsample_fraction else None
+        last_epoch = end_epoch if end_epoch else self.epochs
         # Train and validate the model for (end_epoch - start_epoch)
-        for i in range(start_epoch, end_epoch + 1 if end_epoch else self.epochs + 1):
+        for i in range(start_epoch, last_epoch + 1):
+            set_sampler_epoch(self.dataloader, i)  # Reshuffle the distributed sampler differently every epoch
+            self.epoch = i
+            self.steps_per_epoch = len(self.dataloader)
+            self.step = resume_step
+            if resume_step:
+                # Skip the batches already seen before the interruption
+                set_sampler_start_index(self.dataloader, resume_step * self.dataloader.batch_size)
+                resume_step = 0
+            if self.resolution_schedule:
+                scale = get_resolution_scale(self.resolution_schedule, i)
+                set_train_resolution(self.dataloader, scale)
+                logger.info(f"Epoch {i} train resolution scale: {scale}")
+            if self.freeze_schedule:
+                frozen_stages = get_frozen_stages(self.freeze_schedule, i)
+                set_frozen_stages(unwrap_model(self.model), frozen_stages, self.optimizer)
+            start_step, start_time = self.step, time.perf_counter()
             self.train_epoch(i)
+            step_time = (time.perf_counter() - start_time) * 1000 / max(self.step - start_step, 1)  # Milliseconds
+            if self.freeze_schedule:
+                logger.info(f"Epoch {i} frozen backbone stages: {frozen_stages or None}, mean step time: "
+                            f"{step_time:.1f} ms")
+            if self.selective_backprop:
+                self._log_selective_backprop(i, step_time)
+            if self.aux_task_schedule:
+                logger.info(f"Epoch {i} auxiliary task steps: {self.metrics[i]['train'].get('aux_steps')}/"
+                            f"{self.step - start_step}, mean step time: {step_time:.1f} ms")
             if self.validator:
-                val_metrics = self.validator.test(self.model)
-                self.metrics[i]["val"] = {}
-                self.metrics[i]["val"] = val_metrics
-                # Save the checkpoints
-                best_accuracy = save_model_checkpoints(self.checkpoints_dir_path, i, self.model.state_dict(),
-                                                       self.metrics[i], best_accuracy)
+                # Validate the complete test dataset every validation_every_n_epochs epochs and after the last epoch
+                self.validate(i, full=(i % self.validation_every_n_epochs == 0 or i == last_epoch))
             if self.lr_scheduler:
                 self.lr_scheduler.step()
+            self.save_training_state(i + 1, 0)  # The epoch is complete, resume from the next one
+            if preemption_requested(self.device):
+                self._preempt(i + 1, 0)
+        if self.async_validator:
+            self._collect_validation_results(self.async_validator.close())  # Wait for the pending validations
+        if self.checkpoint_manager:
+            self.checkpoint_manager.close()  # Make sure all the checkpoints are on the disk
+
+    def set_validation_schedule(self, every_n_epochs=1, subsample_fraction=0, mode="sync", config=None, device="cpu",
+                                num_threads=None):
+        """
+        The function sets how and when the model is validated.
+
+        :param every_n_epochs: The complete test dataset is validated every every_n_epochs epochs (and after the last)
+        :param subsample_fraction: Fraction of the test dataset validated by a fast pass in the other epochs (0 to
+        skip the fast passes)
+        :param mode: 'sync' to validate in the training process, 'async' to validate weight snapshots in a separate
+        process while the training continues
+        :param config: The pipeline configuration (Configuration.cfg), required by the 'async' mode
+        :param device: The execution device of the asynchronous validation process
+        :param num_threads: Number of threads of the asynchronous validation process, torch default if None
+        """
+        self.validation_every_n_epochs = every_n_epochs
+        self.validation_subsample_fraction = subsample_fraction
+        self.validation_mode = mode
+        self.validation_config = config
+        self.validation_device = device
+        self.validation_threads = num_threads
+
+    def set_freeze_schedule(self, freeze_schedule):
+        """
+        The function sets the backbone stages frozen during the training (see train/freeze.py).
+
+        :param freeze_schedule: List of {'epochs': [first, last], 'stages': [...]} entries, the stages (conv1, layer1,
+        layer2, layer3, layer4) of each entry are frozen from its first to its last epoch (included)
+        """
+        self.freeze_schedule = freeze_schedule
+
+    def set_resolution_schedule(self, resolution_schedule):
+        """
+        The function sets the resolution of the train images per epoch range (see dataloader/resolution.py), e.g. to
+        train the early epochs at a lower resolution. The test images keep the configured resolution.
+
+        :param resolution_schedule: List of {'epochs': [first, last], 'scale': ...} entries, the resize and crop sizes
+        of the train transforms are scaled by the scale of the entry from its first to its last epoch (included)
+        """
+        self.resolution_schedule = resolution_schedule
+
+    def set_selective_backprop(self, selective_backprop):
+        """
+        The function enables the selective backpropagation of the high loss samples (see train/selective_backprop.py).
+
+        :param selective_backprop: The SelectiveBackprop object, None to backpropagate the full batches
+        """
+        self.selective_backprop = selective_backprop
+        self.full_batch_step_time = None  # Mean step time of the last epoch with the full batches
+
+    def set_aux_task_schedule(self, aux_task_schedule):
+        """
+        The function sets the steps computing the auxiliary self-supervised task, the other steps are classification
+        only (see train/aux_task_schedule.py). The trainers building the auxiliary inputs in the dataloader (PIRL,
+        DCL) follow the batches, whose auxiliary inputs are skipped by the train sampler (see
+        dataloader.sampler.set_sampler_aux_task_schedule()).
+
+        :param aux_task_schedule: The AuxTaskSchedule, None to compute the auxiliary task at every step
+        """
+        self.aux_task_schedule = aux_task_schedule
+
+    def set_flat_checkpoints(self, flat_checkpoints):
+        """
+        The function enables writing the model weights of the epoch checkpoints also as flat checkpoints
+        (epoch_<n>.safetensors, see utils.checkpoint.save_flat_state_dict()), which are memory-mapped at load time.
+
+        :param flat_checkpoints: Either to write the flat checkpoints or not
+        """
+        self.flat_checkpoints = flat_checkpoints
+
+    def _log_selective_backprop(self, epoch, step_time):
+        """
+        The function logs the fraction of the samples skipped by the selective backpropagation during the epoch and
+        the speedup of its mean step time with respect to the last epoch with the full batches, if any.
+
+        :param epoch: The epoch
+        :param step_time: Mean step time of the epoch in milliseconds
+        """
+        skip_rate = self.selective_backprop.reset()
+        if not self.selective_backprop.is_active(epoch):
+            self.full_batch_step_time = step_time
+            return
+        speedup = f"{self.full_batch_step_time / step_time:.2f}x" if self.full_batch_step_time else "unknown"
+        logger.info(f"Epoch {epoch} selective backpropagation skip rate: {skip_rate:.3f}, mean step time: "
+                    f"{step_time:.1f} ms, speedup over the full batches: {speedup}")
+
+    def validate(self, epoch, full=True):
+        """
+        The function validates the model after an epoch and saves the checkpoints. Only the complete validations are
+        used to select the best checkpoint.
+
+        :param epoch: Current epoch
+        :param full: Either to validate the complete test dataset or the subset of the fast pass
+        """
+        if self.validation_mode == "async":
+            # Save the checkpoint now, it becomes the best one once its validation metrics are reported
+            self.best_accuracy = save_model_checkpoints(self.checkpoints_dir_path, epoch,
+                                                        unwrap_model(self.model).state_dict(), self.metrics[epoch],
+                                                        self.best_accuracy, self.checkpoint_manager)
+            if self.async_validator and (full or self.validation_subsample_fraction):
+                if full and self.checkpoint_manager:
+                    self.checkpoint_manager.protect(epoch)
+                self.async_validator.submit(epoch, unwrap_model(self.model).state_dict(), full)
+            if self.async_validator:
+                self._collect_validation_results(self.async_validator.poll())
+            return
+        if full:
+            self.metrics[epoch]["val"] = self.validator.test(self.model)
+        elif self.subsample_dataloader:
+            self.metrics[epoch]["val_subsample"] = self.validator.test(self.model, self.subsample_dataloader)
+        # Save the checkpoints
+        self.best_accuracy = save_model_checkpoints(self.checkpoints_dir_path, epoch,
+                                                    unwrap_model(self.model).state_dict(), self.metrics[epoch],
+                                                    self.best_accuracy, self.checkpoint_manager)
+
+    def _collect_validation_results(self, results):
+        """
+        The function records the metrics reported by the asynchronous validation and updates the best checkpoint.
+
+        :param results: List of (epoch, full, metrics) returned by AsyncValidator.poll()
+        """
+        for epoch, full, metrics in results:
+            self.metrics[epoch]["val" if full else "val_subsample"] = metrics
+            if self.checkpoint_manager:
+                # The checkpoint was saved before its validation, its metrics file holds the validation metrics
+                self.checkpoint_manager.update_metrics(epoch, self.metrics[epoch])
+            logger.info(f"Epoch {epoch} {'' if full else 'fast '}validation loss: {metrics['loss']}, "
+                        f"Top-1 Validation accuracy: {metrics['accuracy_top_1']}, "
+                        f"Top-2 Validation accuracy: {metrics['accuracy_top_2']}")
+            if not full:
+                continue
+            if metrics["accuracy_top_1"] > self.best_accuracy:
+                self.best_accuracy = metrics["accuracy_top_1"]
+                logger.info(f"New best model at epoch {epoch}.")
+                if self.checkpoint_manager:
+                    self.checkpoint_manager.mark_best(epoch)
+            if self.checkpoint_manager:
+                self.checkpoint_manager.release(epoch)
+
+    def save_training_state(self, epoch, step):
+        """
+        The function saves the complete training state (model, optimizer, lr scheduler, random states, etc.) of the
+        current process, overwriting the previous one, so that the training can be resumed with main.py --resume.
+
+        :param epoch: The epoch to resume from
+        :param step: Number of the optimization steps of the epoch already done
+        """
+        if self.checkpoint_manager:
+            self.checkpoint_manager.save_state(get_state_path(self.checkpoints_dir_path),
+                                               get_training_state(self, self.phase, epoch, step, self.best_accuracy))
+
+    def _after_step(self):
+        """
+        The function is called by train_epoch after each optimization step. It saves the mid-epoch training state
+        every state_checkpoint_steps steps and stops the training if the preemption of the process is requested
+        (after the last step of the epoch the preemption is handled once the epoch is validated and saved).
+        """
+        self.step += 1
+        if self.step >= self.steps_per_epoch:
+            return
+        if self.state_checkpoint_steps and self.step % self.state_checkpoint_steps == 0:
+            self.save_training_state(self.epoch, self.step)
+        if preemption_requested(self.device, self.step):
+            self._preempt(self.epoch, self.step)
+
+    def _preempt(self, epoch, step):
+        """
+        The function writes the restart snapshot and exits the process with PREEMPTION_EXIT_CODE.
+
+        :param epoch: The epoch to resume from
+        :param step: Number of the optimization steps of the epoch already done
+        """
+        if self.async_validator:
+            self.async_validator.terminate()  # The pending validations are lost
+        if self.checkpoint_manager:
+            self.checkpoint_manager.close()  # The pending writes must not overwrite the snapshot
+            save_preemption_snapshot(get_training_state(self, self.phase, epoch, step, self.best_accuracy),
+                                     get_state_path(self.checkpoints_dir_path))
+        logger.warning(f"Training preempted at epoch {epoch}, step {step}. Resume it with main.py --resume.")
+        cleanup_distributed()
+        sys.exit(PREEMPTION_EXIT_CODE)
@@ -1,7 +1,13 @@
 import sys
-from utils.util import get_object_from_path
+from utils.util import get_object_from_path, ROTATION_MODES
 from torch.optim.lr_scheduler import StepLR as LRScheduler
-from memory.mem_bank import RGBMem
+from memory.mem_bank import RGBMem, ShardedRGBMem
+from train.optimizer import build_optimizer, DCL_LR_MULTIPLIERS
+from train.freeze import BACKBONE_STAGES
+from train.selective_backprop import SelectiveBackprop, SELECTION_MODES
+from train.aux_task_schedule import AuxTaskSchedule, AUX_TASK_MODES
+from dataloader.sampler import set_sampler_aux_task_schedule
+from utils.distributed import get_device, is_distributed
 import logging
 
 logger = logging.getLogger(f"train/common.py")
@@ -37,6 +43,67 @@ class Trainer:
             logger.info(f"Please provide correct trainer to use in configuration. "
                         f"Available options are ['base_trainer', 'ssl_rot_trainer', 'ssl_pirl_trainer', 'dcl_trainer']")
             sys.exit(1)
+        # Set the validation schedule
+        validation = config.cfg["train"].get("validation") or {}
+        if validation.get("mode", "sync") not in ["sync", "async"]:
+            logger.info(f"Please provide correct validation mode to use in configuration. Available options are "
+                        f"['sync', 'async']")
+            sys.exit(1)
+        self.trainer.set_validation_schedule(every_n_epochs=validation.get("every_n_epochs", 1),
+                                             subsample_fraction=validation.get("subsample_fraction", 0),
+                                             mode=validation.get("mode", "sync"), config=config.cfg,
+                                             device=validation.get("device", "cpu"),
+                                             num_threads=validation.get("num_threads"))
+        # Write the flat checkpoints (memory-mapped at load time)
+        self.trainer.set_flat_checkpoints(config.cfg["general"].get("flat_checkpoints", False))
+        # Set the backbone freezing schedule
+        freeze_schedule = config.cfg["train"].get("freeze_schedule") or []
+        for entry in freeze_schedule:
+            if not set(entry["stages"]).issubset(BACKBONE_STAGES):
+                logger.info(f"Please provide correct backbone stages to freeze in configuration. Available options are "
+                            f"{BACKBONE_STAGES}")
+                sys.exit(1)
+        self.trainer.set_freeze_schedule(freeze_schedule)
+        # Set the train resolution schedule
+        resolution_schedule = config.cfg["train"].get("resolution_schedule") or []
+        if any(entry["scale"] <= 0 for entry in resolution_schedule):
+            logger.info(f"Please provide positive train resolution scales in configuration.")
+            sys.exit(1)
+        self.trainer.set_resolution_schedule(resolution_schedule)
+        # Set the selective backpropagation
+        selective_backprop = config.cfg["train"].get("selective_backprop") or {}
+        if selective_backprop.get("mode"):
+            if selective_backprop["mode"] not in SELECTION_MODES:
+                logger.info(f"Please provide correct selective backpropagation mode to use in configuration. "
+                            f"Available options are {SELECTION_MODES}")
+                sys.exit(1)
+            if config.cfg["train"]["name"] == "ssl_pirl_trainer":
+                logger.warning(f"The selective backpropagation is not supported by the ssl_pirl_trainer, the full "
+                               f"batches are backpropagated.")
+            else:
+                self.trainer.set_selective_backprop(
+                    SelectiveBackprop(mode=selective_backprop["mode"],
+                                      fraction=selective_backprop.get("fraction", 0.5),
+                                      start_epoch=selective_backprop.get("start_epoch", 1)))
+        # Set the auxiliary task schedule
+        aux_task_schedule = config.cfg["train"].get("aux_task_schedule") or {}
+        if aux_task_schedule.get("mode"):
+            if aux_task_schedule["mode"] not in AUX_TASK_MODES:
+                logger.info(f"Please provide correct auxiliary task schedule mode to use in configuration. "
+                            f"Available options are {AUX_TASK_MODES}")
+                sys.exit(1)
+            if config.cfg["train"]["name"] == "base_trainer":
+                logger.warning(f"The base_trainer has no auxiliary task, the auxiliary task schedule is ignored.")
+            else:
+                schedule = AuxTaskSchedule(mode=aux_task_schedule["mode"],
+                                           every_n_steps=aux_task_schedule.get("every_n_steps", 1),
+                                           initial_probability=aux_task_schedule.get("initial_probability", 1.0),
+                                           decay=aux_task_schedule.get("decay", 1.0),
+                                           min_probability=aux_task_schedule.get("min_probability", 0.0))
+                self.trainer.set_aux_task_schedule(schedule)
+                if config.cfg["train"]["name"] in ["ssl_pirl_trainer", "dcl_trainer"]:
+                    # The auxiliary inputs are built by the dataset, skip them for the classification only steps
+                    set_sampler_aux_task_schedule(dataloader, schedule)
 
     @staticmethod
     def __get_base_trainer(config, model, dataloader, val_dataloader=None, warm_up=False):
@@ -57,25 +124,24 @@ class Trainer:
             loss_func = get_object_from_path(config["train"]["warm_up_loss_function_path"])
         else:
             loss_func = get_object_from_path(config["train"]["class_loss_function_path"])
-        optimizer_func = get_object_from_path(config["train"]["optimizer_path"])
+        optimizer_path = config["train"]["optimizer_path"]
         optimizer_param = config["train"]["optimizer_param"]
         epochs = config["train"]["epochs"]
+        device = get_device(config["train"].get("device", "cuda"))  # Execution device of the current process
         output_directory = config["general"]["output_directory"]
         experiment_id = config["general"]["experiment_id"]
         model_checkpoints_directory_name = config["general"]["model_checkpoints_directory_name"]
-        params = []
-        for key, value in dict(model.named_parameters()).items():
-            if value.requires_grad:
-                params += [{'params': [value]}]
-        optimizer = optimizer_func(params=params, lr=optimizer_param["lr"], momentum=optimizer_param["momentum"],
-                                   weight_decay=optimizer_param["weight_decay"])
+        keep_last_checkpoints = config["general"].get("keep_last_checkpoints")  # Keep all the checkpoints if None
+        state_checkpoint_steps = config["train"].get("state_checkpoint_steps")  # Mid-epoch training state frequency
+        optimizer = build_optimizer(model, optimizer_path, optimizer_param)
         lr_scheduler = LRScheduler(optimizer, step_size=config["train"]["lr_scheduler"]["step_size"],
                                    gamma=config["train"]["lr_scheduler"]["gamma"])
         # Create and return the trainer object
         return Trainer(model=model, dataloader=dataloader, loss_function=loss_func, optimizer=optimizer,
-                       epochs=epochs, lr_scheduler=lr_scheduler, val_dataloader=val_dataloader,
+                       epochs=epochs, lr_scheduler=lr_scheduler, val_dataloader=val_dataloader, device=device,
                        checkpoints_dir_path=f"{output_directory}/{experiment_id}/"
-                                            f"{model_checkpoints_directory_name}")
+                                            f"{model_checkpoints_directory_name}",
+                       keep_last_checkpoints=keep_last_checkpoints, state_checkpoint_steps=state_checkpoint_steps)
 
     @staticmethod
     def __get_ssl_rot_trainer(config, model, dataloader, val_dataloader=None, warm_up=False):
@@ -98,25 +164,31 @@ class Trainer:
             class_loss_func = get_object_from_path(config["train"]["class_loss_function_path"])
             rot_loss_func = get_object_from_path(config["train"]["rotation_loss_function_path"])
         rotation_loss_weight = config["train"]["rotation_loss_weight"]
-        optimizer_func = get_object_from_path(config["train"]["optimizer_path"])
+        rotation_mode = config["train"].get("rotation_mode") or "all"  # Rotated images batching
+        if rotation_mode not in ROTATION_MODES:
+            logger.info(f"Please provide correct rotation mode to use in configuration. Available options are "
+                        f"{ROTATION_MODES}")
+            sys.exit(1)
+        optimizer_path = config["train"]["optimizer_path"]
         optimizer_param = config["train"]["optimizer_param"]
         epochs = config["train"]["epochs"]
+        device = get_device(config["train"].get("device", "cuda"))  # Execution device of the current process
         output_directory = config["general"]["output_directory"]
         experiment_id = config["general"]["experiment_id"]
         model_checkpoints_directory_name = config["general"]["model_checkpoints_directory_name"]
-        params = []
-        for key, value in dict(model.named_parameters()).items():
-            if value.requires_grad:
-                params += [{'params': [value]}]
-        optimizer = optimizer_func(params=params, lr=optimizer_param["lr"], momentum=optimizer_param["momentum"],
-                                   weight_decay=optimizer_param["weight_decay"])
+        keep_last_checkpoints = config["general"].get("keep_last_checkpoints")  # Keep all the checkpoints if None
+        state_checkpoint_steps = config["train"].get("state_checkpoint_steps")  # Mid-epoch training state frequency
+        optimizer = build_optimizer(model, optimizer_path, optimizer_param)
         lr_scheduler = LRScheduler(optimizer, step_size=config["train"]["lr_scheduler"]["step_size"],
                                    gamma=config["train"]["lr_scheduler"]["gamma"])
         # Create and return the trainer object
         return Trainer(model=model, dataloader=dataloader, class_loss_function=class_loss_func,
                        rot_loss_function=rot_loss_func, rotation_loss_weight=rotation_loss_weight,
                        optimizer=optimizer, epochs=epochs, lr_scheduler=lr_scheduler, val_dataloader=val_dataloader,
-                       checkpoints_dir_path=f"{output_directory}/{experiment_id}/{model_checkpoints_directory_name}")
+                       device=device,
+                       checkpoints_dir_path=f"{output_directory}/{experiment_id}/{model_checkpoints_directory_name}",
+                       keep_last_checkpoints=keep_last_checkpoints, state_checkpoint_steps=state_checkpoint_steps,
+                       rotation_mode=rotation_mode)
 
     @staticmethod
     def __get_ssl_pirl_trainer(config, model, dataloader, val_dataloader=None, warm_up=False):
@@ -137,27 +209,31 @@ class Trainer:
             loss_func = get_object_from_path(config["train"]["warm_up_loss_function_path"])
         else:
             loss_func = get_object_from_path(config["train"]["class_loss_function_path"])
-        optimizer_func = get_object_from_path(config["train"]["optimizer_path"])
+        optimizer_path = config["train"]["optimizer_path"]
         optimizer_param = config["train"]["optimizer_param"]
         epochs = config["train"]["epochs"]
+        device = get_device(config["train"].get("device", "cuda"))  # Execution device of the current process
         output_directory = config["general"]["output_directory"]
         experiment_id = config["general"]["experiment_id"]
         model_checkpoints_directory_name = config["general"]["model_checkpoints_directory_name"]
-        params = []
-        for key, value in dict(model.named_parameters()).items():
-            if value.requires_grad:
-                params += [{'params': [value]}]
-        optimizer = optimizer_func(params=params, lr=optimizer_param["lr"], momentum=optimizer_param["momentum"],
-                                   weight_decay=optimizer_param["weight_decay"])
+        keep_last_checkpoints = config["general"].get("keep_last_checkpoints")  # Keep all the checkpoints if None
+        state_checkpoint_steps = config["train"].get("state_checkpoint_steps")  # Mid-epoch training state frequency
+        optimizer = build_optimizer(model, optimizer_path, optimizer_param)
         lr_scheduler = LRScheduler(optimizer, step_size=config["train"]["lr_scheduler"]["step_size"],
                                    gamma=config["train"]["lr_scheduler"]["gamma"])
-        # Create memory bank
-        memory = RGBMem(n_dim=128, n_data=len(dataloader) * dataloader.batch_size, K=2048)
+        # Create memory bank, one entry per train sample (the dataloader may only hold a shard if distributed)
+        shared_negatives = config["train"].get("shared_negatives", False)  # One draw of negatives per batch
+        if is_distributed() and config["train"].get("shard_memory_bank", False):
+            memory = ShardedRGBMem(n_dim=128, n_data=len(dataloader.dataset), K=2048,
+                                   shared_negatives=shared_negatives)
+        else:
+            memory = RGBMem(n_dim=128, n_data=len(dataloader.dataset), K=2048, shared_negatives=shared_negatives)
         # Create and return the trainer object
         return Trainer(model=model, dataloader=dataloader, loss_function=loss_func,
                        optimizer=optimizer, epochs=epochs, memory=memory, lr_scheduler=lr_scheduler,
-                       val_dataloader=val_dataloader, checkpoints_dir_path=f"{output_directory}/{experiment_id}/"
-                                                                           f"{model_checkpoints_directory_name}")
+                       val_dataloader=val_dataloader, device=device,
+                       checkpoints_dir_path=f"{output_directory}/{experiment_id}/{model_checkpoints_directory_name}",
+                       keep_last_checkpoints=keep_last_checkpoints, state_checkpoint_steps=state_checkpoint_steps)
 
     @staticmethod
     def __get_ssl_dcl_trainer(config, model, dataloader, val_dataloader=None, warm_up=False):
@@ -182,37 +258,25 @@ class Trainer:
         jigsaw_loss_func = get_object_from_path(config["train"]["jigsaw_loss_function_path"])
         use_adv = config["train"]["use_adv"]
         use_jigsaw = config["train"]["use_jigsaw"]
-        optimizer_func = get_object_from_path(config["train"]["optimizer_path"])
+        optimizer_path = config["train"]["optimizer_path"]
         optimizer_param = config["train"]["optimizer_param"]
         epochs = config["train"]["epochs"]
+        device = get_device(config["train"].get("device", "cuda"))  # Execution device of the current process
         output_directory = config["general"]["output_directory"]
         experiment_id = config["general"]["experiment_id"]
         model_checkpoints_directory_name = config["general"]["model_checkpoints_directory_name"]
-        params = []
-        for key, value in dict(model.named_parameters()).items():
-            if value.requires_grad:
-                params += [{'params': [value]}]
-        base_lr = optimizer_param["lr"]
-        momentum = optimizer_param["momentum"]
-        weight_decay = optimizer_param["weight_decay"]
-        ignored_params1 = list(map(id, model.cls_classifier.parameters()))
-        ignored_params2 = list(map(id, model.adv_classifier.parameters()))
-        ignored_params3 = list(map(id, model.conv_mask.parameters()))
-        ignored_params = ignored_params1 + ignored_params2 + ignored_params3
-        base_params = filter(lambda p: id(p) not in ignored_params, model.parameters())
-        optimizer = optimizer_func([{'params': base_params},
-                                    {'params': model.cls_classifier.parameters(), 'lr': 10 * base_lr},
-                                    {'params': model.adv_classifier.parameters(), 'lr': 10 * base_lr},
-                                    {'params': model.conv_mask.parameters(), 'lr': 10 * base_lr},
-                                    ], lr=base_lr, momentum=momentum, weight_decay=weight_decay)
+        keep_last_checkpoints = config["general"].get("keep_last_checkpoints")  # Keep all the checkpoints if None
+        state_checkpoint_steps = config["train"].get("state_checkpoint_steps")  # Mid-epoch training state frequency
+        optimizer = build_optimizer(model, optimizer_path, optimizer_param, lr_multipliers=DCL_LR_MULTIPLIERS)
         lr_scheduler = LRScheduler(optimizer, step_size=config["train"]["lr_scheduler"]["step_size"],
                                    gamma=config["train"]["lr_scheduler"]["gamma"])
         # Create and return the trainer object
         return Trainer(model=model, dataloader=dataloader, cls_loss_function=cls_loss_func,
                        adv_loss_function=adv_loss_func, jigsaw_loss_function=jigsaw_loss_func, use_adv=use_adv,
                        use_jigsaw=use_jigsaw, optimizer=optimizer, epochs=epochs, lr_scheduler=lr_scheduler,
-                       test_dataloader=val_dataloader, checkpoints_dir_path=f"{output_directory}/{experiment_id}/"
-                                                                            f"{model_checkpoints_directory_name}")
+                       test_dataloader=val_dataloader, device=device,
+                       checkpoints_dir_path=f"{output_directory}/{experiment_id}/{model_checkpoints_directory_name}",
+                       keep_last_checkpoints=keep_last_checkpoints, state_checkpoint_steps=state_checkpoint_steps)
 
     def get_trainer(self):
         """
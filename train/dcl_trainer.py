@@ -1,17 +1,20 @@
+import contextlib
 import torch
+from train.base_trainer import BaseTrainer
 from test.dcl_tester import DCLTester
 import logging
 from torch.autograd import Variable
 import numpy as np
-from utils.util import save_model_checkpoints
+from train.selective_backprop import get_sample_losses, selection_pass
 
 logger = logging.getLogger(f"train/dcl_trainer.py")
 
 
-class DCLTrainer:
+class DCLTrainer(BaseTrainer):
     def __init__(self, model, dataloader, cls_loss_function, adv_loss_function, jigsaw_loss_function, use_adv,
                  use_jigsaw, optimizer, epochs, lr_scheduler=None, test_dataloader=None, device="cuda", log_step=50,
-                 checkpoints_dir_path=None):
+                 checkpoints_dir_path=None, keep_last_checkpoints=None,
+                 state_checkpoint_steps=None):
         """
         Constructor, the function initializes the training related parameters.
 
@@ -29,6 +32,8 @@ class DCLTrainer:
         :param device:  The execution device
         :param log_step:  # Logging step, after each log_step batches a log will be recorded
         :param checkpoints_dir_path:  # Checkpoints directory to save the model training progress and checkpoints
+        :param keep_last_checkpoints:  # Number of the latest epoch checkpoints to keep (all if None)
+        :param state_checkpoint_steps:  # Save the mid-epoch training state every state_checkpoint_steps steps
         """
         self.model = model
         self.dataloader = dataloader
@@ -43,7 +48,9 @@ class DCLTrainer:
         self.device = device
         self.log_step = log_step
         self.checkpoints_dir_path = checkpoints_dir_path
-        self.validator = DCLTester(test_dataloader, cls_loss_function) if test_dataloader else None
+        self.keep_last_checkpoints = keep_last_checkpoints
+        self.state_checkpoint_steps = state_checkpoint_steps
+        self.validator = DCLTester(test_dataloader, cls_loss_function, device) if test_dataloader else None
         self.metrics = {}
 
     def train_epoch(self, epoch):
@@ -53,61 +60,86 @@ class DCLTrainer:
         total_loss = 0
         total_predictions = 0
         total_correct_predictions = 0
+        aux_steps = 0  # Number of the steps computing the adversarial and jigsaw tasks
+        selective = self.selective_backprop is not None and self.selective_backprop.is_active(epoch)
         self.model.train()
         for batch_idx, d in enumerate(self.dataloader):
             inputs, labels, labels_jigsaw, patch_labels = d
             inputs = inputs.to(self.device)
             labels = Variable(torch.from_numpy(np.array(labels))).to(self.device)
-            labels_jigsaw = Variable(torch.from_numpy(np.array(labels_jigsaw))).to(self.device)
-            patch_labels = Variable(torch.from_numpy(np.array(patch_labels))).float().to(self.device)
-            # Predicts CUB classes(N), Adversarial classes(2N) and jigsaw reconstructed locations(49)
-            cls_outputs, adv_outputs, jigsaw_mask_outputs = self.model(inputs, train=True)
-            cls_loss = self.cls_loss(cls_outputs, labels)
-            adv_loss = self.adv_loss(adv_outputs, labels_jigsaw)
-            # jigsaw reconstruct uses regression type with l1  or mse loss or class with bce loss
-            jigsaw_loss = self.jigsaw_loss(jigsaw_mask_outputs, patch_labels)
-            loss = cls_loss  # Adds CUB classification loss to total loss
-            if self.use_adv:
-                # Adds adversarial loss to total loss
-                loss += adv_loss
-            if self.use_jigsaw:
-                # Adds reconstruction loss to total loss
-                loss += jigsaw_loss
+            # The classification only steps of the auxiliary task schedule have no jigsaw images and labels
+            aux = labels_jigsaw is not None
+            if aux:
+                labels_jigsaw = Variable(torch.from_numpy(np.array(labels_jigsaw))).to(self.device)
+                patch_labels = Variable(torch.from_numpy(np.array(patch_labels))).float().to(self.device)
+                aux_steps += 1
+            # The selection pass only computes the sample losses
+            with selection_pass(self.model) if selective else contextlib.nullcontext():
+                # Predicts CUB classes(N), Adversarial classes(2N) and jigsaw reconstructed locations(49)
+                cls_outputs, adv_outputs, jigsaw_mask_outputs = self._forward(inputs, aux)
+                loss = self._get_loss(cls_outputs, adv_outputs, jigsaw_mask_outputs, labels, labels_jigsaw,
+                                      patch_labels)
             total_loss += loss
             _, preds = torch.max(cls_outputs, 1)
             total_predictions += len(preds)
             total_correct_predictions += torch.sum(preds == labels.data)
+            if selective:
+                # Forward and backpropagate the selected images (original or jigsaw) only, as a smaller dense batch
+                sample_losses = self._get_loss(cls_outputs, adv_outputs, jigsaw_mask_outputs, labels, labels_jigsaw,
+                                               patch_labels, get_sample_losses)
+                index = self.selective_backprop.select(sample_losses)
+                cls_outputs, adv_outputs, jigsaw_mask_outputs = self._forward(inputs[index], aux)
+                loss = self._get_loss(cls_outputs, adv_outputs, jigsaw_mask_outputs, labels[index],
+                                      labels_jigsaw[index] if aux else None, patch_labels[index] if aux else None)
             self.optimizer.zero_grad()
             loss.backward()
             self.optimizer.step()
+            self._after_step()
             if (batch_idx % self.log_step == 0) and (batch_idx != 0):
                 logger.info(
                     f"Train Epoch: {epoch}, Step, {batch_idx}/{len(self.dataloader)}, Loss: {total_loss / batch_idx}")
         self.metrics[epoch] = {}
         self.metrics[epoch]["train"] = {}
-        self.metrics[epoch]["train"]["loss"] = float(total_loss / batch_idx)
+        self.metrics[epoch]["train"]["loss"] = float(total_loss / (batch_idx + 1))
         self.metrics[epoch]["train"]["accuracy"] = float(total_correct_predictions) / float(total_predictions)
+        self.metrics[epoch]["train"]["aux_steps"] = aux_steps
         logger.info(f"Epoch {epoch} loss: {self.metrics[epoch]['train']['loss']}, accuracy:, "
                     f"{self.metrics[epoch]['train']['accuracy']}")
 
-    def train_and_validate(self, start_epoch, end_epoch=None):
+    def _forward(self, inputs, aux=True):
+        """
+        The function implements the forward pass of a training step.
+
+        :param inputs: The input images
+        :param aux: Either to compute the adversarial and jigsaw heads or not (classification only step)
+        :return: The classification, adversarial and jigsaw heads outputs (None if not computed)
         """
-        The function implements the overall training pipeline.
+        if aux:
+            return self.model(inputs, train=True)
+        return self.model(inputs, train=False), None, None
 
-        :param start_epoch: Start epoch number
-        :param end_epoch: End epoch number
+    def _get_loss(self, cls_outputs, adv_outputs, jigsaw_mask_outputs, labels, labels_jigsaw, patch_labels,
+                  reduce=None):
         """
-        self.model = self.model.to(self.device)  # Transfer the model to the execution device
-        best_accuracy = 0  # Variable to keep track of the best test accuracy to save the best model
-        # Train and validate the model for (end_epoch - start_epoch)
-        for i in range(start_epoch, end_epoch + 1 if end_epoch else self.epochs + 1):
-            self.train_epoch(i)
-            if self.validator:
-                val_metrics = self.validator.test(self.model)
-                self.metrics[i]["val"] = {}
-                self.metrics[i]["val"] = val_metrics
-                # Save the checkpoints
-                best_accuracy = save_model_checkpoints(self.checkpoints_dir_path, i, self.model.state_dict(),
-                                                       self.metrics[i], best_accuracy)
-            if self.lr_scheduler:
-                self.lr_scheduler.step()
+        The function computes the DCL loss, i.e. the classification loss plus the adversarial and the jigsaw
+        reconstruction losses if used (and computed by the step).
+
+        :param cls_outputs: The classification head outputs
+        :param adv_outputs: The adversarial head outputs
+        :param jigsaw_mask_outputs: The jigsaw reconstruction head outputs
+        :param labels: The class labels
+        :param labels_jigsaw: The adversarial labels, None for the classification only steps
+        :param patch_labels: The jigsaw patch labels, None for the classification only steps
+        :param reduce: Function (loss_function, outputs, targets) computing each loss, e.g. get_sample_losses for the
+        sample losses, the loss modules (batch mean) if None
+        """
+        reduce = reduce if reduce is not None else (lambda loss_function, outputs, targets:
+                                                    loss_function(outputs, targets))
+        loss = reduce(self.cls_loss, cls_outputs, labels)  # Adds CUB classification loss to total loss
+        if self.use_adv and labels_jigsaw is not None:
+            # Adds adversarial loss to total loss
+            loss = loss + reduce(self.adv_loss, adv_outputs, labels_jigsaw)
+        if self.use_jigsaw and patch_labels is not None:
+            # jigsaw reconstruct uses regression type with l1  or mse loss or class with bce loss
+            loss = loss + reduce(self.jigsaw_loss, jigsaw_mask_outputs, patch_labels)
+        return loss
@@ -0,0 +1,66 @@
+import torch.nn as nn
+import logging
+
+logger = logging.getLogger(f"train/freeze.py")
+
+# The ResNet backbone stages which can be frozen, in the order of the forward pass
+BACKBONE_STAGES = ["conv1", "layer1", "layer2", "layer3", "layer4"]
+# Indices of the stages in the nn.Sequential feature extractors built from the ResNet children
+SEQUENTIAL_STAGE_INDICES = {"conv1": [0, 1], "layer1": [4], "layer2": [5], "layer3": [6], "layer4": [7]}
+# Attribute names of the stages in a torchvision ResNet
+RESNET_STAGE_ATTRIBUTES = {"conv1": ["conv1", "bn1"], "layer1": ["layer1"], "layer2": ["layer2"],
+                           "layer3": ["layer3"], "layer4": ["layer4"]}
+
+
+def get_backbone_stages(model):
+    """
+    The function returns the modules of each backbone stage of the model, i.e. of the feature extractor of the SSL
+    models, of the CAM of FGVCResnet/FGVCSSLRotation and of the torchvision model of TorchVision.
+
+    :param model: The model (not wrapped by DistributedDataParallel)
+    :return: Dictionary of the stage name (see BACKBONE_STAGES) to its list of modules
+    """
+    if hasattr(model, "cam"):
+        model = model.cam
+    backbone = getattr(model, "feature_extractor", None)
+    if isinstance(backbone, nn.Sequential):
+        return {stage: [backbone[i] for i in indices] for stage, indices in SEQUENTIAL_STAGE_INDICES.items()}
+    return {stage: [getattr(model.model, name) for name in names] for stage, names in RESNET_STAGE_ATTRIBUTES.items()}
+
+
+def get_frozen_stages(freeze_schedule, epoch):
+    """
+    The function returns the backbone stages frozen during the epoch.
+
+    :param freeze_schedule: List of {'epochs': [first, last], 'stages': [...]} entries (train.freeze_schedule)
+    :param epoch: The epoch
+    :return: The frozen stages, in the order of BACKBONE_STAGES
+    """
+    stages = set()
+    for entry in freeze_schedule or []:
+        first, last = entry["epochs"]
+        if first <= epoch <= last:
+            stages.update(entry["stages"])
+    return [stage for stage in BACKBONE_STAGES if stage in stages]
+
+
+def set_frozen_stages(model, stages, optimizer=None):
+    """
+    The function freezes the given backbone stages and unfreezes the other ones. The frozen parameters do not require
+    gradients, so that the backward pass skips their gradient computation and the optimizer skips them (their
+    gradients are None). A frozen stage preceded only by frozen stages does not record the autograd graph at all,
+    i.e. it runs as under torch.no_grad().
+
+    :param model: The model (not wrapped by DistributedDataParallel)
+    :param stages: The stages to freeze (see BACKBONE_STAGES)
+    :param optimizer: The optimizer, the state (e.g. the momentum buffers) of the newly frozen parameters is released
+    """
+    for stage, modules in get_backbone_stages(model).items():
+        frozen = stage in stages
+        for module in modules:
+            for param in module.parameters():
+                if frozen and param.requires_grad:
+                    param.grad = None
+                    if optimizer is not None:
+                        optimizer.state.pop(param, None)
+                param.requires_grad = not frozen
@@ -0,0 +1,93 @@
+import inspect
+from utils.util import get_object_from_path
+import logging
+
+logger = logging.getLogger(f"train/optimizer.py")
+
+# Prefixes of the pretrained backbone parameters of the supported models (the remaining parameters are the heads)
+BACKBONE_PREFIXES = ["feature_extractor", "cam.feature_extractor", "model"]
+# Prefixes of the heads defined inside the backbone prefixes (e.g. the classification layer of TorchVision.model)
+HEAD_PREFIXES = ["model.fc"]
+# Optimizer parameters handled by the builder, the other ones are passed to the optimizer as is
+BUILDER_PARAMS = ["no_weight_decay_norm_bias", "implementation"]
+# The classification, adversarial and mask heads of DCL are trained with a 10x learning rate
+DCL_LR_MULTIPLIERS = {"cls_classifier": 10, "adv_classifier": 10, "conv_mask": 10}
+
+
+def _has_prefix(name, prefix):
+    return name == prefix or name.startswith(f"{prefix}.")
+
+
+def get_param_groups(model, lr, weight_decay, lr_multipliers=None, no_weight_decay_norm_bias=False):
+    """
+    The function splits the trainable parameters of the model into a few semantic parameter groups, so that the
+    multi-tensor (foreach/fused) optimizer implementations update each group with a few kernel launches:
+    'backbone' and 'heads', one group per prefix of lr_multipliers (e.g. the DCL heads trained with a 10x learning
+    rate), and their '_no_decay' counterparts holding the norm weights and the biases if no_weight_decay_norm_bias.
+
+    :param model: The model to train
+    :param lr: The base learning rate
+    :param weight_decay: The weight decay
+    :param lr_multipliers: Dictionary of parameter name prefix (e.g. 'cls_classifier') to learning rate multiplier
+    :param no_weight_decay_norm_bias: Either to exclude the norm weights and the biases from the weight decay or not
+    :return: List of the parameter groups (each with a 'name' key)
+    """
+    lr_multipliers = lr_multipliers or {}
+    groups = {}
+    for name, param in model.named_parameters():
+        if not param.requires_grad:
+            continue
+        group_name = next((prefix for prefix in lr_multipliers if _has_prefix(name, prefix)), None)
+        multiplier = lr_multipliers.get(group_name, 1)
+        if group_name is None:
+            backbone = any(_has_prefix(name, p) for p in BACKBONE_PREFIXES) and \
+                not any(_has_prefix(name, p) for p in HEAD_PREFIXES)
+            group_name = "backbone" if backbone else "heads"
+        # The norm weights and the biases are the only parameters with less than two dimensions
+        no_decay = no_weight_decay_norm_bias and param.ndim <= 1
+        if no_decay:
+            group_name = f"{group_name}_no_decay"
+        if group_name not in groups:
+            groups[group_name] = {"name": group_name, "params": [], "lr": lr * multiplier,
+                                  "weight_decay": 0 if no_decay else weight_decay}
+        groups[group_name]["params"].append(param)
+    return list(groups.values())
+
+
+def build_optimizer(model, optimizer_path, optimizer_param, lr_multipliers=None):
+    """
+    The function creates the optimizer of the model with semantic parameter groups (see get_param_groups()) and the
+    multi-tensor implementation of the optimizer, if available.
+
+    :param model: The model to train
+    :param optimizer_path: Complete optimizer class path (e.g. torch.optim.SGD)
+    :param optimizer_param: Optimizer parameters from the configuration (lr, momentum, weight_decay, etc.).
+    'no_weight_decay_norm_bias' excludes the norm weights and the biases from the weight decay and 'implementation'
+    selects the optimizer implementation, 'foreach' (default), 'fused' or 'for_loop'
+    :param lr_multipliers: Dictionary of parameter name prefix to learning rate multiplier
+    :return: The optimizer
+    """
+    optimizer_func = get_object_from_path(optimizer_path)
+    kwargs = {key: value for key, value in optimizer_param.items() if key not in BUILDER_PARAMS}
+    param_groups = get_param_groups(model, optimizer_param["lr"], optimizer_param.get("weight_decay", 0),
+                                    lr_multipliers, optimizer_param.get("no_weight_decay_norm_bias", False))
+    implementation = optimizer_param.get("implementation", "foreach")
+    supported = inspect.signature(optimizer_func).parameters
+    for name in ["fused", "foreach"]:
+        if name in supported:
+            kwargs[name] = False if implementation == "for_loop" else None
+    if implementation in supported:
+        kwargs[implementation] = True
+    try:
+        optimizer = optimizer_func(param_groups, **kwargs)
+    except (RuntimeError, ValueError) as e:
+        if implementation != "fused" or "foreach" not in supported:
+            raise
+        # The fused implementation is not available for the device/dtype of the parameters
+        logger.warning(f"Fused {optimizer_path} not available ({e}), using the foreach implementation.")
+        kwargs["fused"], kwargs["foreach"] = None, True
+        optimizer = optimizer_func(param_groups, **kwargs)
+    logger.info(f"Optimizer {optimizer_path.split('.')[-1]} ({implementation}) parameter groups: " +
+                ", ".join(f"{g['name']} ({len(g['params'])} tensors, lr {g['lr']}, weight decay {g['weight_decay']})"
+                          for g in param_groups))
+    return optimizer
@@ -0,0 +1,111 @@
+import math
+import contextlib
+import torch
+import torch.nn as nn
+from layers.diversification_block import DiversificationBlock
+import logging
+
+logger = logging.getLogger(f"train/selective_backprop.py")
+
+SELECTION_MODES = ["top_fraction", "loss_proportional"]  # The supported sample selection modes
+
+
+def get_sample_losses(loss_function, outputs, targets):
+    """
+    The function computes the loss of each sample of the batch with a loss module configured for the batch mean
+    (e.g. torch.nn.CrossEntropyLoss, torch.nn.BCELoss).
+
+    :param loss_function: The loss module
+    :param outputs: The model outputs
+    :param targets: The targets
+    :return: Tensor of the sample losses, the element losses are averaged per sample (e.g. for the jigsaw masks)
+    """
+    reduction = loss_function.reduction
+    loss_function.reduction = "none"
+    try:
+        losses = loss_function(outputs, targets)
+    finally:
+        loss_function.reduction = reduction
+    return losses.reshape(len(losses), -1).mean(dim=1)
+
+
+@contextlib.contextmanager
+def selection_pass(model):
+    """
+    The function returns the context of the selection forward pass: no gradients, the batch norm layers normalize
+    with the batch statistics as in the training pass but do not update their running statistics, and the
+    diversification blocks are bypassed. Only the training pass of the selected samples then updates the statistics
+    and draws the suppression masks.
+
+    :param model: The (possibly wrapped) model
+    """
+    norms = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    blocks = [m for m in model.modules() if isinstance(m, DiversificationBlock) and m.enabled]
+    for module in norms:
+        module.track_running_stats = False
+    for module in blocks:
+        module.enabled = False
+    try:
+        with torch.no_grad():
+            yield
+    finally:
+        for module in norms:
+            module.track_running_stats = True
+        for module in blocks:
+            module.enabled = True
+
+
+class SelectiveBackprop:
+    """
+    The class implements the selective backpropagation: the losses of the batch samples are computed by a forward
+    pass without gradients (see selection_pass()) and only a subset of the samples, biased towards the high loss ones,
+    is forwarded again and backpropagated as a smaller dense batch.
+    """
+    def __init__(self, mode="top_fraction", fraction=0.5, start_epoch=1):
+        """
+        Constructor, the function initializes the selection parameters.
+
+        :param mode: 'top_fraction' backpropagates the samples with the highest losses, 'loss_proportional' samples
+        them (without replacement) with probabilities proportional to their losses
+        :param fraction: Fraction of the batch samples to backpropagate
+        :param start_epoch: The first epoch with the selective backpropagation, the full batches are used before
+        """
+        self.mode = mode
+        self.fraction = fraction
+        self.start_epoch = start_epoch
+        self.selected_samples = 0  # Number of the backpropagated samples since the last reset()
+        self.total_samples = 0  # Number of the forwarded samples since the last reset()
+
+    def is_active(self, epoch):
+        """
+        The function returns True if the selective backpropagation is used during the epoch.
+
+        :param epoch: The epoch
+        """
+        return epoch >= self.start_epoch
+
+    def select(self, losses):
+        """
+        The function selects the samples to backpropagate.
+
+        :param losses: Tensor of the sample losses (without gradients)
+        :return: Tensor of the indices of the selected samples
+        """
+        count = min(max(math.ceil(self.fraction * len(losses)), 1), len(losses))
+        if self.mode == "top_fraction":
+            index = torch.topk(losses, count).indices
+        else:
+            weights = losses.float().clamp(min=0) + 1e-8  # Every sample can be selected
+            index = torch.multinomial(weights, count, replacement=False)
+        self.selected_samples += count
+        self.total_samples += len(losses)
+        return index
+
+    def reset(self):
+        """
+        The function resets the sample counters and returns the fraction of the samples skipped since the last reset.
+        """
+        skip_rate = 1 - self.selected_samples / self.total_samples if self.total_samples else 0
+        self.selected_samples = 0
+        self.total_samples = 0
+        return skip_rate
@@ -1,14 +1,16 @@
 import torch
+from train.base_trainer import BaseTrainer
 from test.base_tester import BaseTester
-from utils.util import save_model_checkpoints
+from utils.distributed import is_distributed, all_gather_tensor
 import logging
 
 logger = logging.getLogger(f"train/ssl_pirl_trainer.py")
 
 
-class SSLPIRLTrainer:
+class SSLPIRLTrainer(BaseTrainer):
     def __init__(self, model, dataloader, loss_function, optimizer, epochs, memory,
-                 lr_scheduler=None, val_dataloader=None, device="cuda", log_step=50, checkpoints_dir_path=None):
+                 lr_scheduler=None, val_dataloader=None, device="cuda", log_step=50, checkpoints_dir_path=None,
+                 keep_last_checkpoints=None, state_checkpoint_steps=None):
         """
         Constructor, the function initializes the training related parameters.
 
@@ -23,6 +25,8 @@ class SSLPIRLTrainer:
         :param device:  The execution device
         :param log_step:  # Logging step, after each log_step batches a log will be recorded
         :param checkpoints_dir_path:  # Checkpoints directory to save the model training progress and checkpoints
+        :param keep_last_checkpoints:  # Number of the latest epoch checkpoints to keep (all if None)
+        :param state_checkpoint_steps:  # Save the mid-epoch training state every state_checkpoint_steps steps
         """
         self.model = model
         self.dataloader = dataloader
@@ -33,8 +37,11 @@ class SSLPIRLTrainer:
         self.device = device
         self.log_step = log_step
         self.checkpoints_dir_path = checkpoints_dir_path
-        self.validator = BaseTester(val_dataloader, loss_function) if val_dataloader else None
+        self.keep_last_checkpoints = keep_last_checkpoints
+        self.state_checkpoint_steps = state_checkpoint_steps
+        self.validator = BaseTester(val_dataloader, loss_function, device) if val_dataloader else None
         self.memory = memory.to(self.device)
+        self.memory.broadcast()  # Start all the processes from the same memory bank
         self.metrics = {}
 
     @staticmethod
@@ -59,26 +66,40 @@ class SSLPIRLTrainer:
         total_loss = 0
         total_predictions = 0
         total_correct_predictions = 0
+        aux_steps = 0  # Number of the steps computing the PIRL task
         self.model.train()
         for batch_idx, d in enumerate(self.dataloader):
             o, _, x_jig, labels, index = d  # Parse the inputs
             # Transfer the data to GPU
             o = o.to(self.device)
-            x_jig = x_jig.to(self.device)
-            bsz, m, c, h, w = x_jig.shape
-            x_jig = x_jig.view(bsz * m, c, h, w)
             labels = labels.to(self.device)
             index = index.to(self.device)
-            # Generate predictions
-            classification_scores, representation, representation_jig = self.model(o, x_jig, train=True)
-            pirl_output = self.memory(representation, index, representation_jig)
-            # Compute loss
-            cls_loss = self.loss(classification_scores, labels)
-            pirl_losses = self._compute_pirl_loss(logits=pirl_output[:-1], target=pirl_output[-1], criterion=self.loss)
-            pirl_loss = (1 - 0.5) * pirl_losses[0] + 0.5 * pirl_losses[1]
-            loss = cls_loss + pirl_loss
+            if x_jig.numel() == 0:
+                # Classification only step of the auxiliary task schedule, the loader skipped the jigsaw crops and
+                # the memory bank is not updated
+                classification_scores = self.model(o, train=False)
+                loss = cls_loss = self.loss(classification_scores, labels)
+            else:
+                x_jig = x_jig.to(self.device)
+                bsz, m, c, h, w = x_jig.shape
+                x_jig = x_jig.view(bsz * m, c, h, w)
+                # Generate predictions
+                classification_scores, representation, representation_jig = self.model(o, x_jig, train=True)
+                if is_distributed():
+                    # Every process applies the same momentum update from the representations of all the processes
+                    pirl_output = self.memory(representation, index, representation_jig,
+                                              all_x=all_gather_tensor(representation), all_y=all_gather_tensor(index))
+                else:
+                    pirl_output = self.memory(representation, index, representation_jig)
+                # Compute loss
+                cls_loss = self.loss(classification_scores, labels)
+                pirl_losses = self._compute_pirl_loss(logits=pirl_output[:-1], target=pirl_output[-1],
+                                                      criterion=self.loss)
+                pirl_loss = (1 - 0.5) * pirl_losses[0] + 0.5 * pirl_losses[1]
+                loss = cls_loss + pirl_loss
+                total_loss_pirl += pirl_loss
+                aux_steps += 1
             total_loss_cls += cls_loss
-            total_loss_pirl += pirl_loss
             total_loss += loss
             # Calculate matrix
             _, preds = torch.max(classification_scores, 1)
@@ -88,36 +109,16 @@ class SSLPIRLTrainer:
             self.optimizer.zero_grad()
             loss.backward()
             self.optimizer.step()
+            self._after_step()
             if (batch_idx % self.log_step == 0) and (batch_idx != 0):
                 logger.info(
                     f"Train Epoch: {epoch}, Step, {batch_idx}/{len(self.dataloader)}, "
-                    f"Cls Loss: {total_loss_cls / batch_idx}, PIRL Loss: {total_loss_pirl / batch_idx}, "
+                    f"Cls Loss: {total_loss_cls / batch_idx}, PIRL Loss: {total_loss_pirl / max(aux_steps, 1)}, "
                     f"Combined Loss: {total_loss / batch_idx}")
         self.metrics[epoch] = {}
         self.metrics[epoch]["train"] = {}
-        self.metrics[epoch]["train"]["loss"] = float(total_loss / batch_idx)
+        self.metrics[epoch]["train"]["loss"] = float(total_loss / (batch_idx + 1))
         self.metrics[epoch]["train"]["accuracy"] = float(total_correct_predictions) / float(total_predictions)
+        self.metrics[epoch]["train"]["aux_steps"] = aux_steps
         logger.info(f"Epoch {epoch} loss: {self.metrics[epoch]['train']['loss']}, accuracy:, "
                     f"{self.metrics[epoch]['train']['accuracy']}")
-
-    def train_and_validate(self, start_epoch, end_epoch=None):
-        """
-        The function implements the overall training pipeline.
-
-        :param start_epoch: Start epoch number
-        :param end_epoch: End epoch number
-        """
-        self.model = self.model.to(self.device)  # Transfer the model to the execution device
-        best_accuracy = 0  # Variable to keep track of the best test accuracy to save the best model
-        # Train and validate the model for (end_epoch - start_epoch)
-        for i in range(start_epoch, end_epoch + 1 if end_epoch else self.epochs + 1):
-            self.train_epoch(i)
-            if self.validator:
-                val_metrics = self.validator.test(self.model)
-                self.metrics[i]["val"] = {}
-                self.metrics[i]["val"] = val_metrics
-                # Save the checkpoints
-                best_accuracy = save_model_checkpoints(self.checkpoints_dir_path, i, self.model.state_dict(),
-                                                       self.metrics[i], best_accuracy)
-            if self.lr_scheduler:
-                self.lr_scheduler.step()
@@ -1,15 +1,19 @@
 import torch
+import contextlib
+from train.base_trainer import BaseTrainer
 from test.base_tester import BaseTester
 import logging
-from utils.util import preprocess_input_data_rotation
-from utils.util import save_model_checkpoints
+from utils.util import get_rotation_batches
+from utils.distributed import no_gradient_sync
+from train.selective_backprop import get_sample_losses, selection_pass
 
 logger = logging.getLogger(f"train/ssl_rot_trainer.py")
 
 
-class SSLROTTrainer:
+class SSLROTTrainer(BaseTrainer):
     def __init__(self, model, dataloader, class_loss_function, rot_loss_function, rotation_loss_weight, optimizer,
-                 epochs, lr_scheduler=None, val_dataloader=None, device="cuda", log_step=50, checkpoints_dir_path=None):
+                 epochs, lr_scheduler=None, val_dataloader=None, device="cuda", log_step=50, checkpoints_dir_path=None,
+                 keep_last_checkpoints=None, state_checkpoint_steps=None, rotation_mode="all"):
         """
         Constructor, the function initializes the training related parameters.
 
@@ -25,6 +29,10 @@ class SSLROTTrainer:
         :param device:  The execution device
         :param log_step:  # Logging step, after each log_step batches a log will be recorded
         :param checkpoints_dir_path:  # Checkpoints directory to save the model training progress and checkpoints
+        :param keep_last_checkpoints:  # Number of the latest epoch checkpoints to keep (all if None)
+        :param state_checkpoint_steps:  # Save the mid-epoch training state every state_checkpoint_steps steps
+        :param rotation_mode:  # 'all' (4x batch), 'single' (random rotation per image) or 'accumulate' (four 1x
+        micro-batches with gradient accumulation)
         """
         self.model = model
         self.dataloader = dataloader
@@ -37,7 +45,10 @@ class SSLROTTrainer:
         self.device = device
         self.log_step = log_step
         self.checkpoints_dir_path = checkpoints_dir_path
-        self.validator = BaseTester(val_dataloader, class_loss_function) \
+        self.keep_last_checkpoints = keep_last_checkpoints
+        self.state_checkpoint_steps = state_checkpoint_steps
+        self.rotation_mode = rotation_mode
+        self.validator = BaseTester(val_dataloader, class_loss_function, device) \
             if val_dataloader else None
         self.metrics = {}
 
@@ -48,83 +59,101 @@ class SSLROTTrainer:
         total_cls_loss = 0
         total_rot_loss = 0
         total_loss = 0
+        aux_steps = 0  # Number of the steps computing the rotation task
         # allocating metric for classification
         total_predictions_head1 = 0
         total_correct_predictions_head1 = 0
         # allocation metric for rotation
         total_predictions_head2 = 0
         total_correct_predictions_head2 = 0
+        selective = self.selective_backprop is not None and self.selective_backprop.is_active(epoch)
         self.model.train()
         for batch_idx, d in enumerate(self.dataloader):
             inputs, labels = d
             inputs = inputs.to(self.device)
             labels = labels.to(self.device)
-            # Generates rotation augmented images and corresponding labels
-            # Augmented labels: Repeats of original class labels for each rotation of image
-            augmented_inputs, augmented_labels, rot_labels = preprocess_input_data_rotation(
-                inputs, labels, rotation=True)
-            class_outputs, rot_outputs = self.model(augmented_inputs, train=True)
+            aux = self.aux_task_schedule is None or self.aux_task_schedule.is_aux_step(epoch, self.step)
+            if aux:
+                # Generates rotation augmented images and corresponding labels
+                # Augmented labels: Repeats of original class labels for each rotation of image
+                batches = get_rotation_batches(inputs, labels, mode=self.rotation_mode)
+                batches_count = 4 if self.rotation_mode == "accumulate" else 1
+                aux_steps += 1
+            else:
+                # Classification only step, the rotated images are not built
+                batches, batches_count = [(inputs, labels, None)], 1
+            self.optimizer.zero_grad()
+            # The gradients of the micro-batches are accumulated, each loss is scaled to get the mean of the whole batch
+            for i, (augmented_inputs, augmented_labels, rot_labels) in enumerate(batches):
+                # Only the last micro-batch synchronizes the (accumulated) gradients, if distributed
+                with no_gradient_sync(self.model) if i < batches_count - 1 else contextlib.nullcontext():
+                    # The selection pass only computes the sample losses
+                    with selection_pass(self.model) if selective else contextlib.nullcontext():
+                        class_outputs, rot_outputs = self.model(augmented_inputs, train=True)
+                        loss = self._get_loss(class_outputs, rot_outputs, augmented_labels, rot_labels) / batches_count
+                    total_loss += loss.detach()
+                    total_cls_loss += self.class_loss(class_outputs, augmented_labels).detach() / batches_count
 
-            # Computing total loss from loss for classification head and rotation head
-            classification_loss = self.class_loss(class_outputs, augmented_labels)
-            total_cls_loss += classification_loss
-            rot_loss = self.rot_loss(rot_outputs, rot_labels)
-            total_rot_loss += rot_loss
-            # Limits contribution of rotation loss by rotation_loss_weight
-            loss = (1 - self.rotation_loss_weight) * classification_loss + self.rotation_loss_weight * rot_loss
-            total_loss += loss
+                    # Metrics for classification head - head1
+                    _, preds_head1 = torch.max(class_outputs, 1)
+                    total_predictions_head1 += len(preds_head1)
+                    total_correct_predictions_head1 += torch.sum(preds_head1 == augmented_labels.data)
+                    if aux:
+                        total_rot_loss += self.rot_loss(rot_outputs, rot_labels).detach() / batches_count
+                        # Metrics for rotation head - head2
+                        _, preds_head2 = torch.max(rot_outputs, 1)
+                        total_predictions_head2 += len(preds_head2)
+                        total_correct_predictions_head2 += torch.sum(preds_head2 == rot_labels.data)
 
-            # Metrics for classification head - head1
-            _, preds_head1 = torch.max(class_outputs, 1)
-            total_predictions_head1 += len(preds_head1)
-            total_correct_predictions_head1 += torch.sum(preds_head1 == augmented_labels.data)
-            # Metrics for rotation head - head2
-            _, preds_head2 = torch.max(rot_outputs, 1)
-            total_predictions_head2 += len(preds_head2)
-            total_correct_predictions_head2 += torch.sum(preds_head2 == rot_labels.data)
+                    if selective:
+                        # Forward and backpropagate the selected (rotated) images only, as a smaller dense batch
+                        index = self.selective_backprop.select(
+                            self._get_loss(class_outputs, rot_outputs, augmented_labels, rot_labels, get_sample_losses))
+                        class_outputs, rot_outputs = self.model(augmented_inputs[index], train=True)
+                        loss = self._get_loss(class_outputs, rot_outputs, augmented_labels[index],
+                                              rot_labels[index] if aux else None) / batches_count
 
+                    loss.backward()
             # optimization
-            self.optimizer.zero_grad()
-            loss.backward()
             self.optimizer.step()
+            self._after_step()
             if (batch_idx % self.log_step == 0) and (batch_idx != 0):
                 logger.info(
                     f"Train Epoch: {epoch}, Step, {batch_idx}/{len(self.dataloader)}, "
-                    f"Cls Loss: {total_cls_loss / batch_idx}, Rot Loss: {total_rot_loss / batch_idx} "
+                    f"Cls Loss: {total_cls_loss / batch_idx}, Rot Loss: {total_rot_loss / max(aux_steps, 1)} "
                     f"Total Loss: {total_loss / batch_idx}")
         self.metrics[epoch] = {}
         self.metrics[epoch]["train"] = {}
-        self.metrics[epoch]["train"]["loss"] = float(total_loss / batch_idx)
-        self.metrics[epoch]["train"]["cls_loss"] = float(total_cls_loss / batch_idx)
-        self.metrics[epoch]["train"]["rot_loss"] = float(total_rot_loss / batch_idx)
+        self.metrics[epoch]["train"]["loss"] = float(total_loss / (batch_idx + 1))
+        self.metrics[epoch]["train"]["cls_loss"] = float(total_cls_loss / (batch_idx + 1))
+        self.metrics[epoch]["train"]["rot_loss"] = float(total_rot_loss / max(aux_steps, 1))
         self.metrics[epoch]["train"]["class_accuracy"] = float(
             total_correct_predictions_head1) / float(total_predictions_head1)
         self.metrics[epoch]["train"]["rot_accuracy"] = float(
-            total_correct_predictions_head2) / float(total_predictions_head2)
+            total_correct_predictions_head2) / float(max(total_predictions_head2, 1))
+        self.metrics[epoch]["train"]["aux_steps"] = aux_steps
         logger.info(f"Epoch {epoch} cls loss: {self.metrics[epoch]['train']['cls_loss']}, "
                     f"Epoch {epoch} rot loss: {self.metrics[epoch]['train']['rot_loss']}, "
                     f"Epoch {epoch} loss: {self.metrics[epoch]['train']['loss']}, "
                     f"class_accuracy:{self.metrics[epoch]['train']['class_accuracy']} "
                     f"rot_accuracy:{self.metrics[epoch]['train']['rot_accuracy']}")
 
-    def train_and_validate(self, start_epoch, end_epoch=None):
+    def _get_loss(self, class_outputs, rot_outputs, labels, rot_labels=None, reduce=None):
         """
-        The function implements the overall training pipeline.
+        The function computes the weighted sum of the classification and the rotation losses, the classification loss
+        only (with the same weight) for the classification only steps.
 
-        :param start_epoch: Start epoch number
-        :param end_epoch: End epoch number
+        :param class_outputs: The classification head outputs
+        :param rot_outputs: The rotation head outputs
+        :param labels: The class labels
+        :param rot_labels: The rotation labels, None for the classification only steps
+        :param reduce: Function (loss_function, outputs, targets) computing each loss, e.g. get_sample_losses for the
+        sample losses, the loss modules (batch mean) if None
         """
-        self.model = self.model.to(self.device)  # Transfer the model to the execution device
-        best_accuracy = 0  # Variable to keep track of the best test accuracy to save the best model
-        # Train and validate the model for (end_epoch - start_epoch)
-        for i in range(start_epoch, end_epoch + 1 if end_epoch else self.epochs + 1):
-            self.train_epoch(i)
-            if self.validator:
-                val_metrics = self.validator.test(self.model)
-                self.metrics[i]["val"] = {}
-                self.metrics[i]["val"] = val_metrics
-                # Save the checkpoints
-                best_accuracy = save_model_checkpoints(self.checkpoints_dir_path, i, self.model.state_dict(),
-                                                       self.metrics[i], best_accuracy)
-            if self.lr_scheduler:
-                self.lr_scheduler.step()
+        reduce = reduce if reduce is not None else (lambda loss_function, outputs, targets:
+                                                    loss_function(outputs, targets))
+        # Limits contribution of rotation loss by rotation_loss_weight
+        loss = (1 - self.rotation_loss_weight) * reduce(self.class_loss, class_outputs, labels)
+        if rot_labels is not None:
+            loss = loss + self.rotation_loss_weight * reduce(self.rot_loss, rot_outputs, rot_labels)
+        return loss
@@ -0,0 +1,109 @@
+import os
+import random
+import numpy as np
+import torch
+from utils.distributed import unwrap_model, get_rank, get_world_size
+import logging
+
+logger = logging.getLogger(f"train/state.py")
+
+
+def get_state_path(checkpoints_dir_path):
+    """
+    The function returns the path of the training state file of the current process. Each process of a distributed
+    run has its own state file, as the random states (and the sharded memory bank) differ across the processes.
+
+    :param checkpoints_dir_path: Checkpoints directory path
+    """
+    if get_world_size() > 1:
+        return f"{checkpoints_dir_path}/last_state_rank_{get_rank()}.pth"
+    return f"{checkpoints_dir_path}/last_state.pth"
+
+
+def get_rng_state():
+    """
+    The function returns the states of all the random number generators used during the training.
+    """
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(rng_state):
+    """
+    The function restores the states of all the random number generators used during the training.
+
+    :param rng_state: The states returned by get_rng_state()
+    """
+    random.setstate(rng_state["python"])
+    np.random.set_state(rng_state["numpy"])
+    torch.set_rng_state(rng_state["torch"].cpu())
+    if rng_state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in rng_state["cuda"]])
+
+
+def get_training_state(trainer, phase, epoch, step, best_accuracy):
+    """
+    The function collects the complete training state required to resume the training.
+
+    :param trainer: The trainer (e.g. BaseTrainer, SSLPIRLTrainer)
+    :param phase: The training phase, 'warm_up' or 'main'
+    :param epoch: The epoch to resume from
+    :param step: Number of the optimization steps of the epoch already done (0 to start the epoch from scratch)
+    :param best_accuracy: Best validation accuracy of the phase so far
+    """
+    memory = getattr(trainer, "memory", None)  # The memory bank of the PIRL trainer
+    return {
+        "phase": phase,
+        "epoch": epoch,
+        "step": step,
+        "world_size": get_world_size(),
+        "best_accuracy": best_accuracy,
+        "metrics": trainer.metrics,
+        "model": unwrap_model(trainer.model).state_dict(),
+        "optimizer": trainer.optimizer.state_dict(),
+        "lr_scheduler": trainer.lr_scheduler.state_dict() if trainer.lr_scheduler else None,
+        "memory": memory.state_dict() if memory is not None else None,
+        "rng": get_rng_state(),
+    }
+
+
+def load_training_state(checkpoints_dir_path):
+    """
+    The function loads the training state of the current process saved in the checkpoints directory.
+
+    :param checkpoints_dir_path: Checkpoints directory path
+    :return: The training state, None if no state has been saved yet
+    """
+    path = get_state_path(checkpoints_dir_path)
+    if not os.path.exists(path):
+        return None
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    if state["world_size"] != get_world_size():
+        raise RuntimeError(f"The training state was saved by {state['world_size']} processes, "
+                           f"it can not be resumed by {get_world_size()} processes.")
+    logger.info(f"Resuming the {state['phase']} phase from epoch {state['epoch']}, step {state['step']}.")
+    return state
+
+
+def restore_training_state(trainer, state):
+    """
+    The function restores the training state into the trainer. The model must already be on its execution device.
+
+    :param trainer: The trainer (e.g. BaseTrainer, SSLPIRLTrainer)
+    :param state: The training state returned by load_training_state()
+    :return: The epoch, the step and the best accuracy to resume from
+    """
+    unwrap_model(trainer.model).load_state_dict(state["model"])
+    trainer.optimizer.load_state_dict(state["optimizer"])
+    if trainer.lr_scheduler and state["lr_scheduler"] is not None:
+        trainer.lr_scheduler.load_state_dict(state["lr_scheduler"])
+    memory = getattr(trainer, "memory", None)
+    if memory is not None and state["memory"] is not None:
+        memory.load_state_dict(state["memory"])
+    trainer.metrics = state["metrics"]
+    set_rng_state(state["rng"])
+    return state["epoch"], state["step"], state["best_accuracy"]
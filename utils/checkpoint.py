@@ -0,0 +1,391 @@
+import os
+import re
+import copy
+import json
+import struct
+import hashlib
+import shutil
+import queue
+import threading
+import numpy as np
+import torch
+import logging
+
+logger = logging.getLogger(f"utils/checkpoint.py")
+
+FLAT_CHECKPOINT_EXTENSION = ".safetensors"  # The flat checkpoints written next to the .pth checkpoints, if enabled
+METRICS_EXTENSION = ".metrics.json"  # The metrics known after the checkpoint was written (e.g. async validation)
+# The dtype names of the flat (safetensors) format
+FLAT_DTYPES = {torch.float64: "F64", torch.float32: "F32", torch.float16: "F16", torch.bfloat16: "BF16",
+               torch.int64: "I64", torch.int32: "I32", torch.int16: "I16", torch.int8: "I8", torch.uint8: "U8",
+               torch.bool: "BOOL"}
+
+
+def save_flat_state_dict(path, state_dict, metadata=None):
+    """
+    The function writes a state dict of tensors in the flat safetensors format (https://github.com/huggingface/
+    safetensors): the length of the JSON header, the header (dtype, shape and byte range of each tensor) and the raw
+    tensor data. The file can be memory-mapped without unpickling, see load_flat_state_dict(). Tensors sharing the
+    same storage and view (e.g. the parameters of TorchvisionSSLRotation.model and .feature_extractor) are written
+    once, the other names are recorded as aliases in the metadata of the header.
+
+    :param path: Path of the flat checkpoint
+    :param state_dict: The state dict (the tensors are copied to the host memory if required)
+    :param metadata: Dictionary of strings stored in the header, if any
+    """
+    names, aliases, views = [], {}, {}
+    for name, tensor in state_dict.items():
+        view = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tensor.stride(),
+                tensor.dtype)
+        if tensor.numel() and view in views:
+            aliases[name] = views[view]
+        else:
+            views[view] = name
+            names.append(name)
+    # The larger elements first, so that every tensor is aligned on its element size in the file
+    names = sorted(names, key=lambda name: -state_dict[name].element_size())
+    header, offset = {}, 0
+    for name in names:
+        size = state_dict[name].numel() * state_dict[name].element_size()
+        header[name] = {"dtype": FLAT_DTYPES[state_dict[name].dtype], "shape": list(state_dict[name].shape),
+                        "data_offsets": [offset, offset + size]}
+        offset += size
+    metadata = {key: str(value) for key, value in (metadata or {}).items()}
+    if aliases:
+        metadata["aliases"] = json.dumps(aliases)
+    if metadata:
+        header["__metadata__"] = metadata
+    header = json.dumps(header).encode()
+    header += b" " * (-len(header) % 8)  # The tensor data starts on an 8 bytes boundary
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name in names:
+            tensor = state_dict[name].detach().to("cpu").contiguous()
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() else b"")
+    os.replace(f"{path}.tmp", path)
+
+
+def load_flat_state_dict(path):
+    """
+    The function memory-maps a flat checkpoint (see save_flat_state_dict()), the tensors are read from the file on
+    first access and the file pages are shared with the page cache instead of being copied at load time.
+
+    :param path: Path of the flat checkpoint
+    :return: The state dict of CPU tensors (copy-on-write views of the file, the aliased names share their tensor)
+    and the metadata of the header
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", {})
+    dtypes = {name: dtype for dtype, name in FLAT_DTYPES.items()}
+    # Copy-on-write mapping, the tensors can be modified without modifying the file
+    data = torch.from_numpy(np.memmap(path, dtype=np.uint8, mode="c", offset=8 + header_size)) \
+        if os.path.getsize(path) > 8 + header_size else torch.empty(0, dtype=torch.uint8)
+    state_dict = {}
+    for name, entry in header.items():
+        start, end = entry["data_offsets"]
+        dtype = dtypes[entry["dtype"]]
+        tensor = data[start:end]
+        if (data.data_ptr() + start) % torch.empty(0, dtype=dtype).element_size():
+            tensor = tensor.clone()  # Unaligned tensor (file written by another writer), copied
+        state_dict[name] = tensor.view(dtype).reshape(entry["shape"])
+    # The aliased names share the tensor of the written name
+    for name, target in json.loads(metadata.pop("aliases", "{}")).items():
+        state_dict[name] = state_dict[target]
+    return state_dict, metadata
+
+
+def get_file_hash(path, chunk_size=1 << 20):
+    """
+    The function returns the SHA-256 hash of the file content.
+
+    :param path: The file path
+    :param chunk_size: Size of the chunks read at once
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_flat_checkpoint_path(checkpoints_path):
+    """
+    The function returns the path of the flat checkpoint written next to a .pth checkpoint.
+
+    :param checkpoints_path: Path of the .pth checkpoint
+    """
+    return f"{os.path.splitext(checkpoints_path)[0]}{FLAT_CHECKPOINT_EXTENSION}"
+
+
+def get_metrics_path(checkpoints_path):
+    """
+    The function returns the path of the metrics file written next to a checkpoint once its asynchronous validation
+    metrics are known (see CheckpointManager.update_metrics()).
+
+    :param checkpoints_path: Path of the .pth or flat checkpoint
+    """
+    return f"{os.path.splitext(checkpoints_path)[0]}{METRICS_EXTENSION}"
+
+
+def load_checkpoint_metrics(checkpoints_path):
+    """
+    The function returns the metrics of a training checkpoint, the metrics file written next to the checkpoint (if
+    any) takes precedence over the metrics stored in the checkpoint when it was written.
+
+    :param checkpoints_path: Path of the .pth or flat checkpoint
+    :return: The metrics, None if the checkpoint holds no metrics (e.g. a state dict)
+    """
+    metrics_path = get_metrics_path(checkpoints_path)
+    if os.path.exists(metrics_path):
+        with open(metrics_path) as f:
+            return json.load(f)
+    if checkpoints_path.endswith(FLAT_CHECKPOINT_EXTENSION):
+        metrics = load_flat_state_dict(checkpoints_path)[1].get("metrics")
+        return json.loads(metrics) if metrics is not None else None
+    checkpoint = torch.load(checkpoints_path, map_location="cpu", mmap=True, weights_only=False)
+    return checkpoint.get("metrics")
+
+
+def load_checkpoint_state_dict(checkpoints_path):
+    """
+    The function loads the state dict of a model checkpoint without copying the tensors to memory: a flat checkpoint
+    (.safetensors) is memory-mapped, and the tensor storages of a .pth checkpoint (torch.save zip format) are
+    memory-mapped while only the small pickled structure is deserialized.
+
+    :param checkpoints_path: Path of the checkpoint, a training checkpoint ({'state_dict': ...}), a state dict or a
+    flat checkpoint
+    :return: The state dict of CPU tensors
+    """
+    if checkpoints_path.endswith(FLAT_CHECKPOINT_EXTENSION):
+        return load_flat_state_dict(checkpoints_path)[0]
+    checkpoint = torch.load(checkpoints_path, map_location="cpu", mmap=True, weights_only=True)
+    return checkpoint["state_dict"] if "state_dict" in checkpoint else checkpoint
+
+
+def snapshot_state_dict(state_dict, copies=None):
+    """
+    The function copies the tensors of a state dict (possibly nested, e.g. an optimizer state dict) to the host
+    memory. Tensors sharing the same storage (e.g. the parameters of aliased modules such as
+    TorchvisionSSLRotation.model and TorchvisionSSLRotation.feature_extractor) are copied once and keep sharing the
+    storage, so that they are serialized only once by torch.save.
+
+    :param state_dict: The state dict (possibly on the GPU)
+    :param copies: Copies of the already visited tensors, keyed by their storage location and view
+    :return: The state dict on the host memory, detached from the training tensors
+    """
+    copies = {} if copies is None else copies
+    if torch.is_tensor(state_dict):
+        view = (state_dict.untyped_storage().data_ptr(), state_dict.storage_offset(), tuple(state_dict.shape),
+                state_dict.stride(), state_dict.dtype)
+        if view not in copies:
+            copies[view] = state_dict.detach().to("cpu", copy=True)
+        return copies[view]
+    if isinstance(state_dict, dict):
+        return type(state_dict)((key, snapshot_state_dict(value, copies)) for key, value in state_dict.items())
+    if isinstance(state_dict, (list, tuple)):
+        return type(state_dict)(snapshot_state_dict(value, copies) for value in state_dict)
+    return state_dict
+
+
+class CheckpointManager:
+    """
+    The class writes the training checkpoints on a background thread so that the training does not stall on disk I/O.
+    Only the last N epoch checkpoints are kept, the best checkpoint is a hard link to (or a copy of, if the file
+    system does not support links) the corresponding epoch checkpoint instead of being serialized a second time.
+    """
+    def __init__(self, checkpoints_dir_path, keep_last=None, best_file_name="best_checkpoints.pth", max_pending=2,
+                 flat=False):
+        """
+        Constructor, the function initializes the manager and starts the writer thread.
+
+        :param checkpoints_dir_path: Checkpoints directory path
+        :param keep_last: Number of the latest epoch checkpoints to keep, all the checkpoints are kept if None or 0
+        :param best_file_name: File name of the best checkpoint
+        :param max_pending: Maximum number of snapshots waiting to be written, bounds the extra host memory
+        :param flat: If True, the model weights are also written as flat checkpoints (see save_flat_state_dict())
+        """
+        self.checkpoints_dir_path = checkpoints_dir_path
+        self.keep_last = keep_last
+        self.flat = flat
+        self.best_file_name = best_file_name
+        self.error = None  # Exception raised by the writer thread, re-raised on the training thread
+        self.protected = set()  # Epochs whose checkpoints are not removed by the retention (e.g. pending validation)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._worker, name="checkpoint-writer", daemon=True)
+        self.thread.start()
+
+    def save(self, epoch, state_dict, metrics, is_best=False):
+        """
+        The function snapshots the state dict to the host memory and queues it for writing.
+
+        :param epoch: Current epoch
+        :param state_dict: Model's state dict of parameters
+        :param metrics: The metrics of the epoch
+        :param is_best: Either the checkpoint is the new best checkpoint or not
+        """
+        self._raise_error()
+        checkpoint = {
+            "epoch": epoch,
+            "metrics": metrics,
+            'state_dict': snapshot_state_dict(state_dict),
+        }
+        self.queue.put((self._write, (epoch, checkpoint, is_best)))
+
+    def save_state(self, path, state):
+        """
+        The function snapshots the training state (see train/state.py) to the host memory and queues it for writing.
+        The state file is overwritten at each call.
+
+        :param path: Path of the state file
+        :param state: The training state
+        """
+        self._raise_error()
+        self.queue.put((self._write_state, (path, snapshot_state_dict(state))))
+
+    def protect(self, epoch):
+        """
+        The function protects the checkpoint of the epoch from the retention until release() is called, e.g. while
+        its validation is pending.
+
+        :param epoch: The epoch
+        """
+        self.protected.add(epoch)
+
+    def release(self, epoch):
+        """
+        The function removes the retention protection of the checkpoint of the epoch.
+
+        :param epoch: The epoch
+        """
+        self._raise_error()
+        self.queue.put((self._release, (epoch,)))
+
+    def mark_best(self, epoch):
+        """
+        The function makes the already saved checkpoint of the epoch the best checkpoint, e.g. once its validation
+        metrics are known.
+
+        :param epoch: The epoch
+        """
+        self._raise_error()
+        self.queue.put((self._link_best, (f"{self.checkpoints_dir_path}/epoch_{epoch}.pth",)))
+
+    def update_metrics(self, epoch, metrics):
+        """
+        The function writes the metrics of the already saved checkpoint of the epoch to a metrics file next to it
+        (epoch_<n>.metrics.json), e.g. once its asynchronous validation metrics are known, without writing the
+        checkpoint again. The file takes precedence over the metrics of the checkpoint (see load_checkpoint_metrics()).
+        The checkpoints removed by the retention in the meantime are skipped.
+
+        :param epoch: The epoch
+        :param metrics: The metrics of the epoch
+        """
+        self._raise_error()
+        self.queue.put((self._update_metrics, (epoch, copy.deepcopy(metrics))))
+
+    def wait(self):
+        """
+        The function blocks until all the queued checkpoints are written.
+        """
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        The function writes the queued checkpoints and stops the writer thread.
+        """
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f"Failed to write the checkpoints to {self.checkpoints_dir_path}.") from error
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                write, args = item
+                write(*args)
+            except Exception as e:
+                logger.error(f"Failed to write the checkpoint: {e}")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, epoch, checkpoint, is_best):
+        path = f"{self.checkpoints_dir_path}/epoch_{epoch}.pth"
+        # Write to a temporary file first so that a checkpoint is never left half written
+        torch.save(checkpoint, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        if self.flat:
+            save_flat_state_dict(get_flat_checkpoint_path(path), checkpoint["state_dict"],
+                                 {"epoch": epoch, "metrics": json.dumps(checkpoint["metrics"], default=str)})
+        if is_best:
+            self._link_best(path)
+        self._apply_retention()
+
+    def _update_metrics(self, epoch, metrics):
+        path = f"{self.checkpoints_dir_path}/epoch_{epoch}.pth"
+        if not os.path.exists(path):
+            return
+        metrics_path = get_metrics_path(path)
+        with open(f"{metrics_path}.tmp", "w") as f:
+            json.dump(metrics, f, default=str)
+        os.replace(f"{metrics_path}.tmp", metrics_path)
+
+    @staticmethod
+    def _write_state(path, state):
+        torch.save(state, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+    def _link_best(self, path):
+        best_path = f"{self.checkpoints_dir_path}/{self.best_file_name}"
+        self._link(path, best_path)
+        if self.flat:
+            self._link(get_flat_checkpoint_path(path), get_flat_checkpoint_path(best_path))
+        # The metrics file of the previous best checkpoint must not be merged with the new one
+        if os.path.exists(get_metrics_path(path)):
+            self._link(get_metrics_path(path), get_metrics_path(best_path))
+        elif os.path.exists(get_metrics_path(best_path)):
+            os.remove(get_metrics_path(best_path))
+
+    @staticmethod
+    def _link(path, best_path):
+        if os.path.exists(f"{best_path}.tmp"):
+            os.remove(f"{best_path}.tmp")
+        try:
+            os.link(path, f"{best_path}.tmp")
+        except OSError:
+            shutil.copyfile(path, f"{best_path}.tmp")  # File system without hard links
+        os.replace(f"{best_path}.tmp", best_path)
+
+    def _release(self, epoch):
+        self.protected.discard(epoch)
+        self._apply_retention()
+
+    def _apply_retention(self):
+        if not self.keep_last:
+            return
+        epochs = []
+        for file_name in os.listdir(self.checkpoints_dir_path):
+            match = re.fullmatch(r"epoch_(\d+)\.pth", file_name)
+            if match:
+                epochs.append(int(match.group(1)))
+        # The best checkpoint is a separate link, removing its epoch checkpoint does not remove it
+        for epoch in sorted(epochs)[:-self.keep_last]:
+            if epoch in self.protected:
+                continue
+            path = f"{self.checkpoints_dir_path}/epoch_{epoch}.pth"
+            os.remove(path)
+            for extra_path in (get_flat_checkpoint_path(path), get_metrics_path(path)):
+                if os.path.exists(extra_path):
+                    os.remove(extra_path)
@@ -0,0 +1,222 @@
+import os
+import contextlib
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+import logging
+
+logger = logging.getLogger(f"utils/distributed.py")
+
+
+def init_distributed(device="cuda", backend=None):
+    """
+    The function initializes the default process group from the environment variables set by torchrun
+    (WORLD_SIZE, RANK, LOCAL_RANK, MASTER_ADDR and MASTER_PORT). Nothing is done for a single process run.
+
+    :param device: The execution device specified in the configuration ('cuda', 'cpu')
+    :param backend: The process group backend, by default 'nccl' for 'cuda' and 'gloo' for 'cpu'
+    :return: The execution device of the current process (e.g. 'cuda:1' for the local rank 1)
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size <= 1 or is_distributed():
+        return get_device(device)
+    if backend is None:
+        backend = "nccl" if device.startswith("cuda") else "gloo"
+    if device.startswith("cuda"):
+        # Each process owns exactly one GPU, selected by its local rank
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+    dist.init_process_group(backend=backend, init_method="env://")
+    logger.info(f"Initialized the process group ({backend}) for rank {get_rank()}/{get_world_size()}.")
+    return get_device(device)
+
+
+def cleanup_distributed():
+    """
+    The function destroys the default process group if initialized.
+    """
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    """
+    The function returns True if the default process group is initialized.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    """
+    The function returns the global rank of the current process (0 for a single process run).
+    """
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    """
+    The function returns the number of processes participating in the training (1 for a single process run).
+    """
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """
+    The function returns True for the process responsible for logging and saving the checkpoints (rank 0).
+    """
+    return get_rank() == 0
+
+
+def get_device(device="cuda"):
+    """
+    The function returns the execution device of the current process. Under distributed CUDA training
+    each process is pinned to the GPU specified by its local rank.
+
+    :param device: The execution device specified in the configuration ('cuda', 'cpu')
+    """
+    if device == "cuda" and is_distributed():
+        return f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}"
+    return device
+
+
+def barrier():
+    """
+    The function synchronizes all the processes, no-op for a single process run.
+    """
+    if is_distributed():
+        dist.barrier()
+
+
+def wrap_model(model, device):
+    """
+    The function wraps the model with DistributedDataParallel for gradient synchronization across the processes.
+    The model is returned as is for a single process run or if it is already wrapped.
+
+    :param model: The model placed on the execution device
+    :param device: The execution device of the current process
+    """
+    if not is_distributed() or isinstance(model, DistributedDataParallel):
+        return model
+    device_ids = [torch.device(device).index] if str(device).startswith("cuda") else None
+    # The auxiliary heads (e.g. DCL jigsaw classifier, unused torchvision fc) do not receive gradients every step
+    return DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=True)
+
+
+def unwrap_model(model):
+    """
+    The function returns the underlying model from the DistributedDataParallel wrapper.
+
+    :param model: The (possibly wrapped) model
+    """
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def no_gradient_sync(model):
+    """
+    The function returns a context skipping the gradient synchronization of the backward passes, e.g. for the
+    gradient accumulation micro-batches but the last one (the accumulated gradients are synchronized by the backward
+    pass of the last micro-batch).
+
+    :param model: The (possibly wrapped) model
+    """
+    return model.no_sync() if isinstance(model, DistributedDataParallel) else contextlib.nullcontext()
+
+
+def all_reduce_sum(values, device="cpu"):
+    """
+    The function sums a list of scalar values across all the processes.
+
+    :param values: List of python numbers or scalar tensors
+    :param device: The device used for the communication ('cuda' for nccl, 'cpu' for gloo)
+    :return: List of the reduced python floats
+    """
+    values = [float(v) for v in values]
+    if not is_distributed():
+        return values
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def all_gather_tensor(tensor):
+    """
+    The function gathers a tensor from all the processes and concatenates the results along the first dimension.
+    The tensors may differ in the size of the first dimension (e.g. the last batch of an epoch). The result is
+    detached, i.e. no gradients flow back through the gathered tensor.
+
+    :param tensor: The tensor on the execution device of the current process
+    :return: The concatenation of the tensors of all the processes ordered by rank
+    """
+    tensor = tensor.detach()
+    if not is_distributed():
+        return tensor
+    world_size = get_world_size()
+    # Exchange the sizes first, all_gather requires equally shaped tensors
+    size = torch.tensor([tensor.size(0)], dtype=torch.long, device=tensor.device)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    dist.all_gather(sizes, size)
+    sizes = [int(s.item()) for s in sizes]
+    max_size = max(sizes)
+    padded = tensor.new_zeros((max_size,) + tuple(tensor.shape[1:]))
+    padded[:tensor.size(0)] = tensor
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded.contiguous())
+    return torch.cat([g[:s] for g, s in zip(gathered, sizes)], dim=0)
+
+
+def all_to_all_tensor(tensor, send_counts, recv_counts=None):
+    """
+    The function sends consecutive chunks of the first dimension of the tensor to the processes (the first
+    send_counts[0] rows to rank 0, the next send_counts[1] rows to rank 1, etc.) and returns the chunks received from
+    all the processes, concatenated by rank. Every row is only sent to its destination process.
+
+    :param tensor: The tensor on the execution device of the current process
+    :param send_counts: List of the numbers of rows sent to each process
+    :param recv_counts: List of the numbers of rows received from each process, exchanged first if None
+    :return: The received tensor and the list of the numbers of rows received from each process
+    """
+    if not is_distributed():
+        return tensor, list(send_counts)
+    if recv_counts is None:
+        counts = torch.tensor(send_counts, dtype=torch.long, device=tensor.device)
+        received = torch.empty_like(counts)
+        dist.all_to_all_single(received, counts)
+        recv_counts = received.tolist()
+    output = tensor.new_empty((sum(recv_counts),) + tuple(tensor.shape[1:]))
+    dist.all_to_all_single(output, tensor.contiguous(), recv_counts, list(send_counts))
+    return output, recv_counts
+
+
+def broadcast_tensor(tensor, src=0):
+    """
+    The function overwrites the tensor of all the processes in-place with the tensor of the source process.
+
+    :param tensor: The tensor on the execution device of the current process
+    :param src: Rank of the source process
+    """
+    if is_distributed():
+        dist.broadcast(tensor, src=src)
+    return tensor
+
+
+def all_reduce_tensor(tensor):
+    """
+    The function sums a tensor in-place across all the processes.
+
+    :param tensor: The tensor on the execution device of the current process
+    """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def set_sampler_epoch(dataloader, epoch):
+    """
+    The function sets the epoch of the dataloader sampler (if supported) so that each epoch uses a different,
+    yet consistent across processes, shuffling of the dataset.
+
+    :param dataloader: The dataloader
+    :param epoch: The current epoch
+    """
+    sampler = getattr(dataloader, "sampler", None)
+    if hasattr(sampler, "set_epoch"):
+        sampler.set_epoch(epoch)
@@ -0,0 +1,127 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+STORE_FILES = ["logits.npy", "labels.npy", "image_ids.npy"]  # The memory-mapped arrays of a store entry
+
+
+def get_store_key(checkpoint_hash, split, data_config):
+    """
+    The function returns the key of the stored logits of a checkpoint on a dataset split with a data configuration.
+
+    :param checkpoint_hash: The hash of the checkpoint file (see get_file_hash())
+    :param split: The dataset split (e.g. 'test')
+    :param data_config: The configuration defining the evaluated images and their transforms (e.g. the dataloader
+    name, resize dimensions, data fraction and test transforms)
+    """
+    content = json.dumps({"checkpoint": checkpoint_hash, "split": split, "data": data_config}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+class LogitStore:
+    """
+    The class implements a directory of memory-mapped per image logits, labels and image ids, one entry per key
+    (see get_store_key()), so that metrics can be computed again without running the models. The rows of an entry
+    are written in the dataset order, possibly by several processes (e.g. the evaluation shards).
+    """
+    def __init__(self, directory):
+        """
+        Constructor, the function creates the store directory if required.
+
+        :param directory: The store directory path
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, key, name=""):
+        """
+        The function returns the path of the entry directory, or of one of its files.
+
+        :param key: The entry key
+        :param name: The file name (e.g. 'logits.npy'), the entry directory if empty
+        """
+        return os.path.join(self.directory, key, name)
+
+    def get_meta(self, key):
+        """
+        The function returns the metadata of the entry, None if the entry does not exist.
+
+        :param key: The entry key
+        """
+        path = self.get_path(key, "meta.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def is_complete(self, key):
+        """
+        The function returns True if all the rows of the entry have been written.
+
+        :param key: The entry key
+        """
+        meta = self.get_meta(key)
+        return meta is not None and meta.get("complete", False)
+
+    def create(self, key, count, num_classes, meta):
+        """
+        The function creates (or overwrites) the entry arrays, the rows are written with write().
+
+        :param key: The entry key
+        :param count: Number of the images
+        :param num_classes: Number of the classes
+        :param meta: Dictionary of the metadata of the entry (e.g. checkpoint path and data configuration)
+        """
+        os.makedirs(self.get_path(key), exist_ok=True)
+        shapes = {"logits.npy": ((count, num_classes), np.float32), "labels.npy": ((count,), np.int64),
+                  "image_ids.npy": ((count,), np.int64)}
+        for name, (shape, dtype) in shapes.items():
+            np.lib.format.open_memmap(self.get_path(key, name), mode="w+", dtype=dtype, shape=shape).flush()
+        self._write_meta(key, dict(meta, count=count, num_classes=num_classes, complete=False))
+
+    def write(self, key, index, logits, labels, image_ids):
+        """
+        The function writes rows of the entry, the processes writing disjoint rows can write concurrently.
+
+        :param key: The entry key
+        :param index: The row indices (dataset positions)
+        :param logits: The logits (len(index), num_classes)
+        :param labels: The labels
+        :param image_ids: The image ids
+        """
+        for name, values in zip(STORE_FILES, [logits, labels, image_ids]):
+            array = np.load(self.get_path(key, name), mmap_mode="r+")
+            array[index] = values
+            array.flush()
+
+    def set_complete(self, key):
+        """
+        The function marks the entry as complete, i.e. usable by load().
+
+        :param key: The entry key
+        """
+        self._write_meta(key, dict(self.get_meta(key), complete=True))
+
+    def load(self, key):
+        """
+        The function returns the memory-mapped arrays of the entry.
+
+        :param key: The entry key
+        :return: logits (count, num_classes), labels and image ids, read-only memory maps
+        """
+        return tuple(np.load(self.get_path(key, name), mmap_mode="r") for name in STORE_FILES)
+
+    def list(self):
+        """
+        The function returns the keys and the metadata of the complete entries, sorted by checkpoint path.
+        """
+        entries = [(key, self.get_meta(key)) for key in os.listdir(self.directory)
+                   if os.path.isdir(self.get_path(key)) and self.is_complete(key)]
+        return sorted(entries, key=lambda entry: (entry[1].get("checkpoints_path", ""), entry[0]))
+
+    def _write_meta(self, key, meta):
+        path = self.get_path(key, "meta.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(f"{path}.tmp", path)  # Atomic, a reader never sees a partial file
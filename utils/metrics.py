@@ -0,0 +1,98 @@
+import torch
+
+
+class StreamingMetrics:
+    """
+    The class accumulates the classification metrics (loss, top-k accuracies and confusion matrix) of a stream of
+    batches on the device of the model outputs, without synchronizing with the host at each batch. The accumulated
+    states of several instances (e.g. of the evaluation shards) can be merged.
+    """
+    def __init__(self, num_classes, top_k=(1, 2), device="cpu"):
+        """
+        Constructor, the function initializes the metric states.
+
+        :param num_classes: Number of classes
+        :param top_k: The k values of the top-k accuracies
+        :param device: The device of the metric states (the device of the model outputs)
+        """
+        self.num_classes = num_classes
+        self.top_k = sorted(set(top_k))
+        self.device = device
+        self.confusion_matrix = torch.zeros(num_classes, num_classes, dtype=torch.long, device=device)
+        self.top_k_correct = torch.zeros(len(self.top_k), dtype=torch.long, device=device)
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=device)  # Sum of the sample losses
+        self.count = torch.zeros((), dtype=torch.long, device=device)  # Number of the samples
+
+    def update(self, outputs, labels, loss=None):
+        """
+        The function accumulates the metrics of a batch.
+
+        :param outputs: The class scores (b, num_classes)
+        :param labels: The labels (b)
+        :param loss: The mean loss of the batch, if any
+        """
+        labels = labels.to(outputs.device).long()
+        max_k = min(self.top_k[-1], self.num_classes)
+        # Number of the hits within the first j predictions, for each j
+        top_k_hits = (outputs.topk(max_k, dim=1).indices == labels.unsqueeze(1)).cumsum(dim=1)
+        k_index = torch.tensor([min(k, max_k) - 1 for k in self.top_k], device=outputs.device)
+        self.top_k_correct += top_k_hits[:, k_index].sum(dim=0)
+        self.confusion_matrix += torch.bincount(labels * self.num_classes + outputs.argmax(dim=1),
+                                                minlength=self.num_classes ** 2).view(self.num_classes, -1)
+        if loss is not None:
+            self.loss_sum += loss.detach().double() * len(labels)
+        self.count += len(labels)
+
+    def state_dict(self):
+        """
+        The function returns the metric states on the CPU, e.g. to send them to another process.
+        """
+        return {"confusion_matrix": self.confusion_matrix.cpu(), "top_k_correct": self.top_k_correct.cpu(),
+                "loss_sum": self.loss_sum.cpu(), "count": self.count.cpu()}
+
+    def merge(self, state_dict):
+        """
+        The function adds the metric states of another instance (see state_dict()).
+
+        :param state_dict: The metric states to add (tensors or numpy arrays)
+        """
+        self.confusion_matrix += torch.as_tensor(state_dict["confusion_matrix"], device=self.device)
+        self.top_k_correct += torch.as_tensor(state_dict["top_k_correct"], device=self.device)
+        self.loss_sum += torch.as_tensor(state_dict["loss_sum"], device=self.device)
+        self.count += torch.as_tensor(state_dict["count"], device=self.device)
+
+    def compute(self):
+        """
+        The function returns the metrics accumulated so far.
+
+        :return: Dictionary of the loss (mean sample loss), the top-k accuracies ('accuracy_top_<k>'), the mean
+        class accuracy, the per class accuracies and the confusion matrix (rows: labels, columns: predictions)
+        """
+        count = max(int(self.count), 1)
+        class_counts = self.confusion_matrix.sum(dim=1)
+        per_class_accuracy = self.confusion_matrix.diagonal().double() / class_counts.clamp(min=1)
+        metrics = {"count": int(self.count), "loss": float(self.loss_sum) / count}
+        for k, correct in zip(self.top_k, self.top_k_correct.tolist()):
+            metrics[f"accuracy_top_{k}"] = correct / count
+        metrics["mean_class_accuracy"] = float(per_class_accuracy[class_counts > 0].mean()) \
+            if bool((class_counts > 0).any()) else 0.0
+        metrics["per_class_accuracy"] = per_class_accuracy.tolist()
+        metrics["confusion_matrix"] = self.confusion_matrix.tolist()
+        return metrics
+
+
+def expected_calibration_error(probabilities, labels, bins=15):
+    """
+    The function returns the expected calibration error, i.e. the mean absolute difference between the confidence and
+    the accuracy of the predictions grouped in equal width confidence bins, weighted by the bin sizes.
+
+    :param probabilities: The class probabilities (n, num_classes)
+    :param labels: The labels (n)
+    :param bins: Number of the confidence bins
+    """
+    confidences, predictions = probabilities.max(dim=1)
+    correct = (predictions == labels.to(predictions.device)).double()
+    bin_index = (confidences.double() * bins).long().clamp(max=bins - 1)
+    confidence_sums = torch.bincount(bin_index, weights=confidences.double(), minlength=bins)
+    correct_sums = torch.bincount(bin_index, weights=correct, minlength=bins)
+    return float((confidence_sums - correct_sums).abs().sum() / max(len(labels), 1))
@@ -0,0 +1,82 @@
+import os
+import signal
+import shutil
+import tempfile
+import torch
+from utils.distributed import is_distributed, all_reduce_sum
+import logging
+
+logger = logging.getLogger(f"utils/preemption.py")
+
+PREEMPTION_EXIT_CODE = 75  # Exit code of a preempted process (EX_TEMPFAIL), the training can be resumed with --resume
+PREEMPTION_POLL_STEPS = 10  # Number of steps between two checks of the preemption requests of the other processes
+_requested = False  # Set by the signal handler
+_installed = False  # Either the signal handler is installed or not
+
+
+def _handle_signal(signum, frame):
+    global _requested
+    _requested = True
+    logger.warning(f"Received signal {signum}, the training will stop after the current step.")
+
+
+def install_preemption_handler(signals=(signal.SIGTERM,)):
+    """
+    The function installs the signal handler which requests the training to stop after the current optimization step.
+    It must be called from the main thread.
+
+    :param signals: The signals sent by the scheduler before preempting the process
+    """
+    global _installed
+    for signum in signals:
+        signal.signal(signum, _handle_signal)
+    _installed = True
+
+
+def preemption_requested(device="cpu", step=None):
+    """
+    The function returns True if the preemption of any of the processes has been requested, so that all the
+    processes stop after the same optimization step. In distributed mode the requests are only exchanged every
+    PREEMPTION_POLL_STEPS steps (the exchange blocks all the processes), the preemption is then handled up to
+    PREEMPTION_POLL_STEPS - 1 steps after the signal.
+
+    :param device: The device used for the communication ('cuda' for nccl, 'cpu' for gloo)
+    :param step: The optimization step, the same in all the processes (None to exchange the requests at once, e.g.
+    at the end of an epoch)
+    """
+    if not _installed:
+        return False
+    if is_distributed():
+        if step is not None and step % PREEMPTION_POLL_STEPS:
+            return False
+        return all_reduce_sum([_requested], device)[0] > 0
+    return _requested
+
+
+def get_staging_directory():
+    """
+    The function returns the local shared memory (tmpfs) directory used to write the snapshot as fast as possible,
+    the default temporary directory if not available.
+    """
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def save_preemption_snapshot(state, path):
+    """
+    The function writes the restart snapshot to the local shared memory first, then flushes it to its path in the
+    checkpoints directory. The snapshot is the training state consumed by main.py --resume (see train/state.py).
+
+    :param state: The training state
+    :param path: Path of the state file in the checkpoints directory
+    """
+    staging_path = os.path.join(get_staging_directory(), f"{os.getpid()}_{os.path.basename(path)}")
+    torch.save(state, staging_path)
+    try:
+        shutil.copyfile(staging_path, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        # Keep the staged snapshot, it can be copied manually to the checkpoints directory
+        logger.error(f"Failed to flush the restart snapshot to {path}, it is kept at {staging_path}.")
+        raise
+    os.remove(staging_path)
+    logger.warning(f"Saved the restart snapshot to {path}.")
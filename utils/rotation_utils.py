@@ -57,5 +57,14 @@ def create_4rotations_images(images, stack_dim=None):
     return images_4rot
 
 
-
-
+def create_random_rotations_images(images):
+    """Rotates each image in the batch by a random multiple of 90 degrees, returns the images and the rotation
+    labels."""
+    labels_rot = torch.randint(4, (images.size(0),), device=images.device)
+    images_rot = images.clone()
+    for r in range(1, 4):
+        index = (labels_rot == r).nonzero(as_tuple=True)[0]
+        if len(index):
+            images_rot[index] = apply_2d_rotation(images[index], rotation=r * 90)
+
+    return images_rot, labels_rot
@@ -1,12 +1,18 @@
 from importlib import import_module
-import requests
 from utils import rotation_utils as rot_utils
+from utils.distributed import is_main_process
+from utils.checkpoint import load_checkpoint_state_dict
 import torch
 import random
 import logging
 
 logger = logging.getLogger(f"utils/util.py")
 
+# The rotation modes of the SSL rotation training: 'all' forwards the four rotations of the images as one 4x batch,
+# 'single' one random rotation per image (1x batch), 'accumulate' the four rotations as 1x micro-batches with gradient
+# accumulation
+ROTATION_MODES = ["all", "single", "accumulate"]
+
 
 def get_object_from_path(path):
     """
@@ -30,6 +36,7 @@ def download_file_from_google_drive(id, destination):
     :param id: Unique google drive token for the file to download
     :param destination: Destination path
     """
+    import requests  # Only imported when the dataset is downloaded
     print(f"Downloading CUB-200-2011 dataset. It may take a while. Thank you for your patience.")
 
     URL = "https://docs.google.com/uc?export=download"
@@ -88,11 +95,39 @@ def preprocess_input_data_rotation(images, labels, rotation=True):
     return images, labels, labels_rotation
 
 
-def load_vissl_weights(model, checkpoints_path):
+def get_rotation_batches(images, labels, mode="all"):
     """
-    The function loads the VISSL (https://github.com/facebookresearch/vissl) weights.
+    The function yields the rotated (micro-)batches of a mini-batch of images for the rotation mode.
+
+    :param images: Batch of images
+    :param labels: Original labels
+    :param mode: The rotation mode ('all', 'single' or 'accumulate', see ROTATION_MODES)
+    :return: Generator of the rotated images, the original labels and the rotation labels, four batches of the size of
+    the input batch (one per rotation, built lazily) for the 'accumulate' mode, a single batch otherwise
     """
-    checkpoint = torch.load(checkpoints_path)
+    if mode == "all":
+        yield preprocess_input_data_rotation(images, labels, rotation=True)
+    elif mode == "single":
+        images, labels_rotation = rot_utils.create_random_rotations_images(images)
+        yield images, labels, labels_rotation
+    else:
+        for r in range(4):
+            labels_rotation = torch.full((images.size(0),), r, dtype=torch.long, device=images.device)
+            yield rot_utils.apply_2d_rotation(images, rotation=r * 90), labels, labels_rotation
+
+
+def load_vissl_weights(model, checkpoints_path, registry=None):
+    """
+    The function loads the VISSL (https://github.com/facebookresearch/vissl) weights, memory-mapped and copied once
+    into the parameters of the model.
+
+    :param model: The model
+    :param checkpoints_path: The path of the VISSL weights, or their name in the weight registry
+    :param registry: The weight registry (see utils/weight_registry.py), if any
+    """
+    if registry is not None and registry.get_path(checkpoints_path):
+        checkpoints_path = registry.get_path(checkpoints_path)  # Registered weights
+    checkpoint = load_checkpoint_state_dict(checkpoints_path)
     updated_checkpoints_dict = {}
     for key in checkpoint:
         updated_checkpoints_dict[f"model.{key}"] = checkpoint[key]
@@ -145,18 +180,35 @@ def get_image_crops(image, crop_size):
     return im_list
 
 
-def save_model_checkpoints(checkpoints_dir_path, epoch, state_dict, metrics, last_best_accuracy):
+def save_model_checkpoints(checkpoints_dir_path, epoch, state_dict, metrics, last_best_accuracy,
+                           checkpoint_manager=None):
     """
-    The function saves the training checkpoints (both current and best).
+    The function saves the training checkpoints (both current and best). Under distributed training only the main
+    process (rank 0) writes the checkpoints, while all the processes keep track of the best accuracy.
 
     :param checkpoints_dir_path: Checkpoints directory path
     :param epoch: Current epoch
     :param state_dict: Model's state dict of parameters
     :param metrics: The metrics of the epoch
     :param last_best_accuracy: Last best accuracy
+    :param checkpoint_manager: CheckpointManager writing the checkpoints in the background, if None the checkpoints
+    are written synchronously
     :return: Current best accuracy
     """
     current_best_accuracy = last_best_accuracy  # Variable to keep track of the current best accuracy
+    main_process = is_main_process()  # Only the main process writes the checkpoints
+    # The epochs without (or with asynchronous) validation can not be the best ones yet
+    is_best = "val" in metrics and metrics["val"]["accuracy_top_1"] > last_best_accuracy
+    if is_best:
+        current_best_accuracy = metrics["val"]["accuracy_top_1"]  # Update the current best accuracy
+        if main_process:
+            logger.info(f"New best model at epoch {epoch}.")  # New best model
+    if not (checkpoints_dir_path and main_process):
+        return current_best_accuracy
+    if checkpoint_manager is not None:
+        # Snapshot the state dict to the host memory, the files are written by the background thread
+        checkpoint_manager.save(epoch, state_dict, metrics, is_best=is_best)
+        return current_best_accuracy
     # Save the model checkpoints
     model_to_save = {
         "epoch": epoch,
@@ -166,16 +218,8 @@ def save_model_checkpoints(checkpoints_dir_path, epoch, state_dict, metrics, las
     torch.save(model_to_save,
                f"{checkpoints_dir_path}/epoch_{epoch}.pth")
     # Update the best checkpoints based on the accuracy
-    if metrics["val"]["accuracy_top_1"] > last_best_accuracy:
-        current_best_accuracy = metrics["val"]["accuracy_top_1"]  # Update the current best accuracy
-        logger.info(f"New best model at epoch {epoch}.")  # New best model
-        if checkpoints_dir_path:
-            model_to_save = {
-                "epoch": epoch,
-                "metrics": metrics,
-                'state_dict': state_dict,
-            }
-            torch.save(model_to_save,
-                       f"{checkpoints_dir_path}/best_checkpoints.pth")
+    if is_best:
+        torch.save(model_to_save,
+                   f"{checkpoints_dir_path}/best_checkpoints.pth")
 
     return current_best_accuracy
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import torch
+from utils.checkpoint import get_file_hash, load_checkpoint_state_dict
+
+logger = logging.getLogger(f"utils/weight_registry.py")
+
+
+class WeightRegistry:
+    """
+    The class implements a local registry of pretrained weights, so that the models are built without network access.
+    The weight files are stored in a content-addressed cache directory (<sha256>.pth) and the names of the weights
+    (e.g. the torchvision model names such as 'resnet50', or the VISSL weights) are mapped to their hashes by the
+    index of the cache directory (index.json) or by the configuration.
+    """
+    def __init__(self, cache_directory, entries=None):
+        """
+        Constructor, the function reads the index of the cache directory.
+
+        :param cache_directory: The cache directory path
+        :param entries: Dictionary of the hashes of the weights per name, overriding the index (e.g. to pin versions)
+        """
+        self.cache_directory = cache_directory
+        self.index_path = os.path.join(cache_directory, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.index.update(entries or {})
+
+    def get_path(self, name):
+        """
+        The function returns the path of the cached weights of the name, None if they are not in the registry.
+
+        :param name: The name of the weights
+        """
+        if name not in self.index:
+            return None
+        path = os.path.join(self.cache_directory, f"{self.index[name]}.pth")
+        return path if os.path.exists(path) else None
+
+    def load_state_dict(self, name):
+        """
+        The function returns the memory-mapped state dict of the weights of the name, the program exits if they are
+        not in the registry (the weights are never downloaded).
+
+        :param name: The name of the weights
+        """
+        path = self.get_path(name)
+        if path is None:
+            logger.info(f"The weights '{name}' are not in the weight registry {self.cache_directory}. Register them "
+                        f"with scripts/register_weights.py. Exiting!")
+            sys.exit(1)
+        return load_checkpoint_state_dict(path)
+
+    def register(self, name, path):
+        """
+        The function copies a weight file to the cache directory, named by the hash of its content, and maps the name
+        to it in the index.
+
+        :param name: The name of the weights
+        :param path: The path of the weight file (a state dict saved by torch.save)
+        :return: The hash of the weights
+        """
+        os.makedirs(self.cache_directory, exist_ok=True)
+        sha = get_file_hash(path)
+        cache_path = os.path.join(self.cache_directory, f"{sha}.pth")
+        if not os.path.exists(cache_path):
+            shutil.copyfile(path, f"{cache_path}.tmp")
+            os.replace(f"{cache_path}.tmp", cache_path)
+        self.index[name] = sha
+        with open(f"{self.index_path}.tmp", "w") as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+        return sha
+
+
+def get_weight_registry(config):
+    """
+    The function returns the weight registry of the configuration, None if the registry is not configured.
+
+    :param config: Configuration class object
+    """
+    registry = config.cfg["model"].get("weight_registry")
+    if not registry:
+        return None
+    return WeightRegistry(registry["cache_directory"], registry.get("entries"))
+
+
+def build_pretrained_model(model_function, pretrained=True, registry=None):
+    """
+    The function builds a torchvision model. With a weight registry, the pretrained model is built on the meta device
+    (no initialization of the weights) and the memory-mapped registry weights are assigned to it, otherwise the
+    torchvision weights are downloaded.
+
+    :param model_function: The torchvision model function (e.g. torchvision.models.resnet50), the registry name of its
+    weights is the function name
+    :param pretrained: Either to load the ImageNet pretrained weights or not
+    :param registry: The weight registry (WeightRegistry), None to download the torchvision weights
+    """
+    if not pretrained or registry is None:
+        return model_function(pretrained=pretrained)
+    state_dict = registry.load_state_dict(model_function.__name__)
+    with torch.device("meta"):
+        net = model_function(pretrained=False)
+    net.load_state_dict(state_dict, strict=True, assign=True)
+    logger.info(f"Loaded the '{model_function.__name__}' weights from the weight registry.")
+    return net